@@ -8,6 +8,7 @@ import coloredlogs
 
 from stemserver.girder.auth import fetch_girder_user_from_token, auth_blueprint
 from stemserver.socketio import endpoints as socketio_endpoints
+from stemserver.socketio.metrics import metrics_blueprint
 
 app = Flask(__name__)
 app.config.from_mapping(
@@ -24,6 +25,7 @@ login_manager.init_app(app)
 socketio = SocketIO(app, async_handlers=False)
 
 app.register_blueprint(auth_blueprint)
+app.register_blueprint(metrics_blueprint)
 
 # Girder authentication
 @login_manager.user_loader
@@ -11,6 +11,7 @@ setup(
         'eventlet==0.31.0',
         'flask_login',
         'requests',
-        'coloredlogs'
+        'coloredlogs',
+        'msgpack'
     ]
 )
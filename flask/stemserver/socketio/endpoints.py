@@ -7,6 +7,7 @@ from flask_login import current_user
 from flask_socketio import SocketIO, emit, join_room, disconnect
 
 from .constants import FileFormat
+from .metrics import metrics
 
 #
 # This variable keeps track of the workers associated with each client. It is
@@ -46,6 +47,7 @@ def fetch_hdf5_path(image_id):
 
 def init(socketio):
     @socketio.on('connect', namespace='/stem')
+    @metrics.instrument('connect')
     def connect():
         if current_user.is_authenticated:
             logger.debug('Client connected')
@@ -57,27 +59,31 @@ def init(socketio):
             return False
 
     @socketio.on('stem.pipeline.create', namespace='/stem')
+    @metrics.instrument('stem.pipeline.create')
     @auth_required
     def create(params):
         user_id = current_user.girder_user['_id']
         worker_id = params['workerId']
-        logger.debug('stem.pipeline.create: %s' % params)
+        logger.debug('stem.pipeline.create: %s', params)
         # Send to all worker ranks
         for sid in workers[user_id][worker_id]['ranks'].values():
             emit('stem.pipeline.create', params, room=sid, include_self=False)
 
     @socketio.on('stem.pipeline.created', namespace='/stem')
+    @metrics.instrument('stem.pipeline.created')
     @auth_required
     def created(params):
-        logger.debug('stem.pipeline.created: %s' % params)
+        logger.debug('stem.pipeline.created: %s', params)
         # We only emit the created to the id of the client
         # that originated the create request ( held in the id field )
         emit('stem.pipeline.created', params, room=params['id'], include_self=False)
 
     @socketio.on('stem.pipeline.execute', namespace='/stem')
+    @metrics.instrument('stem.pipeline.execute')
     @auth_required
     def execute(params):
-        logger.debug('stem.pipeline.execute: %s' % params)
+        logger.debug('stem.pipeline.execute: %s', params)
+        metrics.start(params)
 
         user_id = current_user.girder_user['_id']
         worker_id = params['workerId']
@@ -94,28 +100,34 @@ def init(socketio):
             emit('stem.pipeline.execute', params, room=sid, include_self=False)
 
     @socketio.on('stem.pipeline.executed', namespace='/stem')
+    @metrics.instrument('stem.pipeline.executed')
     @auth_required
     def executed(params):
         logger.debug('stem.pipeline.executed.')
+        metrics.executed(params)
         emit('stem.pipeline.executed', params, room=current_room(), include_self=False)
 
     @socketio.on('stem.pipeline.completed', namespace='/stem')
+    @metrics.instrument('stem.pipeline.completed')
     @auth_required
     def completed(params):
         logger.debug('stem.pipeline.completed.')
+        metrics.completed(params)
         emit('stem.pipeline.completed', params, room=current_room(), include_self=False)
 
     @socketio.on('stem.pipeline.delete', namespace='/stem')
+    @metrics.instrument('stem.pipeline.delete')
     @auth_required
     def delete(params):
-        logger.debug('stem.pipeline.delete: %s' % params)
+        logger.debug('stem.pipeline.delete: %s', params)
 
         emit('stem.pipeline.delete', params, room=current_room(), include_self=False)
 
     @socketio.on('stem.worker_connected', namespace='/stem')
+    @metrics.instrument('stem.worker_connected')
     @auth_required
     def worker_connected(data):
-        logger.debug('stem.worker_connected: %s' % data)
+        logger.debug('stem.worker_connected: %s', data)
         user_id = current_user.girder_user['_id']
         user_workers = workers.setdefault(user_id, {})
         worker_id = data['id']
@@ -134,21 +146,25 @@ def init(socketio):
         emit('stem.workers', user_workers, room=current_room())
 
     @socketio.on('stem.bright', namespace='/stem')
+    @metrics.instrument('stem.bright')
     @auth_required
     def bright(data):
         emit('stem.bright', data, room=current_room(), include_self=False)
 
     @socketio.on('stem.dark', namespace='/stem')
+    @metrics.instrument('stem.dark')
     @auth_required
     def dark(data):
         emit('stem.dark', data, room=current_room(), include_self=False)
 
     @socketio.on('stem.size', namespace='/stem')
+    @metrics.instrument('stem.size')
     @auth_required
     def size(data):
         emit('stem.size', data, room=current_room(), include_self=False)
 
     @socketio.on('disconnect', namespace='/stem')
+    @metrics.instrument('disconnect')
     @auth_required
     def disconnect():
         logger.debug('Client disconnected')
@@ -0,0 +1,171 @@
+import functools
+import io
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from flask import Blueprint
+from flask.json import jsonify
+from flask_login import login_required
+import msgpack
+
+#
+# Per-event instrumentation of the socket.io relay. For each event we keep:
+#
+# event ( the socket.io event name )
+#  |
+#  +--- count ( number of messages handled )
+#  |
+#  +--- bytes ( approximate payload size, binary and string leaves only )
+#  |
+#  +--- handlerTime ( a bounded sample of handler durations, in seconds )
+#
+# Executions are tracked with a correlation id assigned in
+# stem.pipeline.execute and carried by the worker in stem.pipeline.executed
+# and stem.pipeline.completed, giving the end-to-end latency through the
+# worker as seen by the relay.
+#
+
+SAMPLE_SIZE = 1024
+MAX_PENDING = 4096
+
+def payload_size(data):
+    """Approximate the size of a payload without serializing it."""
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    elif isinstance(data, dict):
+        return sum(payload_size(v) for v in data.values())
+    elif isinstance(data, (list, tuple)):
+        return sum(payload_size(v) for v in data)
+    elif data is None:
+        return 0
+
+    return 8
+
+def correlation_id(data):
+    """Get the correlation id from a message.
+
+    The worker sends stem.pipeline.executed as a msgpack packed map. Its keys
+    are read in order until the correlation id, the values of the others
+    (e.g. the result) being skipped rather than decoded.
+    """
+    if isinstance(data, dict):
+        return data.get('correlationId')
+
+    if not isinstance(data, (bytes, bytearray)):
+        return None
+
+    unpacker = msgpack.Unpacker(io.BytesIO(data), raw=False, read_size=256)
+    try:
+        for _ in range(unpacker.read_map_header()):
+            if unpacker.unpack() == 'correlationId':
+                return unpacker.unpack()
+            unpacker.skip()
+    except (msgpack.UnpackException, ValueError):
+        pass
+
+    return None
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return None
+
+    samples = sorted(samples)
+    def at(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    return {
+        'p50': at(0.5),
+        'p90': at(0.9),
+        'p99': at(0.99),
+        'max': samples[-1]
+    }
+
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._events = {}
+        self._latencies = {}
+        self._pending = OrderedDict()
+
+    def _event(self, name):
+        event = self._events.get(name)
+        if event is None:
+            event = {
+                'count': 0,
+                'bytes': 0,
+                'handlerTime': deque(maxlen=SAMPLE_SIZE)
+            }
+            self._events[name] = event
+        return event
+
+    def instrument(self, name):
+        """Decorator recording the count, size and duration of a handler."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args, **kwargs):
+                event = self._event(name)
+                event['count'] += 1
+                if len(args) > 0:
+                    event['bytes'] += payload_size(args[0])
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    event['handlerTime'].append(time.perf_counter() - start)
+            return wrapped
+        return decorator
+
+    def start(self, params):
+        """Assign a correlation id to an execution and start its clock."""
+        id = params.setdefault('correlationId', uuid.uuid4().hex)
+        self._pending[id] = time.monotonic()
+        # Drop the oldest executions if workers never report back
+        while len(self._pending) > MAX_PENDING:
+            self._pending.popitem(last=False)
+
+        return id
+
+    def _record_latency(self, name, start):
+        samples = self._latencies.setdefault(name, deque(maxlen=SAMPLE_SIZE))
+        samples.append(time.monotonic() - start)
+
+    def executed(self, data):
+        start = self._pending.get(correlation_id(data))
+        if start is not None:
+            self._record_latency('stem.pipeline.executed', start)
+
+    def completed(self, data):
+        start = self._pending.pop(correlation_id(data), None)
+        if start is not None:
+            self._record_latency('stem.pipeline.completed', start)
+
+    def snapshot(self):
+        events = {}
+        for name, event in self._events.items():
+            events[name] = {
+                'count': event['count'],
+                'bytes': event['bytes'],
+                'handlerTime': percentiles(event['handlerTime'])
+            }
+
+        latencies = {}
+        for name, samples in self._latencies.items():
+            latencies[name] = percentiles(samples)
+
+        return {
+            'events': events,
+            'latency': latencies,
+            'pending': len(self._pending)
+        }
+
+metrics = Metrics()
+
+metrics_blueprint = Blueprint('metrics_blueprint', __name__)
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    return jsonify(metrics.snapshot())
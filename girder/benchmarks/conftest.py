@@ -0,0 +1,24 @@
+import pytest
+
+from datasets import make_electron_dataset, make_raw_dataset
+
+
+@pytest.fixture(scope='session')
+def electron_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data') / 'electron.h5'
+    return str(make_electron_dataset(path))
+
+
+@pytest.fixture(scope='session')
+def raw_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data') / 'raw.h5'
+    return str(make_raw_dataset(path))
+
+
+@pytest.fixture(scope='session')
+def model():
+    from stemserver_plugin.models.stemimage import StemImage
+
+    # The chunking and encoding methods don't use the database, so skip
+    # the model initialization (which connects to it).
+    return StemImage.__new__(StemImage)
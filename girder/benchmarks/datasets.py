@@ -0,0 +1,79 @@
+import h5py
+import numpy as np
+
+
+def make_event_frames(n_frames, frame_shape=(576, 576), events_per_frame=200,
+                      rng=None):
+    """Generate electron event frames: sorted uint32 pixel indices, with a
+    Poisson distributed number of events per frame"""
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    n_pixels = frame_shape[0] * frame_shape[1]
+    counts = rng.poisson(events_per_frame, n_frames)
+    for count in counts:
+        events = rng.choice(n_pixels, min(count, n_pixels), replace=False)
+        yield np.sort(events).astype(np.uint32)
+
+
+def make_electron_dataset(path, scan_shape=(64, 64), frame_shape=(576, 576),
+                          events_per_frame=200, chunk_size=None, seed=0):
+    """Write a synthetic electron counted dataset.
+
+    The layout matches what stempy writes: `/electron_events/frames` is a
+    vlen uint32 dataset of sorted pixel indices per frame, and
+    `/electron_events/scan_positions` maps each frame to a scan position.
+    Both carry `Nx`/`Ny` attributes.
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = scan_shape[0] * scan_shape[1]
+
+    kwargs = {}
+    if chunk_size is not None:
+        kwargs['chunks'] = (chunk_size,)
+
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('electron_events')
+        frames = group.create_dataset('frames', (n_frames,),
+                                      dtype=h5py.vlen_dtype(np.uint32),
+                                      **kwargs)
+        for i, events in enumerate(make_event_frames(
+                n_frames, frame_shape, events_per_frame, rng)):
+            frames[i] = events
+        frames.attrs['Nx'] = frame_shape[1]
+        frames.attrs['Ny'] = frame_shape[0]
+
+        positions = group.create_dataset(
+            'scan_positions', data=np.arange(n_frames, dtype=np.uint32))
+        positions.attrs['Nx'] = scan_shape[1]
+        positions.attrs['Ny'] = scan_shape[0]
+
+    return path
+
+
+def make_raw_dataset(path, scan_shape=(32, 32), frame_shape=(128, 128),
+                     chunks=None, seed=0):
+    """Write a synthetic dataset of raw frames and stem images.
+
+    `/frames` holds one dense uint16 frame per scan position and
+    `/stem/images` holds a bright and a dark field image with a `names`
+    attribute.
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = scan_shape[0] * scan_shape[1]
+
+    with h5py.File(path, 'w') as f:
+        frames = f.create_dataset('frames', (n_frames,) + tuple(frame_shape),
+                                  dtype=np.uint16, chunks=chunks)
+        for i in range(n_frames):
+            frames[i] = rng.integers(0, 1024, frame_shape, dtype=np.uint16)
+
+        f.create_dataset('scan_positions',
+                         data=np.arange(n_frames, dtype=np.uint32))
+
+        images = f.create_group('stem').create_dataset(
+            'images', data=rng.random((2,) + tuple(scan_shape)))
+        images.attrs['names'] = np.array(['bright', 'dark'],
+                                         dtype=h5py.string_dtype())
+
+    return path
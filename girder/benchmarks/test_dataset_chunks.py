@@ -0,0 +1,54 @@
+import h5py
+import numpy as np
+import pytest
+
+
+def _element_wise_first_chunk(dataset, max_chunk_size=64000):
+    """The original planning loop, up to the first chunk"""
+    current_size = 0
+    for i in range(dataset.shape[0]):
+        array_size = dataset[i].size * dataset.dtype.itemsize
+        if current_size != 0 and current_size + array_size > max_chunk_size:
+            return dataset[0:i]
+        current_size += array_size
+    return dataset[:]
+
+
+@pytest.fixture(scope='module')
+def positions_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'positions.h5')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('scan_positions',
+                         data=np.arange(1024 * 1024, dtype=np.uint32),
+                         chunks=(4096,))
+    return path
+
+
+def test_chunks_cover_dataset(model, raw_file, positions_file):
+    with h5py.File(raw_file, 'r') as f:
+        dataset = f['/frames']
+        data = b''.join(a.tobytes()
+                        for a in model._get_dataset_in_chunks(dataset, 3, 10))
+        assert data == dataset[3:13].tobytes()
+
+        chunks = list(model._get_dataset_in_chunks(dataset, 5, 1))
+        assert len(chunks) == 1
+        assert np.array_equal(chunks[0], dataset[5])
+
+    with h5py.File(positions_file, 'r') as f:
+        dataset = f['/scan_positions']
+        data = b''.join(a.tobytes()
+                        for a in model._get_dataset_in_chunks(dataset, None,
+                                                              None))
+        assert data == dataset[:].tobytes()
+
+
+@pytest.mark.parametrize('implementation', ['element_wise', 'metadata'])
+def test_scan_positions_first_chunk(benchmark, model, positions_file,
+                                    implementation):
+    with h5py.File(positions_file, 'r') as f:
+        dataset = f['/scan_positions']
+        if implementation == 'element_wise':
+            benchmark(_element_wise_first_chunk, dataset)
+        else:
+            benchmark(lambda: next(model._get_dataset_in_chunks(dataset)))
@@ -0,0 +1,148 @@
+import tracemalloc
+
+import pytest
+
+from datasets import make_electron_dataset, make_raw_dataset
+
+# Benchmarks of the model methods behind the stem_images endpoints, over
+# synthetic datasets of increasing size. Each benchmark records the size
+# of the response, its throughput and the peak memory of one request in
+# extra_info, and fails if the peak memory goes above MEMORY_BUDGET.
+#
+# Save a baseline and compare later runs against it (see README.rst):
+#
+#     pytest benchmarks/test_endpoints.py --benchmark-save=baseline
+#     pytest benchmarks/test_endpoints.py --benchmark-compare \
+#         --benchmark-compare-fail=mean:20%
+
+ELECTRON_SIZES = {
+    'small': (16, 16),
+    'medium': (64, 64),
+    'large': (128, 128)
+}
+
+RAW_SIZES = {
+    'small': (8, 8),
+    'medium': (16, 16),
+    'large': (32, 32)
+}
+
+FORMATS = ['bytes', 'msgpack', 'msgpack-typed']
+ELECTRON_FORMATS = FORMATS + ['msgpack-delta', 'msgpack-delta-zlib']
+
+# The peak memory allowed for one request, the responses are streamed
+MEMORY_BUDGET = 96 * 1024 ** 2
+
+ROUNDS = 5
+
+
+class _Endpoints(object):
+    """Calls the model methods of a stem image backed by a local file.
+
+    The database lookups of the model are replaced by a fixed document,
+    the file is read through the same code paths as a file on a
+    filesystem assetstore.
+    """
+
+    def __init__(self, model, path):
+        self.model = model
+        girder_file = {'_id': path, 'size': 0}
+        model._get_local_path = lambda file: path
+        document = {'_id': path, 'public': True,
+                    'metadata': model._scan_metadata(girder_file)}
+        model._load_for_reading = lambda id, user: (document, girder_file,
+                                                    path)
+
+    def __call__(self, method, *args):
+        """Call a model method, consuming the response if it is streamed.
+
+        Returns: the size of the response in bytes
+        """
+        response = getattr(self.model, method)('id', None, *args)
+        if not callable(response):
+            return len(repr(response))
+        return sum(len(chunk) for chunk in response())
+
+
+@pytest.fixture(scope='module', params=list(ELECTRON_SIZES))
+def electron_endpoints(request, tmp_path_factory):
+    from stemserver_plugin.models.stemimage import StemImage
+
+    path = tmp_path_factory.mktemp('data') / 'electron.h5'
+    make_electron_dataset(path, scan_shape=ELECTRON_SIZES[request.param])
+    return _Endpoints(StemImage.__new__(StemImage), str(path))
+
+
+@pytest.fixture(scope='module', params=list(RAW_SIZES))
+def raw_endpoints(request, tmp_path_factory):
+    from stemserver_plugin.models.stemimage import StemImage
+
+    path = tmp_path_factory.mktemp('data') / 'raw.h5'
+    make_raw_dataset(path, scan_shape=RAW_SIZES[request.param])
+    return _Endpoints(StemImage.__new__(StemImage), str(path))
+
+
+def _peak_memory(endpoints, method, *args):
+    tracemalloc.start()
+    try:
+        endpoints(method, *args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _run(benchmark, endpoints, method, *args):
+    size = benchmark.pedantic(endpoints, (method,) + args, rounds=ROUNDS,
+                              warmup_rounds=1)
+    peak = _peak_memory(endpoints, method, *args)
+
+    benchmark.extra_info['bytes'] = size
+    benchmark.extra_info['peak_memory'] = peak
+    if benchmark.stats is not None:
+        benchmark.extra_info['bytes_per_second'] = (
+            size / benchmark.stats.stats.mean)
+
+    assert peak < MEMORY_BUDGET
+
+
+@pytest.mark.parametrize('format', ELECTRON_FORMATS)
+def test_electron_frame(benchmark, electron_endpoints, format):
+    _run(benchmark, electron_endpoints, 'frame', 17, 'electron', format)
+
+
+@pytest.mark.parametrize('format', ['msgpack', 'msgpack-typed',
+                                    'msgpack-delta', 'msgpack-delta-zlib'])
+def test_electron_all_frames(benchmark, electron_endpoints, format):
+    _run(benchmark, electron_endpoints, 'all_frames', 'electron', None,
+         None, format)
+
+
+def test_electron_scan_positions(benchmark, electron_endpoints):
+    _run(benchmark, electron_endpoints, 'scan_positions', 'electron')
+
+
+def test_electron_frame_shape(benchmark, electron_endpoints):
+    _run(benchmark, electron_endpoints, 'frame_shape', 'electron')
+
+
+@pytest.mark.parametrize('format', FORMATS)
+def test_raw_frame(benchmark, raw_endpoints, format):
+    _run(benchmark, raw_endpoints, 'frame', 17, 'raw', format)
+
+
+@pytest.mark.parametrize('format', ['msgpack', 'msgpack-typed'])
+def test_raw_all_frames(benchmark, raw_endpoints, format):
+    _run(benchmark, raw_endpoints, 'all_frames', 'raw', None, None, format)
+
+
+def test_raw_scan_positions(benchmark, raw_endpoints):
+    _run(benchmark, raw_endpoints, 'scan_positions', 'raw')
+
+
+def test_raw_frame_shape(benchmark, raw_endpoints):
+    _run(benchmark, raw_endpoints, 'frame_shape', 'raw')
+
+
+@pytest.mark.parametrize('format', FORMATS)
+def test_image(benchmark, raw_endpoints, format):
+    _run(benchmark, raw_endpoints, 'image', format, 'bright')
@@ -0,0 +1,40 @@
+import h5py
+import numpy as np
+import pytest
+
+# Compare reading frames with the native HDF5 driver against reading them
+# through a Python file object, which is how files that are not on a
+# filesystem assetstore are read (FileModel().open()). A plain Python file
+# object is the cheapest possible file-like wrapper, so the real Girder
+# file handle is at least this slow.
+
+NUM_READS = 200
+
+
+def _open_native(path):
+    return h5py.File(path, 'r')
+
+
+def _open_file_object(path):
+    return h5py.File(open(path, 'rb'), 'r')
+
+
+def _random_reads(f, dataset_path, indices):
+    dataset = f[dataset_path]
+    for i in indices:
+        dataset[i]
+
+
+@pytest.mark.parametrize('opener', [_open_native, _open_file_object],
+                         ids=['native', 'file_object'])
+@pytest.mark.parametrize('kind', ['electron', 'raw'])
+def test_random_frame_reads(benchmark, opener, kind, electron_file, raw_file):
+    if kind == 'electron':
+        path, dataset_path = electron_file, '/electron_events/frames'
+    else:
+        path, dataset_path = raw_file, '/frames'
+
+    with opener(path) as f:
+        n = f[dataset_path].shape[0]
+        indices = np.random.default_rng(0).integers(0, n, NUM_READS)
+        benchmark(_random_reads, f, dataset_path, indices)
@@ -0,0 +1,45 @@
+import msgpack
+import numpy as np
+import pytest
+
+from datasets import make_event_frames
+
+FORMATS = ['msgpack', 'msgpack-typed', 'msgpack-delta', 'msgpack-delta-zlib']
+
+
+@pytest.fixture(scope='module', params=[50, 200, 2000],
+                ids=lambda n: str(n) + '_events')
+def frames(request):
+    return list(make_event_frames(1024, events_per_frame=request.param))
+
+
+def test_delta_round_trip(frames):
+    from stemserver_plugin import encoding
+
+    for compression in encoding.DELTA_COMPRESSIONS:
+        message = encoding.packb_delta_sparse(frames, compression)
+        decoded = encoding.unpackb_delta_sparse(message)
+        assert len(decoded) == len(frames)
+        for expected, actual in zip(frames, decoded):
+            assert np.array_equal(np.sort(expected), actual)
+
+
+@pytest.mark.parametrize('format', FORMATS)
+def test_encode(benchmark, model, frames, format):
+    """Encode throughput, with the bytes per event in extra_info"""
+    size = len(benchmark(model._encode_arrays, frames, format, True))
+
+    events = sum(len(f) for f in frames)
+    benchmark.extra_info['bytes'] = size
+    benchmark.extra_info['bytes_per_event'] = size / events
+    if benchmark.stats is not None:
+        benchmark.extra_info['events_per_second'] = (
+            events / benchmark.stats.stats.mean)
+
+
+def test_decode_delta(benchmark, frames):
+    from stemserver_plugin import encoding
+
+    message = msgpack.unpackb(encoding.packb_delta_sparse(frames, 'zlib'),
+                              raw=False)
+    benchmark(encoding.unpackb_delta_sparse, message)
@@ -0,0 +1,103 @@
+import h5py
+import msgpack
+import pytest
+
+
+def _element_wise_chunks(dataset, max_chunk_size=64000):
+    """The original implementation: one read and one tolist() per element"""
+    current_size = 0
+    data = []
+    for i in range(dataset.shape[0]):
+        array = dataset[i]
+        array_size = array.size * array.dtype.itemsize
+        if len(data) != 0:
+            if current_size + array_size > max_chunk_size:
+                yield msgpack.packb(data, use_bin_type=True)
+                data.clear()
+                current_size = 0
+
+        data.append(array.tolist())
+        current_size += array_size
+
+    yield msgpack.packb(data, use_bin_type=True)
+
+
+def _block_chunks(model, dataset):
+    from stemserver_plugin import encoding
+
+    for arrays in model._get_vlen_dataset_in_chunks(dataset):
+        yield encoding.packb_arrays(arrays)
+
+
+def test_framing_is_unchanged(model, electron_file):
+    with h5py.File(electron_file, 'r') as f:
+        dataset = f['/electron_events/frames']
+        expected = list(_element_wise_chunks(dataset))
+        assert list(_block_chunks(model, dataset)) == expected
+
+
+@pytest.mark.parametrize('implementation', ['element_wise', 'block'])
+def test_all_frames_msgpack(benchmark, model, electron_file, implementation):
+    with h5py.File(electron_file, 'r') as f:
+        dataset = f['/electron_events/frames']
+        if implementation == 'element_wise':
+            benchmark(lambda: list(_element_wise_chunks(dataset)))
+        else:
+            benchmark(lambda: list(_block_chunks(model, dataset)))
+
+
+def _typed_chunks(model, dataset):
+    for arrays in model._get_vlen_dataset_in_chunks(dataset):
+        yield model._encode_arrays(arrays, 'msgpack-typed', sparse=True)
+
+
+def test_typed_round_trip(model, electron_file):
+    import numpy as np
+
+    with h5py.File(electron_file, 'r') as f:
+        dataset = f['/electron_events/frames']
+        frames = []
+        for chunk in _typed_chunks(model, dataset):
+            message = msgpack.unpackb(chunk, raw=False)
+            data = np.frombuffer(message['data'], dtype=message['dtype'])
+            offsets = np.frombuffer(message['offsets'], dtype='<u4')
+            frames += [data[offsets[i]:offsets[i + 1]]
+                       for i in range(message['shape'][0])]
+
+        assert len(frames) == dataset.shape[0]
+        for i in [0, 1, len(frames) - 1]:
+            assert np.array_equal(frames[i], dataset[i])
+
+
+@pytest.mark.parametrize('format', ['msgpack', 'msgpack-typed'])
+def test_all_frames_format(benchmark, model, electron_file, format):
+    with h5py.File(electron_file, 'r') as f:
+        dataset = f['/electron_events/frames']
+
+        def run():
+            return sum(len(model._encode_arrays(arrays, format, sparse=True))
+                       for arrays in model._get_vlen_dataset_in_chunks(dataset))
+
+        benchmark.extra_info['bytes'] = benchmark(run)
+
+
+@pytest.mark.parametrize('chunks', [None, (1, 128, 128), (8, 128, 128)])
+def test_dense_blocks_are_bounded(model, tmp_path, chunks):
+    from datasets import make_raw_dataset
+
+    path = make_raw_dataset(tmp_path / 'raw.h5', scan_shape=(8, 8),
+                            chunks=chunks)
+    with h5py.File(path, 'r') as f:
+        dataset = f['/frames']
+        frame_size = dataset[0].nbytes
+        # A block holds one HDF5 chunk when it is larger than the budget
+        max_rows = max(64000 // frame_size, chunks[0] if chunks else 1)
+
+        blocks = list(model._iter_blocks(dataset, 3, dataset.shape[0]))
+        assert all(len(b) <= max_rows for b in blocks)
+        assert sum(len(b) for b in blocks) == dataset.shape[0] - 3
+
+        frames = [a for arrays in model._get_vlen_dataset_in_chunks(dataset)
+                  for a in arrays]
+        assert len(frames) == dataset.shape[0]
+        assert all((frames[i] == dataset[i]).all() for i in [0, 9, 63])
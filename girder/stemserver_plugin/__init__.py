@@ -1,5 +1,11 @@
-from girder import plugin
+from girder import events, plugin
 from .stemimage import StemImage
+from .models.stemimage import h5_file_pool
+
+
+def _file_removed(event):
+    # Make sure a pooled handle doesn't outlive its file
+    h5_file_pool.invalidate(str(event.info['_id']))
 
 
 class StemPlugin(plugin.GirderPlugin):
@@ -7,3 +13,4 @@ class StemPlugin(plugin.GirderPlugin):
 
     def load(self, info):
         info['apiRoot'].stem_images = StemImage()
+        events.bind('model.file.remove', 'stem', _file_removed)
@@ -0,0 +1,381 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Blocks of frames are read and reduced concurrently. h5py serializes the
+# reads, the numpy work in between runs in parallel.
+MAX_WORKERS = 4
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# The most bytes of dense frames in a block, so that the blocks in flight
+# stay within a few times this size whatever the size of the frames
+BLOCK_BYTES = 16 * 1024 ** 2
+
+
+def annular_mask(frame_shape, center_x=-1, center_y=-1, inner_radius=0,
+                 outer_radius=0):
+    """Create a boolean detector mask of an annulus.
+
+    `frame_shape` is the detector (Nx, Ny). A negative center means the
+    center of the detector. As in the annular mask pipeline of the worker
+    (and stempy), a pixel is in the annulus if
+    inner_radius <= distance <= outer_radius.
+    """
+    nx, ny = frame_shape
+    if center_x < 0:
+        center_x = nx // 2
+    if center_y < 0:
+        center_y = ny // 2
+
+    y, x = np.ogrid[:ny, :nx]
+    distance2 = (x - center_x) ** 2 + (y - center_y) ** 2
+    return ((distance2 >= inner_radius ** 2) &
+            (distance2 <= outer_radius ** 2))
+
+
+def flatten_events(frames):
+    """Flatten a block of vlen frames into events and their frame index"""
+    lengths = np.fromiter((len(f) for f in frames), dtype=np.int64,
+                          count=len(frames))
+    if lengths.sum() == 0:
+        return (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int64),
+                lengths)
+
+    events = np.concatenate(list(frames))
+    frame_index = np.repeat(np.arange(len(frames)), lengths)
+    return events, frame_index, lengths
+
+
+def block_rows(dataset, max_rows=4096, max_bytes=None):
+    """Get the number of rows of the blocks to read a dataset in.
+
+    Blocks of vlen elements (electron events) hold `max_rows` rows, blocks
+    of fixed size elements (dense frames) hold at most `max_bytes` bytes
+    (`BLOCK_BYTES` by default), or a single row if it is larger.
+    """
+    if max_bytes is None:
+        max_bytes = BLOCK_BYTES
+
+    if dataset.dtype.kind == 'O':
+        return max_rows
+
+    row_size = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+    return max(1, min(max_rows, max_bytes // max(1, row_size)))
+
+
+def imap(function, items, max_pending=MAX_WORKERS):
+    """Map `function` over `items` in the thread pool, in order.
+
+    Unlike `Executor.map`, at most `max_pending` items are submitted ahead
+    of the result being consumed, so the results held at once (e.g.
+    blocks of frames) are bounded.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(_executor.submit(function, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def map_blocks(dataset, function, start=0, stop=None, block_size=4096):
+    """Apply `function(block, block_start)` to blocks of a dataset.
+
+    The blocks are read and processed in a thread pool. Returns the list
+    of results, in block order.
+    """
+    if stop is None:
+        stop = dataset.shape[0]
+
+    def process(block_start):
+        block_stop = min(stop, block_start + block_size)
+        return function(dataset[block_start:block_stop], block_start)
+
+    return list(_executor.map(process, range(start, stop, block_size)))
+
+
+def masked_counts(frames, mask):
+    """Count the events of each frame in `frames` that fall in `mask`"""
+    flat_mask = mask.ravel()
+
+    def count(block, block_start):
+        events, frame_index, _ = flatten_events(block)
+        return np.bincount(frame_index[flat_mask[events]],
+                           minlength=len(block))
+
+    blocks = map_blocks(frames, count)
+    if len(blocks) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(blocks)
+
+
+def scatter_to_scan(values, scan_positions, scan_shape):
+    """Sum per frame values into an image of the scan.
+
+    `scan_shape` is the scan (Nx, Ny), the image has shape (Ny, Nx).
+    """
+    nx, ny = scan_shape
+    image = np.bincount(scan_positions, weights=values, minlength=nx * ny)
+    return image[:nx * ny].reshape((ny, nx))
+
+
+def rectangle_positions(scan_shape, x, y, width, height):
+    """Get the scan positions of a rectangle of the scan.
+
+    `scan_shape` is the scan (Nx, Ny). The rectangle is clipped to the
+    scan.
+    """
+    nx, ny = scan_shape
+    xs = np.arange(max(0, x), min(nx, x + width))
+    ys = np.arange(max(0, y), min(ny, y + height))
+    return (ys[:, None] * nx + xs[None, :]).ravel()
+
+
+def contiguous_runs(rows, max_length=4096, max_gap=0):
+    """Split sorted unique rows into (start, stop) runs of consecutive rows.
+
+    Rows separated by at most `max_gap` missing rows are kept in the same
+    run, so that they are read at once.
+    """
+    if len(rows) == 0:
+        return []
+
+    breaks = np.nonzero(np.diff(rows) > max_gap + 1)[0] + 1
+    runs = []
+    for run in np.split(rows, breaks):
+        for start in range(0, len(run), max_length):
+            piece = run[start:start + max_length]
+            runs.append((int(piece[0]), int(piece[-1]) + 1))
+    return runs
+
+
+def detector_roi(frame_shape, roi=None, bin=1):
+    """Validate a detector region of interest and a binning factor.
+
+    `frame_shape` is the detector (Nx, Ny) and `roi` is [x, y, width,
+    height], the whole detector if `None`. The region is trimmed to a
+    multiple of `bin`.
+
+    Returns: the region as an (x, y, width, height) tuple
+    """
+    nx, ny = frame_shape
+    if roi is None:
+        roi = [0, 0, nx, ny]
+
+    if len(roi) != 4:
+        raise ValueError('The detector roi must be [x, y, width, height]')
+
+    x, y, width, height = [int(v) for v in roi]
+    if (x < 0 or y < 0 or width <= 0 or height <= 0 or
+            x + width > nx or y + height > ny):
+        raise ValueError('The detector roi is out of the bounds of the '
+                         'detector (' + str(nx) + 'x' + str(ny) + ')')
+
+    if bin < 1 or bin > min(width, height):
+        raise ValueError('bin must be between 1 and ' +
+                         str(min(width, height)))
+
+    return x, y, width - width % bin, height - height % bin
+
+
+def _binned_dtype(dtype, bin):
+    """Get a dtype that holds the sum of bin * bin values of `dtype`"""
+    if bin == 1 or dtype.kind == 'f':
+        return dtype
+    if dtype.kind == 'u':
+        return np.promote_types(dtype, np.uint32)
+    return np.promote_types(dtype, np.int32)
+
+
+def bin_dense(frames, roi, bin=1):
+    """Crop and bin dense frames, of shape (..., Ny, Nx), to the roi.
+
+    `roi` is an (x, y, width, height) tuple from `detector_roi`. The
+    frames are binned by summing bin x bin blocks of pixels.
+    """
+    x, y, width, height = roi
+    cropped = frames[..., y:y + height, x:x + width]
+    if bin == 1:
+        return cropped
+
+    shape = cropped.shape[:-2] + (height // bin, bin, width // bin, bin)
+    return cropped.reshape(shape).sum(axis=(-3, -1),
+                                      dtype=_binned_dtype(frames.dtype, bin))
+
+
+def bin_events(frames, frame_shape, roi, bin=1):
+    """Crop and bin a block of electron event frames to the roi.
+
+    Events outside of the roi are dropped, and the others are re-indexed
+    to the pixels of the binned roi, of (width // bin, height // bin).
+
+    Returns: a list of event arrays, one per frame
+    """
+    if len(frames) == 0:
+        return []
+
+    events, frame_index, _ = flatten_events(frames)
+    nx = frame_shape[0]
+    x, y, width, height = roi
+
+    event_x = events % nx
+    event_y = events // nx
+    keep = ((event_x >= x) & (event_x < x + width) &
+            (event_y >= y) & (event_y < y + height))
+    binned = (((event_y[keep] - y) // bin) * (width // bin) +
+              (event_x[keep] - x) // bin).astype(events.dtype)
+
+    lengths = np.bincount(frame_index[keep], minlength=len(frames))
+    return np.split(binned, np.cumsum(lengths)[:-1])
+
+
+def scan_position_index(scan_positions, num_positions=None):
+    """Build a CSR index from scan positions to frame rows.
+
+    Returns: an (offsets, rows) tuple of int64 arrays. The frames of scan
+             position `p` are `rows[offsets[p]:offsets[p + 1]]`, in
+             increasing order. Frames beyond `num_positions` (by default,
+             the largest position plus one) are left out.
+    """
+    scan_positions = np.asarray(scan_positions, dtype=np.int64)
+    if num_positions is None:
+        num_positions = int(scan_positions.max()) + 1 if len(
+            scan_positions) else 0
+
+    rows = np.argsort(scan_positions, kind='stable')
+    counts = np.bincount(scan_positions, minlength=num_positions)
+    offsets = np.zeros(num_positions + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[:num_positions])
+
+    # Positions past the end sort last
+    return offsets, rows[:offsets[-1]]
+
+
+def summarize_scan_positions(scan_positions, num_positions=None):
+    """Summarize how frames map to scan positions, to store in the
+    metadata. `identity` is True if frame i is scan position i."""
+    offsets, _ = scan_position_index(scan_positions, num_positions)
+    counts = np.diff(offsets)
+    num_positions = len(counts)
+
+    return {
+        'positions': num_positions,
+        'identity': bool(len(scan_positions) == num_positions and
+                         np.array_equal(scan_positions,
+                                        np.arange(num_positions))),
+        'maxFrames': int(counts.max()) if num_positions else 0,
+        'empty': int((counts == 0).sum())
+    }
+
+
+def index_rows(offsets, rows, positions):
+    """Get the frame rows of scan positions from a CSR index.
+
+    The rows are in the order of `positions`.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = offsets[positions]
+    lengths = offsets[positions + 1] - starts
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) -
+                                                  lengths, lengths)
+    return rows[np.repeat(starts, lengths) + within]
+
+
+REDUCTIONS = ['sum', 'mean', 'max']
+
+
+def reduce_frames(dataset, rows, reduction, frame_shape, sparse):
+    """Reduce the frames at `rows` of a dataset into one dense frame.
+
+    The reductions are over frames: `mean` divides the sum by the number
+    of frames, and `max` is the largest value of a pixel in any of them.
+    So an electron scan position with several frames counts each of them,
+    and one without frames doesn't count (while `frame` merges the frames
+    of a position).
+
+    The rows are read in blocks of contiguous rows, of at most
+    `BLOCK_BYTES` for dense frames, and the result is accumulated block by
+    block.
+
+    Args:
+        dataset: The frames, either vlen electron events (`sparse`) or
+                 dense raw frames
+        rows: Sorted unique frame rows to reduce
+        reduction: One of `REDUCTIONS`
+        frame_shape: The detector (Nx, Ny)
+        sparse: Whether the dataset holds electron events
+
+    Returns: a float64 array of shape (Ny, Nx) for electron events, or of
+             the shape of a frame for dense frames
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError('Unknown reduction: ' + reduction)
+
+    nx, ny = frame_shape
+    num_pixels = nx * ny
+    shape = (ny, nx) if sparse else dataset.shape[1:]
+
+    def process(run):
+        block = dataset[run[0]:run[1]]
+        if not sparse:
+            block = block.reshape((len(block), num_pixels))
+            if reduction == 'max':
+                return block.max(axis=0).astype(np.float64)
+            return block.sum(axis=0, dtype=np.float64)
+
+        events, frame_index, _ = flatten_events(block)
+        if reduction == 'max':
+            # The count of each pixel in each frame, then the max over frames
+            keys, counts = np.unique(frame_index * num_pixels + events,
+                                     return_counts=True)
+            result = np.zeros(num_pixels, dtype=np.float64)
+            np.maximum.at(result, keys % num_pixels, counts)
+            return result
+        return np.bincount(events, minlength=num_pixels).astype(np.float64)
+
+    runs = contiguous_runs(rows, max_length=block_rows(dataset))
+    result = None
+    for partial in imap(process, runs):
+        if result is None:
+            result = partial
+        elif reduction == 'max':
+            np.maximum(result, partial, out=result)
+        else:
+            result += partial
+
+    if result is None:
+        result = np.zeros(num_pixels, dtype=np.float64)
+
+    if reduction == 'mean' and len(rows) > 0:
+        result /= len(rows)
+
+    return result.reshape(shape)
+
+
+def downsample(image):
+    """Halve a 2D image with 2x2 means, repeating the last row/column of
+    odd sized images"""
+    ny, nx = image.shape
+    padded = np.pad(image, ((0, ny % 2), (0, nx % 2)), mode='edge')
+    return padded.reshape((padded.shape[0] // 2, 2,
+                           padded.shape[1] // 2, 2)).mean(axis=(1, 3))
+
+
+def level_shape(shape, level):
+    """Get the shape of a 2D image at a pyramid level"""
+    return [-(-x // 2 ** level) for x in shape]
+
+
+def pyramid_level_for_size(shape, max_size):
+    """Get the first pyramid level whose largest side fits in `max_size`"""
+    level = 0
+    while max(level_shape(shape, level)) > max(1, max_size):
+        level += 1
+    return level
+
+
+def num_pyramid_levels(shape):
+    return pyramid_level_for_size(shape, 1) + 1
@@ -0,0 +1,231 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import h5py
+import numpy as np
+
+
+class H5FilePool(object):
+    """A process wide LRU pool of read-only h5py file handles.
+
+    Handles are keyed by an id (the girder file id) and are reopened when
+    the modification time of the file on disk changes. At most `max_open`
+    idle handles are kept open; handles that are in use are never closed
+    underneath their users, they are closed once released instead.
+    """
+
+    def __init__(self, max_open=64, rdcc_nbytes=4 * 1024 ** 2):
+        self.max_open = max_open
+        # The chunk cache of each handle, large enough for a few chunks of
+        # repacked files (see `repack.CHUNK_BYTES`)
+        self.rdcc_nbytes = rdcc_nbytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @contextmanager
+    def open(self, key, path):
+        """Get an open h5py file for `path`, to be used as a context manager"""
+        entry = self._acquire(key, path)
+        try:
+            yield entry['file']
+        finally:
+            self._release(entry)
+
+    def invalidate(self, key):
+        """Drop the handle for `key`, e.g. when the file is deleted"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._retire(entry)
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._retire(self._entries.popitem()[1])
+
+    def _acquire(self, key, path):
+        mtime = os.stat(path).st_mtime_ns
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry['path'] != path or
+                                      entry['mtime'] != mtime):
+                # The file changed on disk, don't hand out the old handle
+                del self._entries[key]
+                self._retire(entry)
+                entry = None
+
+            if entry is None:
+                entry = {
+                    'path': path,
+                    'mtime': mtime,
+                    'file': h5py.File(path, 'r',
+                                      rdcc_nbytes=self.rdcc_nbytes),
+                    'users': 0,
+                    'retired': False
+                }
+                self._entries[key] = entry
+
+            self._entries.move_to_end(key)
+            entry['users'] += 1
+            self._evict()
+
+            return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry['users'] -= 1
+            if entry['retired'] and entry['users'] == 0:
+                entry['file'].close()
+            else:
+                self._evict()
+
+    def _retire(self, entry):
+        entry['retired'] = True
+        if entry['users'] == 0:
+            entry['file'].close()
+
+    def _evict(self):
+        """Close the least recently used idle handles above the bound"""
+        excess = len(self._entries) - self.max_open
+        for key in list(self._entries):
+            if excess <= 0:
+                break
+            entry = self._entries[key]
+            if entry['users'] == 0:
+                del self._entries[key]
+                self._retire(entry)
+                excess -= 1
+
+
+class TTLCache(object):
+    """A small thread safe cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl=5, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        """Remove all the entries whose key matches `predicate`"""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+
+class DiskCache(object):
+    """A bounded on-disk cache of bytes and numpy arrays.
+
+    Entries are files named after a hash of their key. When the total
+    size goes above `max_size` bytes, the least recently used entries
+    are removed.
+    """
+
+    def __init__(self, directory, max_size=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _path(self, key, extension):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+    def _get(self, key, extension):
+        path = self._path(key, extension)
+        try:
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _set(self, key, extension, write):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key, extension)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def get_bytes(self, key):
+        path = self._get(key, '.bin')
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def set_bytes(self, key, data):
+        self._set(key, '.bin', lambda f: f.write(data))
+
+    def get_array(self, key):
+        path = self._get(key, '.npy')
+        if path is None:
+            return None
+        return np.load(path)
+
+    def set_array(self, key, array):
+        self._set(key, '.npy', lambda f: np.save(f, array))
+
+    def get_arrays(self, key):
+        """Get a dict of arrays stored with `set_arrays`"""
+        path = self._get(key, '.npz')
+        if path is None:
+            return None
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    def set_arrays(self, key, **arrays):
+        self._set(key, '.npz', lambda f: np.savez(f, **arrays))
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
@@ -0,0 +1,132 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+
+import h5py
+import numpy as np
+
+from .analysis import block_rows
+
+# The products computed for every imported dataset, see
+# `compute_derived_products`.
+PRODUCTS = ['scan_counts', 'summed_diffraction', 'frame_counts']
+
+_executor = None
+
+
+class UnavailableError(Exception):
+    """The derived products can't be computed for a dataset"""
+
+
+def get_executor():
+    """Get the process pool that computes derived products.
+
+    The processes are spawned rather than forked, since the server process
+    holds threads and database connections.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def frames_type(metadata):
+    """Get the type of the frames the products of a dataset are computed
+    from, and the path of its frames.
+
+    Raises `UnavailableError` if the dataset has no frames the products
+    can be computed from.
+    """
+    types = metadata['types']
+    if 'electron' in types:
+        if types['electron']['frameShape'] is None:
+            raise UnavailableError('The detector dimensions of the electron '
+                                   'events are unknown')
+        return 'electron', '/electron_events/frames'
+    elif 'raw' in types:
+        return 'raw', '/frames'
+
+    raise UnavailableError('No frames found')
+
+
+def compute_derived_products(path, output_path, metadata, block_size=None):
+    """Compute the derived products of a dataset in one streaming pass.
+
+    The products are written to a sidecar HDF5 file at `output_path`:
+
+    /frame_counts: the number of events (electron) or the total intensity
+                   (raw) of each frame
+    /summed_diffraction: the sum of all the frames, of shape (Ny, Nx) of
+                         the detector
+    /scan_counts: `frame_counts` summed per scan position, of shape
+                  (Ny, Nx) of the scan, or flat if the scan dimensions are
+                  unknown
+
+    The frames are read `block_size` rows at a time, by default in blocks
+    bounded by bytes (see `analysis.block_rows`).
+
+    This runs in a separate process, so it only depends on the file path
+    and the metadata of the stem image (see `StemImage._scan_metadata`).
+
+    Returns: `output_path`
+    """
+    type, frames_path = frames_type(metadata)
+    info = metadata['types'][type]
+
+    with h5py.File(path, 'r') as rf:
+        frames = rf[frames_path]
+        num_frames = frames.shape[0]
+        frame_counts = np.zeros(num_frames, dtype=np.float64)
+        if block_size is None:
+            block_size = block_rows(frames)
+
+        if type == 'electron':
+            nx, ny = info['frameShape']
+            summed = np.zeros(nx * ny, dtype=np.float64)
+            scan_positions = rf.get('/electron_events/scan_positions')
+        else:
+            summed = np.zeros(frames.shape[1:], dtype=np.float64)
+            scan_positions = rf.get('/scan_positions')
+
+        for start in range(0, num_frames, block_size):
+            block = frames[start:start + block_size]
+            if type == 'electron':
+                lengths = np.fromiter((len(f) for f in block), dtype=np.int64,
+                                      count=len(block))
+                frame_counts[start:start + len(block)] = lengths
+                if lengths.sum() > 0:
+                    summed += np.bincount(np.concatenate(list(block)),
+                                          minlength=summed.size)
+            else:
+                frame_counts[start:start + len(block)] = block.reshape(
+                    (len(block), -1)).sum(axis=1, dtype=np.float64)
+                summed += block.sum(axis=0, dtype=np.float64)
+
+        if scan_positions is not None:
+            positions = scan_positions[()].astype(np.int64)
+        else:
+            positions = np.arange(num_frames)
+
+    if type == 'electron':
+        summed = summed.reshape((ny, nx))
+
+    scan_shape = info['scanShape']
+    if scan_shape is not None:
+        size = scan_shape[0] * scan_shape[1]
+    else:
+        size = int(positions.max()) + 1 if len(positions) else 0
+    scan_counts = np.bincount(positions, weights=frame_counts,
+                              minlength=size)[:size]
+    if scan_shape is not None:
+        scan_counts = scan_counts.reshape((scan_shape[1], scan_shape[0]))
+
+    # Write to a temporary file first, so a partial file is never served
+    tmp_path = output_path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        f.create_dataset('frame_counts', data=frame_counts)
+        f.create_dataset('summed_diffraction', data=summed)
+        f.create_dataset('scan_counts', data=scan_counts)
+    os.replace(tmp_path, output_path)
+
+    return output_path
@@ -0,0 +1,348 @@
+import zlib
+
+import msgpack
+import numpy as np
+
+
+def _array_header_sizes(lengths):
+    return np.where(lengths < 16, 1, np.where(lengths < 0x10000, 3, 5))
+
+
+def _write_big_endian(out, positions, values, num_bytes):
+    """Write `num_bytes` big-endian bytes of `values` after each position"""
+    for i in range(num_bytes):
+        shift = 8 * (num_bytes - 1 - i)
+        out[positions + 1 + i] = (values >> values.dtype.type(shift)) & 0xff
+
+
+def _write_array_headers(out, positions, lengths):
+    sizes = _array_header_sizes(lengths)
+
+    mask = sizes == 1
+    out[positions[mask]] = 0x90 | lengths[mask]
+
+    mask = sizes == 3
+    out[positions[mask]] = 0xdc
+    _write_big_endian(out, positions[mask], lengths[mask], 2)
+
+    mask = sizes == 5
+    out[positions[mask]] = 0xdd
+    _write_big_endian(out, positions[mask], lengths[mask], 4)
+
+
+# (predicate, tag, number of payload bytes) for each msgpack integer type,
+# in the order msgpack itself tries them.
+_UINT_TYPES = [
+    (lambda v: v < 0x80, None, 0),
+    (lambda v: v <= 0xff, 0xcc, 1),
+    (lambda v: v <= 0xffff, 0xcd, 2),
+    (lambda v: v <= 0xffffffff, 0xce, 4),
+    (lambda v: np.ones(v.shape, dtype=bool), 0xcf, 8)
+]
+
+_NEGATIVE_INT_TYPES = [
+    (lambda v: v >= -0x20, None, 0),
+    (lambda v: v >= -0x80, 0xd0, 1),
+    (lambda v: v >= -0x8000, 0xd1, 2),
+    (lambda v: v >= -0x80000000, 0xd2, 4),
+    (lambda v: np.ones(v.shape, dtype=bool), 0xd3, 8)
+]
+
+
+def _classify(values, types):
+    """Get the index into `types` for each value"""
+    classes = np.full(values.shape, len(types) - 1, dtype=np.int8)
+    unassigned = np.ones(values.shape, dtype=bool)
+    for i, (predicate, _, _) in enumerate(types):
+        mask = unassigned & predicate(values)
+        classes[mask] = i
+        unassigned &= ~mask
+    return classes
+
+
+def _element_encoder(flat):
+    """Get the per element sizes and a writer for a flat array.
+
+    Returns `None` if the dtype is not supported.
+    """
+    kind = flat.dtype.kind
+
+    if kind == 'f':
+        def write(out, positions):
+            out[positions] = 0xcb
+            payload = flat.astype('>f8').view(np.uint8).reshape(-1, 8)
+            out[positions[:, None] + np.arange(1, 9)] = payload
+        return np.full(flat.shape, 9, dtype=np.int64), write
+
+    if kind == 'b':
+        def write(out, positions):
+            out[positions] = np.where(flat, 0xc3, 0xc2)
+        return np.ones(flat.shape, dtype=np.int64), write
+
+    if kind not in ('u', 'i'):
+        return None
+
+    if kind == 'u':
+        values = flat.astype(np.uint64)
+        groups = [(np.ones(flat.shape, dtype=bool), _UINT_TYPES)]
+    else:
+        values = flat.astype(np.int64)
+        negative = values < 0
+        groups = [(~negative, _UINT_TYPES), (negative, _NEGATIVE_INT_TYPES)]
+
+    sizes = np.zeros(flat.shape, dtype=np.int64)
+    selections = []
+    for group, types in groups:
+        classes = _classify(values, types)
+        for i, (_, tag, num_bytes) in enumerate(types):
+            mask = group & (classes == i)
+            if not mask.any():
+                continue
+            sizes[mask] = num_bytes + 1
+            selections.append((mask, tag, num_bytes))
+
+    def write(out, positions):
+        for mask, tag, num_bytes in selections:
+            p = positions[mask]
+            v = values[mask]
+            if tag is None:
+                # fixint, the value is the tag
+                out[p] = v.astype(np.uint8) if kind == 'u' else v & 0xff
+            else:
+                out[p] = tag
+                _write_big_endian(out, p, v, num_bytes)
+
+    return sizes, write
+
+
+def packb_arrays(arrays):
+    """msgpack a list of 1D arrays as a list of lists.
+
+    Equivalent to `msgpack.packb([a.tolist() for a in arrays],
+    use_bin_type=True)`. The arrays must share a dtype.
+    """
+    arrays = list(arrays)
+    if len(arrays) == 0:
+        return msgpack.packb([], use_bin_type=True)
+
+    if any(a.ndim != 1 for a in arrays):
+        return msgpack.packb([a.tolist() for a in arrays], use_bin_type=True)
+
+    flat = np.concatenate(arrays)
+    encoder = _element_encoder(flat)
+    if encoder is None:
+        return msgpack.packb([a.tolist() for a in arrays], use_bin_type=True)
+    sizes, write = encoder
+
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    header_sizes = _array_header_sizes(lengths)
+    outer = _outer_header(len(arrays))
+
+    # Bytes of the elements before each element, and before each array
+    element_offsets = np.cumsum(sizes) - sizes
+    starts = np.cumsum(lengths) - lengths
+    element_bytes = np.concatenate([[0], np.cumsum(sizes)])
+    headers_through = np.cumsum(header_sizes)
+
+    header_positions = (len(outer) + element_bytes[starts] + headers_through -
+                        header_sizes)
+    array_index = np.repeat(np.arange(len(arrays)), lengths)
+    element_positions = (len(outer) + element_offsets +
+                         headers_through[array_index])
+
+    total = len(outer) + int(header_sizes.sum()) + int(sizes.sum())
+    out = np.empty(total, dtype=np.uint8)
+    out[:len(outer)] = np.frombuffer(outer, dtype=np.uint8)
+    _write_array_headers(out, header_positions, lengths)
+    write(out, element_positions)
+
+    return out.tobytes()
+
+
+def packb_array(array):
+    """msgpack a 1D array as a list, like `msgpack.packb(array.tolist())`"""
+    return packb_arrays([array])[len(_outer_header(1)):]
+
+
+def _outer_header(length):
+    if length < 16:
+        return bytes([0x90 | length])
+    elif length < 0x10000:
+        return b'\xdc' + length.to_bytes(2, 'big')
+    return b'\xdd' + length.to_bytes(4, 'big')
+
+
+def _little_endian(array):
+    return array.astype(array.dtype.newbyteorder('<'), copy=False)
+
+
+def packb_typed(array, fields=None):
+    """msgpack an array as its raw bytes together with its dtype and shape.
+
+    The message is a map: `{'dtype': '<u2', 'shape': [...], 'data': bin}`,
+    with `data` in C order and little-endian, so that it can be viewed as a
+    typed array by the client without per element decoding. Any `fields`
+    are added to the map.
+    """
+    array = np.ascontiguousarray(_little_endian(np.asarray(array)))
+    message = dict(fields or {})
+    message.update({
+        'dtype': array.dtype.str,
+        'shape': list(array.shape),
+        'data': array.tobytes()
+    })
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def packb_typed_sparse(arrays, dtype=np.uint32, fields=None):
+    """msgpack a list of 1D arrays as a flat buffer plus offsets.
+
+    The message is a map: `{'dtype': '<u4', 'shape': [n], 'offsets': bin,
+    'data': bin}`, where `offsets` holds n + 1 little-endian uint32 values
+    and array `i` is `data[offsets[i]:offsets[i + 1]]`. Any `fields` are
+    added to the map.
+    """
+    arrays = list(arrays)
+    offsets = np.zeros(len(arrays) + 1, dtype='<u4')
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    if len(arrays) > 0:
+        data = _little_endian(np.concatenate(arrays))
+    else:
+        data = np.empty(0, dtype=np.dtype(dtype).newbyteorder('<'))
+
+    message = dict(fields or {})
+    message.update({
+        'dtype': data.dtype.str,
+        'shape': [len(arrays)],
+        'offsets': offsets.tobytes(),
+        'data': data.tobytes()
+    })
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def varint_encode(values):
+    """Encode unsigned integers as LEB128 varints (7 bits per byte)"""
+    values = np.asarray(values)
+    if len(values) == 0:
+        return b''
+
+    max_value = int(values.max())
+    dtype = np.uint32 if max_value < 1 << 32 else np.uint64
+    values = values.astype(dtype)
+
+    sizes = np.ones(values.shape, dtype=np.int64)
+    for i in range(1, -(-max_value.bit_length() // 7)):
+        sizes += values >= dtype(1 << (7 * i))
+
+    # Each value is repeated once per byte and shifted to its 7 bit group.
+    # All the bytes but the last of each value have the high bit set.
+    ends = np.cumsum(sizes)
+    byte_index = np.arange(ends[-1]) - np.repeat(ends - sizes, sizes)
+    out = (np.repeat(values, sizes) >>
+           (7 * byte_index).astype(dtype)).astype(np.uint8)
+    out |= 0x80
+    out[ends - 1] &= 0x7f
+
+    return out.tobytes()
+
+
+def varint_decode(data):
+    """Decode LEB128 varints into an array of uint64"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.uint64)
+
+    ends = np.nonzero(data < 0x80)[0]
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    value_index = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(data)) - starts[value_index]) * 7)
+    groups = ((data & 0x7f).astype(np.uint64) <<
+              shifts.astype(np.uint64))
+    return np.bitwise_or.reduceat(groups, starts)
+
+
+DELTA_COMPRESSIONS = [None, 'zlib']
+
+
+def packb_delta_sparse(arrays, compression=None):
+    """msgpack a list of electron event frames as delta encoded varints.
+
+    The events of each frame are sorted, and each event is sent as its
+    difference with the previous event of the frame (the first one as
+    is), encoded as a varint. The message is a map:
+
+    {'encoding': 'delta-varint', 'compression': None or 'zlib',
+     'dtype': '<u4', 'shape': [n], 'counts': bin, 'data': bin}
+
+    where `counts` holds the varint encoded number of events of each
+    frame, and `data` the varint encoded deltas, zlib compressed if
+    `compression` is 'zlib'. The order of the events within a frame is
+    not preserved. See `unpackb_delta_sparse`.
+    """
+    if compression not in DELTA_COMPRESSIONS:
+        raise ValueError('Unknown compression: ' + str(compression))
+
+    arrays = list(arrays)
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    if lengths.sum() > 0:
+        events = np.concatenate(arrays)
+        dtype = events.dtype
+        events = events.astype(np.int64)
+        firsts = (np.cumsum(lengths) - lengths)[lengths > 0]
+
+        deltas = np.empty_like(events)
+        deltas[0] = events[0]
+        deltas[1:] = events[1:] - events[:-1]
+        # The first event of each frame is sent as is
+        deltas[firsts] = events[firsts]
+
+        # The frames written by stempy are already sorted
+        if (deltas < 0).any():
+            frame_index = np.repeat(np.arange(len(arrays)), lengths)
+            events = np.sort((frame_index << 32) | events) & 0xffffffff
+            deltas[1:] = events[1:] - events[:-1]
+            deltas[firsts] = events[firsts]
+    else:
+        dtype = np.dtype(np.uint32)
+        deltas = np.empty(0, dtype=np.int64)
+
+    data = varint_encode(deltas)
+    if compression == 'zlib':
+        data = zlib.compress(data, 1)
+
+    return msgpack.packb({
+        'encoding': 'delta-varint',
+        'compression': compression,
+        'dtype': _little_endian(np.empty(0, dtype=dtype)).dtype.str,
+        'shape': [len(arrays)],
+        'counts': varint_encode(lengths),
+        'data': data
+    }, use_bin_type=True)
+
+
+def unpackb_delta_sparse(message):
+    """Decode a message of `packb_delta_sparse` into a list of arrays"""
+    if not isinstance(message, dict):
+        message = msgpack.unpackb(message, raw=False)
+
+    data = message['data']
+    if message['compression'] == 'zlib':
+        data = zlib.decompress(data)
+
+    lengths = varint_decode(message['counts']).astype(np.int64)
+    if len(lengths) == 0:
+        return []
+
+    deltas = varint_decode(data).astype(np.int64)
+
+    # Undo the deltas within each frame, with a cumulative sum that
+    # restarts at the first event of each frame
+    events = np.cumsum(deltas)
+    firsts = (np.cumsum(lengths) - lengths)[lengths > 0]
+    if len(events) > 0:
+        restarts = np.zeros(len(events), dtype=np.int64)
+        restarts[firsts] = events[firsts] - deltas[firsts]
+        events -= np.maximum.accumulate(restarts)
+    events = events.astype(message['dtype'])
+
+    return np.split(events, np.cumsum(lengths)[:-1])
@@ -1,6 +1,14 @@
 from contextlib import contextmanager
+import datetime
+import email.utils
+import hashlib
+import json
 import os
+import tempfile
+import uuid
 
+import cherrypy
+from cherrypy.lib import httputil
 import h5py
 import msgpack
 import numpy as np
@@ -16,12 +24,58 @@ from girder.utility.filesystem_assetstore_adapter import (
     FilesystemAssetstoreAdapter
 )
 
+from ..cache import DiskCache, H5FilePool, TTLCache
+from .. import analysis
+from .. import derived
+from .. import encoding
+from .. import repack
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'stemserver_plugin')
+
+# Shared by all requests of this process
+h5_file_pool = H5FilePool(max_open=64)
+lookup_cache = TTLCache(ttl=5)
+# Scan position indexes (see `StemImage._get_scan_index`), by file version
+index_cache = TTLCache(ttl=300, max_size=16)
+disk_cache = DiskCache(os.environ.get('STEMSERVER_CACHE_DIR',
+                                      os.path.join(DATA_DIR, 'cache')))
+derived_directory = os.environ.get('STEMSERVER_DERIVED_DIR',
+                                   os.path.join(DATA_DIR, 'derived'))
+# The repacked copies are the only copy of the data of their stem images,
+# so they are kept in the assetstore the files are imported into (under
+# REPACK_SUBDIRECTORY) unless STEMSERVER_REPACK_DIR is set. It must then
+# be a persistent directory, not a temporary one.
+repack_directory = os.environ.get('STEMSERVER_REPACK_DIR')
+REPACK_SUBDIRECTORY = 'stem_repacked'
+
+# Responses of the dataset reads are deterministic for a given file. They
+# are sent with validators, so that browsers and proxies can revalidate
+# them, and optionally cached on disk when STEMSERVER_RESPONSE_CACHE_SIZE
+# (in bytes) is set.
+CACHE_MAX_AGE = int(os.environ.get('STEMSERVER_CACHE_MAX_AGE', 60))
+MAX_CACHED_RESPONSE_SIZE = 64 * 1024 ** 2
+_response_cache_size = int(os.environ.get('STEMSERVER_RESPONSE_CACHE_SIZE',
+                                          0))
+response_cache = None
+if _response_cache_size > 0:
+    response_cache = DiskCache(
+        os.environ.get('STEMSERVER_RESPONSE_CACHE_DIR',
+                       os.path.join(DATA_DIR, 'responses')),
+        max_size=_response_cache_size)
+
 
 class StemImage(AccessControlledModel):
 
     IMPORT_FOLDER = 'stem_images'
 
-    ALLOWED_FORMATS = ['bytes', 'msgpack']
+    ALLOWED_FORMATS = ['bytes', 'msgpack', 'msgpack-typed']
+
+    # Formats of electron event frames only, with their compression (see
+    # `encoding.packb_delta_sparse`)
+    SPARSE_FORMATS = {
+        'msgpack-delta': None,
+        'msgpack-delta-zlib': 'zlib'
+    }
 
     def __init__(self):
         super(StemImage, self).__init__()
@@ -40,7 +94,16 @@ class StemImage(AccessControlledModel):
 
         return doc
 
-    def create(self, user, file_id=None, file_path=None, public=False):
+    def create(self, user, file_id=None, file_path=None, public=False,
+               repack_compression=False):
+        """Create a stem image from a girder file or a file path.
+
+        When importing a file path, `repack_compression` (one of
+        `repack.COMPRESSIONS`) rewrites the frames of the file with chunks
+        tuned for scan order access in the background (see
+        `_schedule_repack`). The stem image reads the file as is until the
+        repacked copy is ready. `False` imports the file as is.
+        """
         stem_image = {}
         if file_id:
             stem_image['fileId'] = file_id
@@ -51,8 +114,12 @@ class StemImage(AccessControlledModel):
                 raise RestException('Only admin users can use a filePath', 403)
 
             name = os.path.basename(file_path)
-            item = self._create_import_item(user, name, public)
             assetstore = self._get_assetstore()
+            if repack_compression is not False:
+                stem_image['repack'] = self._prepare_repack(
+                    file_path, repack_compression, assetstore)
+
+            item = self._create_import_item(user, name, public)
 
             adapter = FilesystemAssetstoreAdapter(assetstore)
             f = adapter.importFile(item, file_path, user)
@@ -60,11 +127,135 @@ class StemImage(AccessControlledModel):
         else:
             raise RestException('Must set either fileId or filePath')
 
+        girder_file = FileModel().load(stem_image['fileId'], force=True)
+        try:
+            stem_image['metadata'] = self._scan_metadata(girder_file)
+        except OSError:
+            # Not readable as HDF5 (yet), it will be scanned on first use
+            pass
+
         self.setUserAccess(stem_image, user=user, level=AccessType.ADMIN)
         if public:
             self.setPublic(stem_image, True)
 
-        return self.save(stem_image)
+        stem_image = self.save(stem_image)
+        self._schedule_derived_products(stem_image)
+        if 'repack' in stem_image:
+            self._schedule_repack(stem_image)
+
+        return stem_image
+
+    def rescan(self, id, user):
+        """Extract the metadata of the HDF5 file again, if it changed"""
+        stem_image = self.load(id, user=user, level=AccessType.WRITE)
+
+        if not stem_image:
+            raise RestException('StemImage not found.', 404)
+
+        self.invalidate(stem_image)
+        girder_file = FileModel().load(stem_image['fileId'],
+                                       level=AccessType.READ, user=user)
+        metadata = self._scan_metadata(girder_file)
+        self.update({'_id': stem_image['_id']},
+                    {'$set': {'metadata': metadata}})
+        stem_image['metadata'] = metadata
+        self._schedule_derived_products(stem_image)
+
+        return stem_image
+
+    def _schedule_derived_products(self, stem_image):
+        """Compute the derived products of a stem image in the background.
+
+        The products (see `derived.compute_derived_products`) are computed
+        in a separate process and written to a sidecar HDF5 file. Their
+        status is kept in the `derived` field of the document.
+        """
+        girder_file = FileModel().load(stem_image['fileId'], force=True)
+        path = self._get_local_path(girder_file)
+        metadata = stem_image.get('metadata')
+        if path is None or metadata is None:
+            self._set_derived_status(stem_image, {'status': 'unavailable'})
+            return
+
+        try:
+            derived.frames_type(metadata)
+        except derived.UnavailableError as e:
+            self._set_derived_status(stem_image, {'status': 'unavailable',
+                                                  'error': str(e)})
+            return
+
+        os.makedirs(derived_directory, exist_ok=True)
+        output_path = os.path.join(derived_directory,
+                                   str(stem_image['_id']) + '.h5')
+        self._set_derived_status(stem_image, {'status': 'running'})
+
+        future = derived.get_executor().submit(
+            derived.compute_derived_products, path, output_path, metadata)
+
+        def _done(future):
+            try:
+                status = {'status': 'complete', 'path': future.result()}
+            except Exception as e:
+                status = {'status': 'error', 'error': str(e)}
+            if not self._set_derived_status(stem_image, status):
+                # The stem image was deleted while the products were
+                # computed, nothing refers to them anymore
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+        future.add_done_callback(_done)
+
+    def _set_derived_status(self, stem_image, status):
+        """Set the status of the derived products of a stem image.
+
+        Returns: False if the stem image does not exist anymore
+        """
+        status['updated'] = datetime.datetime.utcnow()
+        result = self.update({'_id': stem_image['_id']},
+                             {'$set': {'derived': status}})
+        # The file did not change, keep its pooled handle
+        self._invalidate_lookups(stem_image)
+
+        return result.matched_count > 0
+
+    def derived_status(self, id, user):
+        stem_image = self.load(id, user=user, level=AccessType.READ)
+
+        if not stem_image:
+            raise RestException('StemImage not found.', 404)
+
+        status = stem_image.get('derived', {'status': 'none'})
+        status = {k: v for k, v in status.items() if k != 'path'}
+        if status['status'] == 'complete':
+            status['products'] = derived.PRODUCTS
+
+        return status
+
+    def derived_product(self, id, user, name, format):
+        if format is None:
+            format = 'bytes'
+
+        if format not in StemImage.ALLOWED_FORMATS:
+            raise RestException('Unknown format: ' + format)
+
+        if name not in derived.PRODUCTS:
+            raise RestException('Unknown derived product: ' + name)
+
+        stem_image, _, _ = self._load_for_reading(id, user)
+        status = stem_image.get('derived', {'status': 'none'})
+        if status['status'] != 'complete':
+            raise RestException('Derived products are not available '
+                                '(status: ' + status['status'] + ')', 404)
+
+        setResponseHeader('Content-Type', 'application/octet-stream')
+
+        def _stream():
+            with h5py.File(status['path'], 'r') as rf:
+                dataset = rf[name]
+                for array in self._get_dataset_in_chunks(dataset, None, None):
+                    yield self._encode_chunk(array, format)
+
+        return _stream
 
     def delete(self, id, user):
         stem_image = self.load(id, user=user, level=AccessType.WRITE)
@@ -89,8 +280,106 @@ class StemImage(AccessControlledModel):
         except:
             pass
 
+        self.invalidate(stem_image)
+
+        derived_path = stem_image.get('derived', {}).get('path')
+        if derived_path is not None and os.path.exists(derived_path):
+            os.remove(derived_path)
+
+        # The repacked copy is owned by the stem image
+        repack_path = stem_image.get('repack', {}).get('path')
+        if repack_path is not None and os.path.exists(repack_path):
+            os.remove(repack_path)
+
         return self.remove(stem_image)
 
+    def _prepare_repack(self, file_path, compression, assetstore):
+        """Check that a file can be repacked and choose the path of its copy.
+
+        The copy is written to `repack_directory` if it is set, or in the
+        assetstore otherwise (see `REPACK_SUBDIRECTORY`).
+
+        Returns: the initial `repack` field of the stem image
+        """
+        if compression not in repack.COMPRESSIONS:
+            raise RestException('Unknown compression: ' + str(compression))
+
+        if not h5py.is_hdf5(file_path):
+            raise RestException('Failed to repack ' + file_path +
+                                ': not an HDF5 file')
+
+        directory = repack_directory
+        if directory is None:
+            directory = os.path.join(assetstore['root'], REPACK_SUBDIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        output_path = os.path.join(directory, uuid.uuid4().hex + '-' +
+                                   os.path.basename(file_path))
+
+        return {
+            'status': 'running',
+            'compression': compression,
+            'source': file_path,
+            'path': output_path
+        }
+
+    def _schedule_repack(self, stem_image):
+        """Repack the file of a stem image in the background.
+
+        The repack runs in the process pool of `repack`, apart from the
+        derived products, which it would otherwise queue behind. Once the
+        copy is verified the girder file is pointed at it, and the
+        stem image reads it from then on. The `repack` field of the
+        document holds the status, and then the report of `repack.repack`.
+        """
+        info = stem_image['repack']
+        future = repack.get_executor().submit(
+            repack.repack, info['source'], info['path'], info['compression'])
+
+        def _done(future):
+            try:
+                report = future.result()
+                report.update(info, status='complete')
+                self._use_repacked_file(stem_image, report)
+            except Exception as e:
+                status = {k: v for k, v in info.items() if k != 'path'}
+                status.update(status='error', error=str(e))
+                self.update({'_id': stem_image['_id']},
+                            {'$set': {'repack': status}})
+                if os.path.exists(info['path']):
+                    os.remove(info['path'])
+                return
+
+            self.invalidate(stem_image)
+
+        future.add_done_callback(_done)
+
+    def _use_repacked_file(self, stem_image, report):
+        """Point the girder file of a stem image at its repacked copy.
+
+        The file was imported from the original (see `create`), so only its
+        path changes, and the original stays on disk.
+        """
+        result = self.update({'_id': stem_image['_id']},
+                             {'$set': {'repack': report}})
+        if result.matched_count == 0:
+            raise Exception('The stem image was deleted')
+
+        FileModel().update({'_id': stem_image['fileId']},
+                           {'$set': {'path': report['path'],
+                                     'size': report['size'],
+                                     'mtime': os.path.getmtime(
+                                         report['path'])}})
+
+    def invalidate(self, stem_image):
+        """Drop cached lookups and pooled file handles of a stem image"""
+        self._invalidate_lookups(stem_image)
+        h5_file_pool.invalidate(str(stem_image['fileId']))
+
+    def _invalidate_lookups(self, stem_image):
+        """Drop the cached lookups of a stem image (see `_load_for_reading`)"""
+        id = str(stem_image['_id'])
+        lookup_cache.invalidate(lambda key: key[0] == id)
+
     @contextmanager
     def _open_h5py_file(self, stem_image_id, user):
         """Get an h5py file object of the stem image
@@ -100,6 +389,43 @@ class StemImage(AccessControlledModel):
         with self._open_h5py_file(id, user) as f:
             do_stuff_with_file(f)
         """
+        _, girder_file, _ = self._load_for_reading(stem_image_id, user)
+        with self._open_girder_file(girder_file) as f:
+            yield f
+
+    @contextmanager
+    def _open_girder_file(self, girder_file):
+        """Get an h5py file object of a girder file, as a context manager"""
+        path = self._get_local_path(girder_file)
+
+        # Files on a filesystem assetstore are opened by path, so that
+        # h5py reads through the native HDF5 driver. Going through
+        # FileModel().open() makes every read a Python callback.
+        # Those handles are pooled across requests.
+        if path is not None:
+            with h5_file_pool.open(str(girder_file['_id']), path) as f:
+                yield f
+        else:
+            with FileModel().open(girder_file) as rf:
+                with h5py.File(rf, 'r') as f:
+                    yield f
+
+    def _load_for_reading(self, stem_image_id, user):
+        """Load a stem image and its file, checking read access.
+
+        The result is cached for a few seconds per (stem image, user) so
+        that browsing frames does not repeat the lookups on every request.
+
+        Returns: a tuple of the stem image, its girder file, and the local
+                 path of the file (`None` if it is not on a filesystem
+                 assetstore).
+        """
+        user_id = str(user['_id']) if user else None
+        key = (str(stem_image_id), user_id)
+        cached = lookup_cache.get(key)
+        if cached is not None:
+            return cached
+
         stem_image = self.load(stem_image_id, user=user, level=AccessType.READ)
 
         if not stem_image:
@@ -107,23 +433,149 @@ class StemImage(AccessControlledModel):
 
         girder_file = FileModel().load(stem_image['fileId'],
                                        level=AccessType.READ, user=user)
-        with FileModel().open(girder_file) as rf:
-            yield h5py.File(rf, 'r')
+        result = (stem_image, girder_file, self._get_local_path(girder_file))
+        lookup_cache.set(key, result)
+
+        return result
 
     def _get_h5_dataset(self, id, user, path, offset=None, limit=None, format='bytes'):
         if format == 'bytes' or format is None:
             return self._get_h5_dataset_bytes(id, user, path, offset, limit)
         elif format == 'msgpack':
             return self._get_h5_dataset_msgpack(id, user, path, offset, limit)
+        elif format == 'msgpack-typed':
+            return self._get_h5_dataset_msgpack_typed(id, user, path, offset,
+                                                      limit)
         else:
             raise RestException('Unknown format: ' + format)
 
+    def metadata(self, id, user):
+        """Get the metadata of the HDF5 file of a stem image.
+
+        The metadata is extracted once and stored in the stem image
+        document (see `_scan_metadata`). Documents created before it was
+        stored are scanned on first use.
+        """
+        stem_image, girder_file, _ = self._load_for_reading(id, user)
+        metadata = stem_image.get('metadata')
+        if metadata is None:
+            metadata = self._scan_metadata(girder_file)
+            self.update({'_id': stem_image['_id']},
+                        {'$set': {'metadata': metadata}})
+            stem_image['metadata'] = metadata
+
+        return metadata
+
+    def _scan_metadata(self, girder_file):
+        """Read the shapes and attributes needed by the endpoints.
+
+        Returns a dict of the form:
+
+        {
+            'types': {
+                'electron': {'frames': 4096, 'frameShape': [576, 576],
+                             'scanShape': [64, 64],
+                             'scanIndex': {'positions': 4096,
+                                           'identity': True,
+                                           'maxFrames': 1, 'empty': 0}},
+                'raw': ...
+            },
+            'images': {'names': ['bright', 'dark'], 'count': 2,
+                       'shape': [64, 64]},
+            'scanned': datetime
+        }
+
+        `frameShape` and `scanShape` are `None` if their dimensions are
+        not in the file, and `images` is `None` if there are no images.
+        `scanIndex` summarizes how electron frames map to scan positions
+        (see `analysis.summarize_scan_positions`).
+        """
+        metadata = {
+            'types': {},
+            'images': None,
+            'scanned': datetime.datetime.utcnow()
+        }
+
+        def nx_ny(dataset):
+            if dataset is None:
+                return None
+            if 'Nx' not in dataset.attrs or 'Ny' not in dataset.attrs:
+                return None
+            return [int(dataset.attrs['Nx']), int(dataset.attrs['Ny'])]
+
+        with self._open_girder_file(girder_file) as rf:
+            for type in ['electron', 'raw']:
+                path = self._get_path_to_type(type)
+                if path not in rf:
+                    continue
+
+                dataset = rf[path]
+                if type == 'electron':
+                    frame_shape = nx_ny(dataset)
+                    scans = rf.get('/electron_events/scan_positions')
+                else:
+                    frame_shape = [int(x) for x in dataset.shape[1:3]]
+                    scans = rf.get('/scan_positions')
+
+                metadata['types'][type] = {
+                    'frames': int(dataset.shape[0]),
+                    'frameShape': frame_shape,
+                    'scanShape': nx_ny(scans)
+                }
+
+                if type == 'electron':
+                    scan_shape = nx_ny(scans)
+                    if scans is not None:
+                        positions = scans[()].astype(np.int64)
+                    else:
+                        positions = np.arange(dataset.shape[0])
+                    num_positions = None
+                    if scan_shape is not None:
+                        num_positions = scan_shape[0] * scan_shape[1]
+                    metadata['types'][type]['scanIndex'] = (
+                        analysis.summarize_scan_positions(positions,
+                                                          num_positions))
+
+            images = rf.get('/stem/images')
+            if images is not None:
+                names = images.attrs.get('names', [])
+                metadata['images'] = {
+                    'names': [n.decode() if isinstance(n, bytes) else str(n)
+                              for n in names],
+                    'count': int(images.shape[0]),
+                    'shape': [int(x) for x in images.shape[1:]]
+                }
+
+        return metadata
+
+    def _get_type_metadata(self, id, user, type):
+        """Get the metadata of a frame type, raising if there is no data"""
+        path = self._get_path_to_type(type)
+        info = self.metadata(id, user)['types'].get(type)
+        if info is None or info['frames'] <= 0:
+            raise RestException('No data found in dataset: ' + path)
+
+        return info
+
+    def _get_images_metadata(self, id, user):
+        images = self.metadata(id, user)['images']
+        if images is None:
+            raise RestException('No stem images found.', 404)
+
+        return images
+
     def image_names(self, id, user):
-        path = '/stem/images'
-        with self._open_h5py_file(id, user) as rf:
-            return rf[path].attrs['names'].tolist()
+        return self._get_images_metadata(id, user)['names']
+
+    def image(self, id, user, format, name, level=None, max_size=None,
+              x=None, y=None, width=None, height=None):
+        """Get a stem image, optionally downsampled and/or cropped.
 
-    def image(self, id, user, format, name):
+        Level 0 is the full resolution image and each level halves the
+        image with 2x2 means. `max_size` selects the first level whose
+        largest side fits in it. `x`, `y`, `width` and `height` select a
+        tile, in the coordinates of the level.
+        """
         path = '/stem/images'
 
         if format is None:
@@ -132,79 +584,188 @@ class StemImage(AccessControlledModel):
         if format not in StemImage.ALLOWED_FORMATS:
             raise RestException('Unknown format: ' + format)
 
-        with self._open_h5py_file(id, user) as rf:
-            # Check if the name is an integer. If so, assume it is
-            # an index and not a name.
-            if self._str_is_int(name):
-                index = int(name)
-                if index >= len(rf[path]):
-                    raise RestException('Index is too large')
-            else:
-                # Get the index of the data from the name
-                index = self._get_image_index_from_name(rf[path], name)
+        images = self._get_images_metadata(id, user)
+        index = self._get_image_index(images, name)
+        level = self._get_pyramid_level(images, level, max_size)
 
-        setResponseHeader('Content-Type', 'application/octet-stream')
-        def _stream():
-            with self._open_h5py_file(id, user) as rf:
-                dataset = rf[path][index]
-                for array in self._get_vlen_dataset_in_chunks(dataset):
-                    if format == 'bytes':
-                        yield np.array(array, copy=False).tobytes()
-                    elif format == 'msgpack':
-                        yield msgpack.packb(array, use_bin_type=True)
+        shape = analysis.level_shape(images['shape'], level)
+        tile = self._get_tile(shape, x, y, width, height)
 
-        return _stream
+        def respond():
+            if level > 0:
+                image = self._get_pyramid_level_image(id, user, index, level)
+                if tile is not None:
+                    image = image[tile]
 
-    def image_shape(self, id, user, name):
-        path = '/stem/images'
-        with self._open_h5py_file(id, user) as rf:
-            dataset = rf[path]
+            setResponseHeader('Content-Type', 'application/octet-stream')
+            def _stream():
+                if level > 0:
+                    for arrays in self._get_vlen_dataset_in_chunks(image):
+                        yield self._encode_arrays(arrays, format)
+                    return
 
-            if self._str_is_int(name):
-                index = int(name)
-                if index >= len(dataset):
-                    raise RestException('Index is too large')
-            else:
-                index = self._get_image_index_from_name(dataset, name)
+                with self._open_h5py_file(id, user) as rf:
+                    if tile is not None:
+                        dataset = rf[path][(index,) + tile]
+                    else:
+                        dataset = rf[path][index]
+                    for arrays in self._get_vlen_dataset_in_chunks(dataset):
+                        yield self._encode_arrays(arrays, format)
 
-            return dataset[index].shape
+            return _stream
 
-    def frames_types(self, id, user):
-        types = []
+        params = {
+            'format': format,
+            'index': index,
+            'level': level,
+            'tile': [[t.start, t.stop] for t in tile] if tile else None
+        }
+        return self._cached_response(id, user, 'image', params, respond)
+
+    def image_shape(self, id, user, name, level=None, max_size=None):
+        images = self._get_images_metadata(id, user)
+        # Validate the name
+        self._get_image_index(images, name)
+        level = self._get_pyramid_level(images, level, max_size)
+
+        return analysis.level_shape(images['shape'], level)
+
+    def _get_pyramid_level(self, images, level, max_size):
+        """Get the pyramid level from either a level or a max size"""
+        num_levels = analysis.num_pyramid_levels(images['shape'])
+        if level is None:
+            if max_size is None:
+                return 0
+            return analysis.pyramid_level_for_size(images['shape'], max_size)
+
+        if level < 0 or level >= num_levels:
+            raise RestException('level must be between 0 and ' +
+                                str(num_levels - 1))
+        return level
+
+    def _get_tile(self, shape, x, y, width, height):
+        """Get the slices of a tile of an image of `shape` (rows, columns).
+
+        Returns `None` if no tile is requested.
+        """
+        if (x, y, width, height) == (None, None, None, None):
+            return None
+
+        x = 0 if x is None else x
+        y = 0 if y is None else y
+        width = shape[1] - x if width is None else width
+        height = shape[0] - y if height is None else height
+        if (x < 0 or y < 0 or width <= 0 or height <= 0 or
+                x + width > shape[1] or y + height > shape[0]):
+            raise RestException('The tile is out of the bounds of the image '
+                                '(' + str(shape[1]) + 'x' + str(shape[0]) +
+                                ')')
+
+        return (slice(y, y + height), slice(x, x + width))
+
+    def _get_pyramid_level_image(self, id, user, index, level):
+        """Get a downsampled level of a stem image.
+
+        The whole pyramid of the image is built the first time one of its
+        levels is requested and cached on disk.
+        """
+        def key(level):
+            return self._cache_key(id, user, 'pyramid',
+                                   {'index': index, 'level': level})
+
+        image = disk_cache.get_array(key(level))
+        if image is not None:
+            return image
 
         with self._open_h5py_file(id, user) as rf:
-            for type in ['electron', 'raw']:
-                path = self._get_path_to_type(type)
-                try:
-                    if rf[path].shape[0] > 0:
-                        types.append(type)
-                except KeyError:
-                    pass
+            current = rf['/stem/images'][index]
+
+        result = None
+        for i in range(1, analysis.num_pyramid_levels(current.shape)):
+            current = analysis.downsample(current)
+            disk_cache.set_array(key(i), current)
+            if i == level:
+                result = current
 
-        return types
+        return result
+
+    def frames_types(self, id, user):
+        types = self.metadata(id, user)['types']
+        return [type for type in ['electron', 'raw']
+                if type in types and types[type]['frames'] > 0]
 
-    def frame(self, id, user, scan_position, type, format):
+    def frame(self, id, user, scan_position, type, format, bin=None,
+              roi=None):
+        """Get the frame of a scan position.
+
+        Electron datasets can have several frames per scan position, their
+        events are sent together as one frame (see `_get_scan_index`).
+        """
         path = self._get_path_to_type(type)
 
         # Make sure the scan position is not out of bounds
-        with self._open_h5py_file(id, user) as rf:
-            dataset = rf[path]
-            if dataset.shape[0] <= 0:
-                raise RestException('No data found in dataset: ' + path)
-            if scan_position >= dataset.shape[0]:
-                msg = ('scan_position ' + str(scan_position) + ' is greater '
-                       'than the max: ' + str(dataset.shape[0] - 1))
-                raise RestException(msg)
+        info = self._get_type_metadata(id, user, type)
+        num_positions = self._get_num_scan_positions(info)
+        if scan_position >= num_positions:
+            msg = ('scan_position ' + str(scan_position) + ' is greater '
+                   'than the max: ' + str(num_positions - 1))
+            raise RestException(msg)
+
+        if format is None:
+            format = 'bytes'
+
+        self._check_format(format, type, StemImage.ALLOWED_FORMATS)
+        sparse_format = format in StemImage.SPARSE_FORMATS
+
+        transform = self._get_frame_transform(id, user, type, bin, roi)
+        index = self._get_scan_index(id, user, type)
+
+        def respond():
+            if transform is None and index is None and not sparse_format:
+                return self._get_h5_dataset(id, user, path,
+                                            offset=scan_position, limit=1,
+                                            format=format)
 
-        return self._get_h5_dataset(id, user, path, offset=scan_position, limit=1, format=format)
+            setResponseHeader('Content-Type', 'application/octet-stream')
+
+            def _stream():
+                with self._open_h5py_file(id, user) as rf:
+                    dataset = rf[path]
+                    sparse = dataset.dtype.kind == 'O'
+                    frame = [array for _, array in self._iter_position_frames(
+                        dataset, np.array([scan_position]), index)]
+                    if transform is not None:
+                        if not sparse:
+                            # Dense frames are transformed as a block
+                            frame = np.stack(frame)
+                        frame = transform(frame)
+                    yield self._encode_frame(frame, format, sparse)
 
-    def all_frames(self, id, user, type, limit=None, offset=None):
+            return _stream
+
+        params = {
+            'type': type,
+            'scanPosition': scan_position,
+            'format': format,
+            'bin': bin,
+            'roi': roi
+        }
+        return self._cached_response(id, user, 'frame', params, respond)
+
+    def all_frames(self, id, user, type, limit=None, offset=None,
+                   format=None, bin=None, roi=None):
         path = self._get_path_to_type(type)
 
+        if format is None:
+            format = 'msgpack'
+
+        self._check_format(format, type, ['msgpack', 'msgpack-typed'])
+
         # Ensure limit and offset are reasonable
-        with self._open_h5py_file(id, user) as rf:
-            limit, offset = self._check_limit_and_offset(rf[path], limit,
-                                                         offset)
+        num_frames = self._get_type_metadata(id, user, type)['frames']
+        limit, offset = self._check_limit_and_offset(num_frames, limit,
+                                                     offset)
+        transform = self._get_frame_transform(id, user, type, bin, roi)
 
         setResponseHeader('Content-Type', 'application/octet-stream')
 
@@ -213,52 +774,624 @@ class StemImage(AccessControlledModel):
             nonlocal user
             with self._open_h5py_file(id, user) as rf:
                 dataset = rf[path]
-                for data in self._get_vlen_dataset_in_chunks(dataset, limit,
-                                                             offset):
-                    yield msgpack.packb(data, use_bin_type=True)
+                sparse = dataset.dtype.kind == 'O'
+                for arrays in self._get_vlen_dataset_in_chunks(
+                        dataset, limit, offset, transform=transform):
+                    yield self._encode_arrays(arrays, format, sparse)
+
+        params = {
+            'type': type,
+            'limit': limit,
+            'offset': offset,
+            'format': format,
+            'bin': bin,
+            'roi': roi
+        }
+        return self._cached_response(id, user, 'all_frames', params,
+                                     lambda: _stream)
+
+    def frames(self, id, user, type, positions=None, ranges=None,
+               format=None):
+        """Get the frames of a list of scan positions.
+
+        The positions are given as a list, and/or as [start, stop) ranges
+        that are clipped to the scan. They are sorted and merged into
+        contiguous reads, and the frames are streamed in chunks, each
+        tagged with the positions of its frames. Like in `frame`, the
+        frames of a scan position are sent as one frame.
+
+        With msgpack-typed (default), each chunk is the map of
+        `encoding.packb_typed_sparse` (electron) or `encoding.packb_typed`
+        (raw) with an additional `positions` entry, holding little-endian
+        uint32 values. With msgpack, each chunk is a map of `positions`
+        and `frames` lists.
+        """
+        path = self._get_path_to_type(type)
+
+        if format is None:
+            format = 'msgpack-typed'
+
+        if format not in ('msgpack', 'msgpack-typed'):
+            raise RestException('Unknown format: ' + format)
+
+        info = self._get_type_metadata(id, user, type)
+        num_positions = self._get_num_scan_positions(info)
+
+        # The ranges are clipped to the scan, so the selection is bounded
+        # by the number of scan positions whatever the request
+        selected = np.zeros(num_positions, dtype=bool)
+        if ranges is not None and not isinstance(ranges, list):
+            raise RestException('Ranges must be a list of [start, stop] pairs')
+        for r in ranges or []:
+            try:
+                start, stop = [int(x) for x in r]
+            except (TypeError, ValueError):
+                raise RestException('Ranges must be [start, stop] pairs')
+            selected[max(0, start):max(0, min(stop, num_positions))] = True
+
+        try:
+            positions = np.asarray(positions or [], dtype=np.int64)
+        except (TypeError, ValueError):
+            positions = None
+        if positions is None or positions.ndim != 1:
+            raise RestException('Positions must be a list of scan positions')
+        if len(positions) > 0 and (positions.min() < 0 or
+                                   positions.max() >= num_positions):
+            raise RestException('Scan positions must be between 0 and ' +
+                                str(num_positions - 1))
+        selected[positions] = True
+        positions = np.flatnonzero(selected)
+
+        index = self._get_scan_index(id, user, type)
+
+        setResponseHeader('Content-Type', 'application/octet-stream')
+
+        def _stream():
+            packer = msgpack.Packer(use_bin_type=True)
+            with self._open_h5py_file(id, user) as rf:
+                dataset = rf[path]
+                sparse = dataset.dtype.kind == 'O'
+                for chunk_positions, arrays in self._get_positions_in_chunks(
+                        dataset, positions, index):
+                    if format == 'msgpack':
+                        yield (packer.pack_map_header(2) +
+                               msgpack.packb('positions') +
+                               encoding.packb_array(chunk_positions) +
+                               msgpack.packb('frames') +
+                               encoding.packb_arrays(arrays))
+                        continue
+
+                    fields = {
+                        'positions': chunk_positions.astype('<u4').tobytes()
+                    }
+                    if sparse:
+                        yield encoding.packb_typed_sparse(arrays,
+                                                          fields=fields)
+                    else:
+                        yield encoding.packb_typed(np.stack(arrays),
+                                                   fields=fields)
 
         return _stream
 
-    def frame_shape(self, id, user, type):
-        path = self._get_path_to_type(type)
-        with self._open_h5py_file(id, user) as rf:
-            dataset = rf[path]
-            if type == 'electron':
-                if 'Nx' not in dataset.attrs or 'Ny' not in dataset.attrs:
-                    raise RestException('Detector dimensions not found!', 404)
+    def _get_positions_in_chunks(self, dataset, positions, index=None,
+                                 max_chunk_size=64000):
+        """A generator to yield the frames of sorted unique `positions`.
+
+        The frames are read with `_iter_position_frames` and grouped like
+        in `_get_vlen_dataset_in_chunks`.
 
-                return int(dataset.attrs['Nx']), int(dataset.attrs['Ny'])
-            elif type == 'raw':
-                return dataset.shape[1], dataset.shape[2]
+        Yields: (positions, list of numpy arrays) tuples
+        """
+        current_size = 0
+        chunk_positions = []
+        data = []
+        for position, array in self._iter_position_frames(dataset, positions,
+                                                          index):
+            array_size = array.size * array.dtype.itemsize
+            if len(data) != 0:
+                if current_size + array_size > max_chunk_size:
+                    yield np.array(chunk_positions, dtype=np.int64), data
+                    chunk_positions = []
+                    data = []
+                    current_size = 0
+
+            chunk_positions.append(position)
+            data.append(array)
+            current_size += array_size
+
+        if len(data) > 0:
+            yield np.array(chunk_positions, dtype=np.int64), data
 
-        raise RestException('In frame_shape, unknown type: ' + type)
+    def _iter_position_frames(self, dataset, positions, index=None,
+                              max_gap=16, batch_size=4096):
+        """A generator to yield the frame of each of sorted `positions`.
+
+        With a scan position `index` (see `_get_scan_index`), the events of
+        all the frames of a position are concatenated into one frame.
+        Otherwise position i is row i. The rows are read in merged runs:
+        rows closer than `max_gap` are read together, and the frames in
+        between are dropped.
+
+        Yields: (position, numpy array) tuples
+        """
+        def read(rows):
+            for start, stop in analysis.contiguous_runs(rows,
+                                                        max_gap=max_gap):
+                block = dataset[start:stop]
+                run_rows = rows[(rows >= start) & (rows < stop)]
+                yield from zip(run_rows, block[run_rows - start])
+
+        if index is None:
+            yield from read(positions)
+            return
+
+        offsets, index_rows = index
+        for i in range(0, len(positions), batch_size):
+            batch = positions[i:i + batch_size]
+            frames = dict(read(np.unique(analysis.index_rows(
+                offsets, index_rows, batch))))
+            for position in batch:
+                arrays = [frames[row] for row in
+                          index_rows[offsets[position]:offsets[position + 1]]]
+                if len(arrays) == 0:
+                    dtype = h5py.check_vlen_dtype(dataset.dtype)
+                    yield position, np.empty(0, dtype=dtype or np.uint32)
+                else:
+                    yield position, np.concatenate(arrays)
+
+    def frame_shape(self, id, user, type):
+        self._get_path_to_type(type)
+        info = self.metadata(id, user)['types'].get(type)
+        if info is None or info['frameShape'] is None:
+            raise RestException('Detector dimensions not found!', 404)
+
+        return info['frameShape']
 
     def scan_positions(self, id, user, type):
         path = self._get_path_to_type(type)
         if type == 'electron':
-            return self._get_h5_dataset(id, user, path)
+            def respond():
+                return self._get_h5_dataset(
+                    id, user, '/electron_events/scan_positions')
         elif type == 'raw':
+            def respond():
+                setResponseHeader('Content-Type', 'application/octet-stream')
+
+                def _stream():
+                    with self._open_h5py_file(id, user) as rf:
+                        dataset = rf[path]
+                        yield np.arange(dataset.shape[0],
+                                        dtype=np.int64).tobytes()
+
+                return _stream
+        else:
+            raise RestException('In scan_positions, unknown type: ' + type)
+
+        return self._cached_response(id, user, 'scan_positions',
+                                     {'type': type}, respond)
+
+    def virtual_detector(self, id, user, center_x, center_y, inner_radius,
+                         outer_radius, format):
+        """Compute an annular virtual detector image from electron events.
+
+        The image is cached on disk per (file, parameters).
+        """
+        if format is None:
+            format = 'bytes'
+
+        if format not in StemImage.ALLOWED_FORMATS:
+            raise RestException('Unknown format: ' + format)
+
+        info = self._get_type_metadata(id, user, 'electron')
+        if info['frameShape'] is None or info['scanShape'] is None:
+            raise RestException('Detector or scan dimensions not found!', 404)
+
+        params = {
+            'centerX': center_x,
+            'centerY': center_y,
+            'innerRadius': inner_radius,
+            'outerRadius': outer_radius
+        }
+        def respond():
+            key = self._cache_key(id, user, 'virtual_detector', params)
+            image = disk_cache.get_array(key)
+            if image is None:
+                mask = analysis.annular_mask(info['frameShape'], center_x,
+                                             center_y, inner_radius,
+                                             outer_radius)
+                with self._open_h5py_file(id, user) as rf:
+                    counts = analysis.masked_counts(
+                        rf['/electron_events/frames'], mask)
+                    positions = self._get_electron_scan_positions(rf)
+                image = analysis.scatter_to_scan(counts, positions,
+                                                 info['scanShape'])
+                disk_cache.set_array(key, image)
+
             setResponseHeader('Content-Type', 'application/octet-stream')
 
             def _stream():
-                with self._open_h5py_file(id, user) as rf:
-                    dataset = rf[path]
-                    array = np.array([i for i in range(dataset.shape[0])])
-                    yield array.tobytes()
+                for arrays in self._get_vlen_dataset_in_chunks(image):
+                    yield self._encode_arrays(arrays, format)
+
+            return _stream
+
+        return self._cached_response(id, user, 'virtual_detector',
+                                     dict(params, format=format), respond)
+
+    def reduce_frames(self, id, user, type, reduction, positions=None, x=None,
+                      y=None, width=None, height=None, format=None, bin=None,
+                      roi=None):
+        """Reduce the frames of a set of scan positions to one frame.
+
+        The scan positions are either given as a list, or as a rectangle of
+        the scan. The frames of those positions are read in contiguous runs
+        and reduced over frames with `reduction` (sum, mean or max, see
+        `analysis.reduce_frames`) on the server. The
+        reduced frame is then cropped and binned (see
+        `_get_frame_transform`).
+        """
+        if format is None:
+            format = 'bytes'
+
+        if format not in StemImage.ALLOWED_FORMATS:
+            raise RestException('Unknown format: ' + format)
+
+        if reduction not in analysis.REDUCTIONS:
+            raise RestException('Unknown reduction: ' + reduction)
+
+        path = self._get_path_to_type(type)
+        info = self._get_type_metadata(id, user, type)
+        if info['frameShape'] is None:
+            raise RestException('Detector dimensions not found!', 404)
+
+        num_positions = self._get_num_scan_positions(info)
+
+        if positions is not None:
+            positions = np.unique(np.asarray(positions, dtype=np.int64))
+            if len(positions) > 0 and (positions[0] < 0 or
+                                       positions[-1] >= num_positions):
+                raise RestException('Scan positions must be between 0 and ' +
+                                    str(num_positions - 1))
+        elif None not in (x, y, width, height):
+            if info['scanShape'] is None:
+                raise RestException('Scan dimensions not found!', 404)
+            positions = analysis.rectangle_positions(info['scanShape'], x, y,
+                                                     width, height)
+        else:
+            raise RestException('Either positions or x, y, width and height '
+                                'must be set')
+
+        region = self._get_detector_roi(info, type, bin, roi)
+
+        def respond():
+            rows = self._get_frame_rows(id, user, type, positions)
+            with self._open_h5py_file(id, user) as rf:
+                result = analysis.reduce_frames(rf[path], rows, reduction,
+                                                info['frameShape'],
+                                                sparse=type == 'electron')
+
+            if region is not None:
+                result = analysis.bin_dense(result, region, bin or 1)
+
+            setResponseHeader('Content-Type', 'application/octet-stream')
+
+            def _stream():
+                for arrays in self._get_vlen_dataset_in_chunks(result):
+                    yield self._encode_arrays(arrays, format)
+
+            return _stream
+
+        params = {
+            'type': type,
+            'reduction': reduction,
+            'positions': positions.tolist(),
+            'format': format,
+            'bin': bin,
+            'roi': roi
+        }
+        return self._cached_response(id, user, 'reduce_frames', params,
+                                     respond)
+
+    def _check_format(self, format, type, allowed):
+        """Check a frame format, the sparse formats are always allowed for
+        electron events"""
+        if format in StemImage.SPARSE_FORMATS:
+            if type != 'electron':
+                raise RestException(format + ' is only available for '
+                                    'electron events')
+        elif format not in allowed:
+            raise RestException('Unknown format: ' + format)
+
+    def _get_detector_roi(self, info, type, bin=None, roi=None):
+        """Validate the detector roi and binning of a frame request.
+
+        Returns `None` if the frames are requested as they are, or the
+        (x, y, width, height) region otherwise.
+        """
+        if (bin is None or bin == 1) and roi is None:
+            return None
+
+        if info['frameShape'] is None:
+            raise RestException('Detector dimensions not found!', 404)
+
+        # The frameShape of raw frames is the shape of the dataset, which
+        # is (Ny, Nx)
+        frame_shape = info['frameShape']
+        if type == 'raw':
+            frame_shape = frame_shape[::-1]
+
+        try:
+            return analysis.detector_roi(frame_shape, roi, bin or 1)
+        except ValueError as e:
+            raise RestException(str(e))
+
+    def _get_frame_transform(self, id, user, type, bin=None, roi=None):
+        """Get a function cropping and binning blocks of frames.
+
+        Dense frames are binned by summing bin x bin blocks of pixels.
+        Electron events are filtered to the roi and re-indexed to the
+        binned detector, of (width // bin, height // bin).
+
+        Returns `None` if the frames are requested as they are.
+        """
+        info = self._get_type_metadata(id, user, type)
+        region = self._get_detector_roi(info, type, bin, roi)
+        if region is None:
+            return None
+
+        bin = bin or 1
+        if type == 'electron':
+            return lambda block: analysis.bin_events(
+                block, info['frameShape'], region, bin)
+
+        return lambda block: analysis.bin_dense(block, region, bin)
+
+    def _get_frame_rows(self, id, user, type, positions):
+        """Get the sorted frame rows of a sorted array of scan positions.
+
+        Electron datasets can have several frames per scan position (or
+        none), raw datasets have one frame per scan position.
+        """
+        index = self._get_scan_index(id, user, type)
+        if index is None:
+            return positions
+
+        return np.sort(analysis.index_rows(index[0], index[1], positions))
+
+    def _get_num_scan_positions(self, info):
+        """Get the number of scan positions from the metadata of a type"""
+        if info['scanShape'] is not None:
+            return info['scanShape'][0] * info['scanShape'][1]
+        elif 'scanIndex' in info:
+            return info['scanIndex']['positions']
+        return info['frames']
+
+    def _get_scan_index(self, id, user, type):
+        """Get the CSR index from scan positions to frame rows.
+
+        The index is built once per file version (see
+        `analysis.scan_position_index`) and cached on disk and in memory.
+
+        Returns: an (offsets, rows) tuple, or `None` if frame i is scan
+                 position i (always the case for raw frames)
+        """
+        if type != 'electron':
+            return None
+
+        info = self._get_type_metadata(id, user, type)
+        summary = info.get('scanIndex')
+        if summary is not None and summary['identity']:
+            return None
+
+        key = self._cache_key(id, user, 'scan_index', {})
+        index = index_cache.get(key)
+        if index is not None:
+            return index
+
+        arrays = disk_cache.get_arrays(key)
+        if arrays is not None:
+            index = (arrays['offsets'], arrays['rows'])
+        else:
+            with self._open_h5py_file(id, user) as rf:
+                scan_positions = self._get_electron_scan_positions(rf)
+            num_positions = None
+            if info['scanShape'] is not None:
+                num_positions = info['scanShape'][0] * info['scanShape'][1]
+            index = analysis.scan_position_index(scan_positions,
+                                                 num_positions)
+            disk_cache.set_arrays(key, offsets=index[0], rows=index[1])
+
+        index_cache.set(key, index)
+        return index
+
+    def scan_index(self, id, user, type):
+        """Get the scan position index, as a msgpack map.
+
+        The map holds the number of `positions` and `frames`, and whether
+        frame i is scan position i (`identity`). Otherwise it also holds
+        `offsets` and `rows` as little-endian uint32 (`dtype`) buffers: the
+        frames of scan position p are rows[offsets[p]:offsets[p + 1]].
+        """
+        self._get_path_to_type(type)
+        info = self._get_type_metadata(id, user, type)
+
+        def respond():
+            index = self._get_scan_index(id, user, type)
+            message = {
+                'positions': self._get_num_scan_positions(info),
+                'frames': info['frames'],
+                'identity': index is None
+            }
+            if index is not None:
+                dtype = '<u4' if info['frames'] < 1 << 32 else '<u8'
+                message.update({
+                    'dtype': dtype,
+                    'offsets': index[0].astype(dtype).tobytes(),
+                    'rows': index[1].astype(dtype).tobytes()
+                })
+
+            setResponseHeader('Content-Type', 'application/octet-stream')
+
+            def _stream():
+                yield msgpack.packb(message, use_bin_type=True)
 
             return _stream
 
-        raise RestException('In scan_positions, unknown type: ' + type)
+        return self._cached_response(id, user, 'scan_index', {'type': type},
+                                     respond)
+
+    def _get_electron_scan_positions(self, rf):
+        """Get the scan position of each electron frame"""
+        path = '/electron_events/scan_positions'
+        if path in rf:
+            return rf[path][()].astype(np.int64)
+        return np.arange(rf['/electron_events/frames'].shape[0])
+
+    def _cache_key(self, id, user, kind, params):
+        """Get a key identifying a derived result of the stem image file.
+
+        The key changes when the file changes, so stale entries are
+        never returned.
+        """
+        _, girder_file, _ = self._load_for_reading(id, user)
+        version, _ = self._file_version(id, user)
+
+        return json.dumps([kind, str(girder_file['_id']), version, params],
+                          sort_keys=True)
+
+    def _file_version(self, id, user):
+        """Get the version of the stem image file and when it was modified.
+
+        Returns: a tuple of a JSON serializable version, and the
+                 modification time as a POSIX timestamp
+        """
+        _, girder_file, path = self._load_for_reading(id, user)
+        if path is not None:
+            stat = os.stat(path)
+            return [stat.st_mtime_ns, stat.st_size], stat.st_mtime
+
+        updated = girder_file.get('updated') or girder_file.get('created')
+        if updated is None:
+            modified = 0
+        else:
+            modified = updated.replace(
+                tzinfo=datetime.timezone.utc).timestamp()
+
+        return [str(updated), girder_file['size']], modified
+
+    def _cached_response(self, id, user, kind, params, respond):
+        """Send a deterministic response of the stem image file.
+
+        The response is sent with an ETag derived from the file id, its
+        version and `params`, and with Last-Modified and Cache-Control
+        headers. Conditional requests matching them get a 304 without
+        touching the file.
+
+        If the response cache is enabled, responses up to
+        `MAX_CACHED_RESPONSE_SIZE` bytes are stored on disk and served
+        from there on later requests.
+
+        Args:
+            kind: The kind of response, e.g. the name of the endpoint
+            params: The parameters that the response depends on
+            respond: A function returning the streaming response, called
+                     only if the response is not cached
+
+        Returns: a generator function streaming the response
+        """
+        key = self._cache_key(id, user, kind, params)
+        etag = '"' + hashlib.sha1(key.encode('utf8')).hexdigest() + '"'
+        _, modified = self._file_version(id, user)
+        stem_image, _, _ = self._load_for_reading(id, user)
+
+        # Replace the no-cache headers set for every endpoint by girder
+        cherrypy.response.headers.pop('Pragma', None)
+        cherrypy.response.headers.pop('Expires', None)
+        visibility = 'public' if stem_image.get('public') else 'private'
+        setResponseHeader('Cache-Control',
+                          visibility + ', max-age=' + str(CACHE_MAX_AGE))
+        setResponseHeader('ETag', etag)
+        setResponseHeader('Last-Modified', httputil.HTTPDate(int(modified)))
+
+        if self._is_not_modified(etag, modified):
+            cherrypy.response.status = 304
+            return lambda: iter(())
+
+        if response_cache is not None:
+            data = response_cache.get_bytes(key)
+            if data is not None:
+                setResponseHeader('Content-Type', 'application/octet-stream')
+
+                def _cached():
+                    for i in range(0, len(data), 64000):
+                        yield data[i:i + 64000]
+
+                return _cached
+
+        stream = respond()
+        if response_cache is None:
+            return stream
+
+        def _stream():
+            chunks = []
+            size = 0
+            for chunk in stream():
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > MAX_CACHED_RESPONSE_SIZE:
+                        chunks = None
+                    else:
+                        chunks.append(chunk)
+                yield chunk
+
+            if chunks is not None:
+                response_cache.set_bytes(key, b''.join(chunks))
+
+        return _stream
+
+    def _is_not_modified(self, etag, modified):
+        """Check the conditional headers of the request"""
+        headers = cherrypy.request.headers
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            # Weak validators are equivalent for a GET
+            tags = [t[2:] if t.startswith('W/') else t for t in tags]
+            return etag in tags or '*' in tags
+
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates are in UTC, a date without a zone (e.g. -0000)
+            # must not be taken as local time
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            modified = datetime.datetime.fromtimestamp(
+                int(modified), datetime.timezone.utc)
+            return modified <= since
+
+        return False
 
     def file_path(self, id, user):
-        stem_image = self.load(id, user=user, level=AccessType.READ)
-        file = FileModel().load(stem_image['fileId'], user=user, level=AccessType.READ)
-        assetstore = AssetstoreModel().load(file['assetstoreId'])
-        if assetstore['type'] is not AssetstoreType.FILESYSTEM:
+        _, _, path = self._load_for_reading(id, user)
+        if path is None:
             raise RestException('The file assetstore is not a file system!')
-        path = os.path.join(assetstore['root'], file['path'])
         return {'path': path}
 
+    def _get_local_path(self, file):
+        """Get the path of a file on the local file system.
+
+        Returns `None` if the file is not stored in a filesystem
+        assetstore.
+        """
+        assetstore = AssetstoreModel().load(file['assetstoreId'])
+        if assetstore['type'] != AssetstoreType.FILESYSTEM:
+            return None
+        return os.path.join(assetstore['root'], file['path'])
+
     def _get_import_folder(self, user, public=False):
         """Get the folder where files will be imported.
 
@@ -338,12 +1471,91 @@ class StemImage(AccessControlledModel):
 
         return _stream
 
+    def _get_h5_dataset_msgpack_typed(self, id, user, path, offset=None,
+                                      limit=None):
+        """Get a dataset packed with msgpack as typed binary arrays.
+
+        Each chunk is a map holding the raw bytes of the arrays together
+        with their dtype and shape (see `encoding.packb_typed`). Chunks of
+        vlen datasets are sent as a flat buffer plus offsets (see
+        `encoding.packb_typed_sparse`).
+
+        Args:
+            id: The id of the stem image
+            user: The user accessing the stem image
+            path: a path in the h5 file to a dataset
+
+        Returns: a dataset packed with msgpack
+        """
+        setResponseHeader('Content-Type', 'application/octet-stream')
+
+        def _stream():
+            nonlocal id
+            nonlocal user
+            with self._open_h5py_file(id, user) as rf:
+                dataset = rf[path]
+                if dataset.dtype.kind == 'O':
+                    for arrays in self._get_vlen_dataset_in_chunks(
+                            dataset, limit, offset):
+                        yield encoding.packb_typed_sparse(arrays)
+                else:
+                    for array in self._get_dataset_in_chunks(dataset, offset,
+                                                             limit):
+                        yield encoding.packb_typed(array)
+
+        return _stream
+
+    def _encode_chunk(self, array, format):
+        """Encode an array, one chunk of a dense dataset, in `format`"""
+        if format == 'bytes':
+            return array.tobytes()
+        elif format == 'msgpack':
+            if array.ndim == 1:
+                return encoding.packb_array(array)
+            return msgpack.packb(array.tolist(), use_bin_type=True)
+        elif format == 'msgpack-typed':
+            return encoding.packb_typed(array)
+
+        raise RestException('Unknown format: ' + format)
+
+    def _encode_frame(self, frame, format, sparse=False):
+        """Encode a single frame, given as a list (or a block) of one array.
+
+        Electron event frames are sent like the chunks of their dataset,
+        so that the typed formats carry the offsets.
+        """
+        if sparse and (format == 'msgpack-typed' or
+                       format in StemImage.SPARSE_FORMATS):
+            return self._encode_arrays(frame, format, sparse=True)
+
+        return self._encode_chunk(frame[0], format)
+
+    def _encode_arrays(self, arrays, format, sparse=False):
+        """Encode a list of arrays, one chunk of a stream, in `format`"""
+        if format == 'bytes':
+            return b''.join(a.tobytes() for a in arrays)
+        elif format == 'msgpack':
+            return encoding.packb_arrays(arrays)
+        elif format == 'msgpack-typed':
+            if sparse:
+                return encoding.packb_typed_sparse(arrays)
+            elif len(arrays) == 0:
+                return encoding.packb_typed(np.empty(0))
+            return encoding.packb_typed(np.stack(arrays))
+        elif format in StemImage.SPARSE_FORMATS:
+            return encoding.packb_delta_sparse(
+                arrays, StemImage.SPARSE_FORMATS[format])
+
+        raise RestException('Unknown format: ' + format)
+
     def _get_vlen_dataset_in_chunks(self, dataset, limit=1e6, offset=0,
-                                    max_chunk_size=64000):
-        """A generator to yield lists of lists of a vlen dataset.
+                                    max_chunk_size=64000, transform=None):
+        """A generator to yield lists of arrays of a vlen dataset.
 
         A vlen dataset is a dataset whose elements are variable length
-        arrays.
+        arrays. The dataset is read in blocks of contiguous elements
+        (see `_iter_blocks`), and the lists are split exactly as if the
+        elements had been read one at a time.
 
         This will also work if `dataset` is a numpy array.
 
@@ -356,30 +1568,70 @@ class StemImage(AccessControlledModel):
                             to send. Note that it will always send at
                             least one array, even if the size exceeds
                             the max.
-        Yields: Arrays of the dataset
+            transform: A function applied to each block read, e.g. to
+                       bin the frames
+        Yields: Lists of numpy arrays of the dataset
         """
 
-        num_arrays = min(limit, dataset.shape[0])
+        if offset is None:
+            offset = 0
+        if limit is None:
+            limit = dataset.shape[0]
+        num_arrays = int(min(limit, dataset.shape[0] - offset))
 
         current_size = 0
         data = []
-        for i in range(num_arrays):
-            array = dataset[offset + i]
-            array_size = array.size * array.dtype.itemsize
-            if len(data) != 0:
-                if current_size + array_size > max_chunk_size:
-                    yield data
-                    data.clear()
-                    current_size = 0
-
-            data.append(array.tolist())
-            current_size += array_size
+        for block in self._iter_blocks(dataset, offset, offset + num_arrays,
+                                       max_block_size=max_chunk_size):
+            if transform is not None:
+                block = transform(block)
+            for array in block:
+                array_size = array.size * array.dtype.itemsize
+                if len(data) != 0:
+                    if current_size + array_size > max_chunk_size:
+                        yield data
+                        data = []
+                        current_size = 0
+
+                data.append(array)
+                current_size += array_size
 
         yield data
 
+    def _iter_blocks(self, dataset, start, stop, min_block_size=1024,
+                     max_block_size=64000):
+        """A generator to read a dataset in blocks along its first axis.
+
+        Blocks are aligned to the HDF5 chunks of the dataset (if it is
+        chunked), so that each block is a single read of whole chunks.
+        Blocks of vlen elements contain at least `min_block_size` elements.
+        Blocks of fixed size elements, e.g. raw frames, hold at most
+        `max_block_size` bytes, or a single HDF5 chunk if it is larger.
+        """
+        chunks = getattr(dataset, 'chunks', None)
+        step = chunks[0] if chunks else 1
+        if dataset.dtype.kind == 'O':
+            block_size = step * -(-min_block_size // step)
+        else:
+            element_size = (int(np.prod(dataset.shape[1:])) *
+                            dataset.dtype.itemsize)
+            rows = max_block_size // max(1, element_size)
+            block_size = step * max(1, rows // step)
+
+        while start < stop:
+            end = min(stop, (start // block_size + 1) * block_size)
+            yield dataset[start:end]
+            start = end
+
     def _get_dataset_in_chunks(self, dataset, offset=None, limit=1e6, max_chunk_size=64000):
         """A generator to yield numpy arrays of the dataset.
 
+        For datasets of fixed size elements the chunks are planned from
+        the shape and dtype alone, aligned to the HDF5 chunk layout when
+        there is one, and read with `read_direct` into a buffer that is
+        reused for every chunk. The yielded arrays are therefore only
+        valid until the next iteration.
+
         Args:
             dataset: An h5py dataset
             limit: Limit the number of arrays to be obtained
@@ -391,46 +1643,41 @@ class StemImage(AccessControlledModel):
                             the max.
         Yields: Arrays of the dataset
         """
-        num_arrays = min(limit, dataset.shape[0])
-
-        current_size = 0
-        start = 0
-
-        def is_ref_type(dataset):
-            return dataset.dtype.kind == 'O'
-
-        def get_chunk_shape(start, stop, dataset):
-            if stop - start == 1:
-                # If the one dataset is a reference, follow the reference to get the shape
-                if is_ref_type(dataset):
-                    return dataset[start].shape
-                else:
-                    return dataset.shape[1:]
-            else:
-                return (stop - start,) + dataset.shape[1:]
-
-        def get_chunk_data(start, stop, dataset):
-            if stop - start == 1 and is_ref_type(dataset):
-                return dataset[start]
-
-            shape = get_chunk_shape(start, stop, dataset)
-            dtype = dataset.dtype
-            array = np.empty(shape, dtype=dtype)
-            dataset.read_direct(array, source_sel=np.s_[start:stop])
-            return array
-
-        for i in range(num_arrays):
-            array_size = dataset[offset + i].size * dataset.dtype.itemsize
-            if current_size != 0:
-                if current_size + array_size > max_chunk_size:
-                    yield get_chunk_data(offset + start, offset + i, dataset)
-                    current_size = 0
-                    start = i
-
-            current_size += array_size
-
-        stop = num_arrays
-        yield get_chunk_data(offset + start, offset + stop, dataset)
+        if offset is None:
+            offset = 0
+        if limit is None:
+            limit = dataset.shape[0]
+        stop = offset + max(0, int(min(limit, dataset.shape[0] - offset)))
+
+        if dataset.dtype.kind == 'O':
+            # The sizes of vlen elements are only known once they are read
+            for arrays in self._get_vlen_dataset_in_chunks(
+                    dataset, stop - offset, offset, max_chunk_size):
+                if len(arrays) == 1:
+                    yield arrays[0]
+                elif len(arrays) > 1:
+                    yield np.concatenate(arrays)
+            return
+
+        element_shape = dataset.shape[1:]
+        element_size = int(np.prod(element_shape)) * dataset.dtype.itemsize
+        rows = max(1, max_chunk_size // max(1, element_size))
+
+        # Read whole HDF5 chunks where they fit
+        chunks = getattr(dataset, 'chunks', None)
+        if chunks and rows > chunks[0]:
+            rows -= rows % chunks[0]
+
+        buffer = np.empty((min(rows, stop - offset),) + element_shape,
+                          dtype=dataset.dtype)
+        start = offset
+        while start < stop:
+            end = min(stop, (start // rows + 1) * rows)
+            array = buffer[:end - start]
+            dataset.read_direct(array, source_sel=np.s_[start:end])
+            # A single element is sent with its own shape
+            yield array[0] if end - start == 1 else array
+            start = end
 
     def _get_path_to_type(self, type):
         """Get the path to the dataset for the given type"""
@@ -440,8 +1687,8 @@ class StemImage(AccessControlledModel):
             return '/frames'
         raise RestException('Unknown type: ' + type)
 
-    def _check_limit_and_offset(self, dataset, limit, offset):
-        """Check that the limit and offset are reasonable
+    def _check_limit_and_offset(self, size, limit, offset):
+        """Check that the limit and offset are reasonable for `size` frames
 
         This function does sanity checks and raises an exception if
         an issue is found.
@@ -451,7 +1698,7 @@ class StemImage(AccessControlledModel):
         """
 
         if limit is None:
-            limit = dataset.shape[0]
+            limit = size
 
         if offset is None:
             offset = 0
@@ -459,9 +1706,9 @@ class StemImage(AccessControlledModel):
         if int(offset) < 0:
             raise RestException('Offset cannot be less than zero')
 
-        if int(offset) >= dataset.shape[0]:
+        if int(offset) >= size:
             msg = ('Offset is out of bounds (cannot be ' +
-                   str(dataset.shape[0]) + ' or greater)')
+                   str(size) + ' or greater)')
             raise RestException(msg)
 
         if int(limit) <= 0:
@@ -469,17 +1716,22 @@ class StemImage(AccessControlledModel):
 
         return int(limit), int(offset)
 
-    def _get_image_index_from_name(self, dataset, name):
-        """Get the index of an image from a name.
+    def _get_image_index(self, images, name):
+        """Get the index of an image from a name or an index.
 
-        This assumes that dataset.shape[0] is the index for the images,
-        and that the dataset has a `names` attribute that contains the
-        names of the images.
+        `images` is the images metadata (see `_scan_metadata`). If the
+        name is an integer, it is assumed to be an index.
         """
+        if self._str_is_int(name):
+            index = int(name)
+            if index >= images['count']:
+                raise RestException('Index is too large')
+            return index
+
         try:
-            return dataset.attrs['names'].tolist().index(name)
+            return images['names'].index(name)
         except ValueError:
-            raise RestException(name + ' is not in ' + dataset.name)
+            raise RestException(name + ' is not in /stem/images')
 
     def _str_is_int(self, s):
         """A simple function to check if a string is an int"""
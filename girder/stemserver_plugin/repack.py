@@ -0,0 +1,248 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import os
+import time
+
+import h5py
+import numpy as np
+
+# The datasets that are rewritten, the rest of the file is copied as is
+FRAME_DATASETS = ['/electron_events/frames', '/electron_events/scan_positions',
+                  '/frames', '/scan_positions']
+
+COMPRESSIONS = ['lzf', 'gzip', None]
+
+# The target size of a chunk of dense frames, in bytes. Small enough that
+# reading a single frame does not decompress too much, and that a few
+# chunks fit in the chunk cache of the pooled handles of the plugin.
+CHUNK_BYTES = 256 * 1024
+
+# The number of frames per chunk of electron event frames
+EVENT_CHUNK_FRAMES = 1024
+
+_executor = None
+
+
+def get_executor():
+    """Get the process pool that repacks files.
+
+    It is separate from the pool of the derived products, so that a
+    repack does not queue behind them. The processes are spawned rather
+    than forked, since the server process holds threads and database
+    connections.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _chunk_rows(dataset, scan_nx=None):
+    """Get the number of rows (frames) per chunk of a dataset.
+
+    Frames are read in scan order, a scan row at a time by the worker and
+    a frame at a time by the plugin. Chunks hold a whole number of frames,
+    around `CHUNK_BYTES` for dense frames, aligned to scan rows when they
+    fit.
+    """
+    if dataset.dtype.kind == 'O':
+        rows = EVENT_CHUNK_FRAMES
+    else:
+        frame_size = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+        rows = max(1, CHUNK_BYTES // max(1, frame_size))
+
+    if scan_nx and rows > scan_nx:
+        rows -= rows % scan_nx
+
+    return max(1, min(rows, dataset.shape[0]))
+
+
+def _hash_block(checksum, block):
+    if block.dtype.kind == 'O':
+        for array in block:
+            checksum.update(len(array).to_bytes(8, 'little'))
+            checksum.update(np.ascontiguousarray(array).tobytes())
+    else:
+        checksum.update(np.ascontiguousarray(block).tobytes())
+
+
+def dataset_checksum(dataset, block_rows=None):
+    """Get the sha256 of the content of a dataset, read in blocks"""
+    checksum = hashlib.sha256()
+    if block_rows is None:
+        block_rows = _chunk_rows(dataset)
+    for start in range(0, dataset.shape[0], block_rows):
+        _hash_block(checksum, dataset[start:start + block_rows])
+    return checksum.hexdigest()
+
+
+def _copy_attrs(source, destination):
+    for name, value in source.attrs.items():
+        destination.attrs[name] = value
+
+
+def _repack_dataset(source, destination, path, compression, scan_nx):
+    """Stream a dataset into a chunked (and compressed) copy.
+
+    Returns: the sha256 of the content, computed while copying
+    """
+    dataset = source[path]
+    rows = _chunk_rows(dataset, scan_nx)
+    kwargs = {}
+    # Filters only apply to the heap references of vlen data, so the
+    # events themselves can't be compressed by HDF5.
+    if compression is not None and dataset.dtype.kind != 'O':
+        kwargs['compression'] = compression
+        if compression == 'gzip':
+            kwargs['compression_opts'] = 1
+        kwargs['shuffle'] = dataset.dtype.itemsize > 1
+
+    copy = destination.create_dataset(
+        path, shape=dataset.shape, dtype=dataset.dtype,
+        chunks=(rows,) + dataset.shape[1:], **kwargs)
+    _copy_attrs(dataset, copy)
+
+    # Copy whole chunks at a time, up to about 16 MiB of dense frames
+    checksum = hashlib.sha256()
+    if dataset.dtype.kind == 'O':
+        block_rows = rows * 16
+    else:
+        chunk_size = rows * int(np.prod(dataset.shape[1:])) * \
+            dataset.dtype.itemsize
+        block_rows = rows * max(1, 16 * 1024 ** 2 // max(1, chunk_size))
+
+    for start in range(0, dataset.shape[0], block_rows):
+        block = dataset[start:start + block_rows]
+        copy[start:start + len(block)] = block
+        _hash_block(checksum, block)
+
+    return checksum.hexdigest(), rows
+
+
+def _read_speed(path, datasets, samples=256, seed=0):
+    """Time per frame and scan row reads of datasets of a file.
+
+    Frames are read one at a time in scan order (like a viewer following
+    the scan), and a scan row at a time at random rows (like the worker).
+
+    Returns: a dict of {path: {'frame': seconds per frame, 'row': seconds
+             per frame when reading a scan row at a time}}
+    """
+    rng = np.random.default_rng(seed)
+    speeds = {}
+    with h5py.File(path, 'r', rdcc_nbytes=4 * 1024 ** 2) as f:
+        for name, scan_nx in datasets:
+            dataset = f[name]
+            n = dataset.shape[0]
+            first = int(rng.integers(0, max(1, n - samples + 1)))
+            indices = range(first, min(n, first + samples))
+
+            start = time.perf_counter()
+            for i in indices:
+                dataset[i]
+            per_frame = (time.perf_counter() - start) / max(1, len(indices))
+
+            row = scan_nx or 64
+            starts = rng.integers(0, max(1, n - row + 1),
+                                  max(1, min(16, n // row)))
+            start = time.perf_counter()
+            for s in starts:
+                dataset[s:s + row]
+            per_row = ((time.perf_counter() - start) /
+                       max(1, len(starts) * min(row, n)))
+
+            speeds[name] = {'frame': per_frame, 'row': per_row}
+
+    return speeds
+
+
+def repack(path, output_path, compression='lzf'):
+    """Rewrite the frames of a STEM file with chunking tuned for scan order.
+
+    The frame datasets (`FRAME_DATASETS`) are streamed into chunked,
+    compressed copies and everything else is copied as is. The content of
+    the copies is checked against the original with checksums, and the
+    read speed of both files is measured.
+
+    Returns: a report of the form:
+
+    {
+        'compression': 'lzf',
+        'datasets': {'/frames': {'chunks': [32, 128, 128],
+                                 'sha256': '...'}},
+        'readSpeed': {'/frames': {'frame': 0.0001, 'row': 0.00002,
+                                  'originalFrame': 0.001,
+                                  'originalRow': 0.0001}},
+        'size': 123, 'originalSize': 456,
+        'duration': 12.0
+    }
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: ' + str(compression))
+
+    began = time.perf_counter()
+    report = {'compression': compression, 'datasets': {}}
+    speed_datasets = []
+
+    tmp_path = output_path + '.tmp'
+    try:
+        with h5py.File(path, 'r') as source, h5py.File(tmp_path, 'w') as out:
+            _copy_attrs(source, out)
+            repacked = [p for p in FRAME_DATASETS if p in source]
+
+            def copy_others(name, obj):
+                path = '/' + name
+                if path in repacked:
+                    return
+                if isinstance(obj, h5py.Group):
+                    _copy_attrs(obj, out.require_group(path))
+                else:
+                    source.copy(obj, out, name=path)
+
+            source.visititems(copy_others)
+
+            for dataset_path in repacked:
+                group = dataset_path.rsplit('/', 1)[0]
+                scans = source.get(group + '/scan_positions')
+                scan_nx = None
+                if scans is not None and 'Nx' in scans.attrs:
+                    scan_nx = int(scans.attrs['Nx'])
+
+                checksum, rows = _repack_dataset(source, out, dataset_path,
+                                                 compression, scan_nx)
+                report['datasets'][dataset_path] = {
+                    'chunks': list(out[dataset_path].chunks),
+                    'sha256': checksum
+                }
+                if dataset_path.endswith('frames'):
+                    speed_datasets.append((dataset_path, scan_nx))
+
+        # Verify the copies from disk
+        with h5py.File(tmp_path, 'r') as f:
+            for dataset_path, info in report['datasets'].items():
+                if dataset_checksum(f[dataset_path]) != info['sha256']:
+                    raise Exception('Checksum mismatch after repacking ' +
+                                    dataset_path)
+
+        original = _read_speed(path, speed_datasets)
+        repacked_speed = _read_speed(tmp_path, speed_datasets)
+        report['readSpeed'] = {}
+        for name, speed in repacked_speed.items():
+            report['readSpeed'][name] = dict(speed, **{
+                'originalFrame': original[name]['frame'],
+                'originalRow': original[name]['row']
+            })
+
+        os.replace(tmp_path, output_path)
+    finally:
+        # Don't leave a partial copy behind when repacking fails
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    report['size'] = os.path.getsize(output_path)
+    report['originalSize'] = os.path.getsize(path)
+    report['duration'] = time.perf_counter() - began
+
+    return report
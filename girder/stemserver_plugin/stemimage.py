@@ -23,11 +23,20 @@ class StemImage(Resource):
         self.route('GET', (':id', 'frames', 'types'), self.frames_types)
         self.route('GET', (':id', 'frames', ':scanPosition'), self.frame)
         self.route('GET', (':id', 'frames'), self.all_frames)
+        self.route('POST', (':id', 'frames'), self.frames)
         self.route('GET', (':id', 'frames', 'shape'), self.frame_shape)
+        self.route('GET', (':id', 'frames', 'reduce'), self.reduce_frames)
         self.route('GET', (':id', 'scanPositions'), self.scan_positions)
+        self.route('GET', (':id', 'scanPositions', 'index'), self.scan_index)
+        self.route('GET', (':id', 'analysis', 'virtual_detector'),
+                   self.virtual_detector)
+        self.route('GET', (':id', 'derived', 'status'), self.derived_status)
+        self.route('GET', (':id', 'derived', 'products', ':name'),
+                   self.derived_product)
         self.route('POST', (), self.create)
         self.route('DELETE', (':id',), self.delete)
         self.route('GET', (':id', 'path'), self.file_path)
+        self.route('PUT', (':id', 'rescan'), self.rescan)
 
         self._model = StemImageModel()
 
@@ -40,10 +49,20 @@ class StemImage(Resource):
     @access.public
     @autoDescribeRoute(
         Description('Get stem images')
+        .param('fields',
+               'A comma separated list of the fields to return, for example '
+               'fileId,metadata.types. By default all fields are returned.',
+               required=False)
+        .pagingParams(defaultSort='_id')
     )
-    def find(self, params):
+    def find(self, fields, limit, offset, sort):
         user = getCurrentUser()
-        results = self._model.findWithPermissions(user=user)
+        if fields is not None:
+            fields = ['_id'] + [x.strip() for x in fields.split(',')
+                                if x.strip()]
+        results = self._model.findWithPermissions(user=user, fields=fields,
+                                                  limit=limit, offset=offset,
+                                                  sort=sort)
         return [self._clean(x) for x in results]
 
     @access.public
@@ -80,24 +99,47 @@ class StemImage(Resource):
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
         Description('Get a stem image.')
+        .notes('Downsampled levels (each halving the image) are built on '
+               'the first request and cached on the server. The tile '
+               'parameters are in the coordinates of the level.')
         .param('id', 'The id of the stem image.')
         .param('name', 'The name or index of the stem image.')
         .param('format',
                'The format with which to send the data over http. '
-               'Currently either bytes (default) or msgpack.',
+               'Currently either bytes (default), msgpack or msgpack-typed.',
+               required=False)
+        .param('level', 'The pyramid level, 0 (default) is full resolution.',
+               dataType='integer', required=False)
+        .param('maxSize',
+               'Use the first level whose largest side is at most maxSize.',
+               dataType='integer', required=False)
+        .param('x', 'The column of the tile origin.', dataType='integer',
+               required=False)
+        .param('y', 'The row of the tile origin.', dataType='integer',
+               required=False)
+        .param('width', 'The width of the tile.', dataType='integer',
+               required=False)
+        .param('height', 'The height of the tile.', dataType='integer',
                required=False)
     )
-    def image(self, id, format, name):
-        return self._model.image(id, getCurrentUser(), format, name)
+    def image(self, id, format, name, level, maxSize, x, y, width, height):
+        return self._model.image(id, getCurrentUser(), format, name, level,
+                                 maxSize, x, y, width, height)
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
         Description('Get the shape of a stem image.')
         .param('id', 'The id of the stem image.')
         .param('name', 'The name or index of the stem image.')
+        .param('level', 'The pyramid level, 0 (default) is full resolution.',
+               dataType='integer', required=False)
+        .param('maxSize',
+               'Use the first level whose largest side is at most maxSize.',
+               dataType='integer', required=False)
     )
-    def image_shape(self, id, name):
-        return self._model.image_shape(id, getCurrentUser(), name)
+    def image_shape(self, id, name, level, maxSize):
+        return self._model.image_shape(id, getCurrentUser(), name, level,
+                                       maxSize)
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -109,16 +151,25 @@ class StemImage(Resource):
                default='electron')
         .param('format',
                'The format with which to send the data over http. '
-               'Currently either bytes (default) or msgpack',
+               'Currently either bytes (default), msgpack, msgpack-typed, '
+               'or for electron events msgpack-delta or msgpack-delta-zlib '
+               '(sorted, delta and varint encoded events, optionally zlib '
+               'compressed)',
                required=False)
+        .param('bin', 'Bin the detector by summing bin x bin pixels.',
+               dataType='integer', required=False)
+        .jsonParam('roi', 'The detector region of interest, as a JSON '
+                   '[x, y, width, height] list.', requireArray=True,
+                   required=False)
         .errorResponse('Scan position is out of bounds')
     )
-    def frame(self, id, scanPosition, type, format):
-        return self._model.frame(id, getCurrentUser(), int(scanPosition), type, format)
+    def frame(self, id, scanPosition, type, format, bin, roi):
+        return self._model.frame(id, getCurrentUser(), int(scanPosition), type,
+                                 format, bin, roi)
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
-        Description('Get all frames of an image (msgpack format only).')
+        Description('Get all frames of an image (msgpack formats only).')
         .param('id', 'The id of the stem image.')
         .param('type',
                'The type of data to use. Options: electron (default) or raw',
@@ -129,10 +180,44 @@ class StemImage(Resource):
         .param('offset',
                'Offset to use with the limit',
                required=False)
+        .param('format',
+               'The format with which to send the data over http. '
+               'Currently either msgpack (default), msgpack-typed, or for '
+               'electron events msgpack-delta or msgpack-delta-zlib',
+               required=False)
+        .param('bin', 'Bin the detector by summing bin x bin pixels.',
+               dataType='integer', required=False)
+        .jsonParam('roi', 'The detector region of interest, as a JSON '
+                   '[x, y, width, height] list.', requireArray=True,
+                   required=False)
     )
-    def all_frames(self, id, type, limit, offset):
+    def all_frames(self, id, type, limit, offset, format, bin, roi):
         return self._model.all_frames(id, getCurrentUser(), type, limit,
-                                      offset)
+                                      offset, format, bin, roi)
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the frames of a list of scan positions.')
+        .notes('The frames are read in sorted, merged runs and streamed in '
+               'chunks tagged with their positions.')
+        .param('id', 'The id of the stem image.')
+        .jsonParam('body',
+                   'Should contain `positions` (a list of scan positions) '
+                   'and/or `ranges` (a list of [start, stop] scan position '
+                   'ranges).', paramType='body', requireObject=True)
+        .param('type',
+               'The type of data to use. Options: electron (default) or raw',
+               default='electron')
+        .param('format',
+               'The format with which to send the data over http. '
+               'Currently either msgpack-typed (default) or msgpack',
+               required=False)
+        .errorResponse('Scan position is out of bounds')
+    )
+    def frames(self, id, body, type, format):
+        return self._model.frames(id, getCurrentUser(), type,
+                                  body.get('positions'), body.get('ranges'),
+                                  format)
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -145,6 +230,45 @@ class StemImage(Resource):
     def frame_shape(self, id, type):
         return self._model.frame_shape(id, getCurrentUser(), type)
 
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Reduce the frames of a region of the scan to one frame.')
+        .notes('Set either positions, or x, y, width and height. The result '
+               'is a detector sized array of float64. The mean and max are '
+               'over the frames of the positions, a position with several '
+               'frames counting each of them.')
+        .param('id', 'The id of the stem image.')
+        .param('type',
+               'The type of data to use. Options: electron (default) or raw',
+               default='electron')
+        .param('reduction', 'The reduction: sum (default), mean or max',
+               default='sum', enum=['sum', 'mean', 'max'])
+        .jsonParam('positions', 'A JSON list of scan positions.',
+                   requireArray=True, required=False)
+        .param('x', 'The scan x of the rectangle origin.', dataType='integer',
+               required=False)
+        .param('y', 'The scan y of the rectangle origin.', dataType='integer',
+               required=False)
+        .param('width', 'The width of the rectangle.', dataType='integer',
+               required=False)
+        .param('height', 'The height of the rectangle.', dataType='integer',
+               required=False)
+        .param('format',
+               'The format with which to send the data over http. '
+               'Currently either bytes (default), msgpack or msgpack-typed',
+               required=False)
+        .param('bin', 'Bin the detector by summing bin x bin pixels.',
+               dataType='integer', required=False)
+        .jsonParam('roi', 'The detector region of interest, as a JSON '
+                   '[x, y, width, height] list.', requireArray=True,
+                   required=False)
+    )
+    def reduce_frames(self, id, type, reduction, positions, x, y, width,
+                      height, format, bin, roi):
+        return self._model.reduce_frames(id, getCurrentUser(), type,
+                                         reduction, positions, x, y, width,
+                                         height, format, bin, roi)
+
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
         Description('Get the scan positions of an image.')
@@ -156,13 +280,87 @@ class StemImage(Resource):
     def scan_positions(self, id, type):
         return self._model.scan_positions(id, getCurrentUser(), type)
 
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the index from scan positions to frames.')
+        .notes('The response is a msgpack map. Unless `identity` is true '
+               '(frame i is scan position i), the frames of scan position '
+               'p are rows[offsets[p]:offsets[p + 1]].')
+        .param('id', 'The id of the stem image.')
+        .param('type',
+               'The type of data to use. Options: electron (default) or raw',
+               default='electron')
+    )
+    def scan_index(self, id, type):
+        return self._model.scan_index(id, getCurrentUser(), type)
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Compute an annular virtual detector image from the '
+                    'electron events.')
+        .notes('Pixels at a distance d from the center with '
+               'innerRadius <= d <= outerRadius are counted. Results are '
+               'cached on the server.')
+        .param('id', 'The id of the stem image.')
+        .param('centerX', 'The detector x of the center (-1 for the middle).',
+               dataType='integer', default=-1, required=False)
+        .param('centerY', 'The detector y of the center (-1 for the middle).',
+               dataType='integer', default=-1, required=False)
+        .param('innerRadius', 'The inner radius of the annulus.',
+               dataType='integer', default=0, required=False)
+        .param('outerRadius', 'The outer radius of the annulus.',
+               dataType='integer')
+        .param('format',
+               'The format with which to send the data over http. '
+               'Currently either bytes (default), msgpack or msgpack-typed',
+               required=False)
+    )
+    def virtual_detector(self, id, centerX, centerY, innerRadius, outerRadius,
+                         format):
+        return self._model.virtual_detector(id, getCurrentUser(), centerX,
+                                            centerY, innerRadius, outerRadius,
+                                            format)
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get the status of the derived products of a stem image.')
+        .notes('The derived products are computed in the background when '
+               'the stem image is created or rescanned.')
+        .param('id', 'The id of the stem image.')
+    )
+    def derived_status(self, id):
+        return self._model.derived_status(id, getCurrentUser())
+
+    @access.public(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description('Get a derived product of a stem image.')
+        .param('id', 'The id of the stem image.')
+        .param('name',
+               'The product: scan_counts (counts per scan position), '
+               'summed_diffraction (sum of all frames) or frame_counts '
+               '(counts per frame).')
+        .param('format',
+               'The format with which to send the data over http. '
+               'Currently either bytes (default), msgpack or msgpack-typed',
+               required=False)
+        .errorResponse('Derived products are not available.', 404)
+    )
+    def derived_product(self, id, name, format):
+        return self._model.derived_product(id, getCurrentUser(), name, format)
+
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
         Description('Create a stem image.')
         .jsonParam('body',
                    'Should contain either `fileId` (a valid girder fileId of '
                    'the image file) or `filePath` (a valid file path on the '
-                   'girder server to the image file (admin users only)).',
+                   'girder server to the image file (admin users only)). '
+                   'With a `filePath`, set `repack` to true to rewrite the '
+                   'frames with chunks tuned for scan order reads in the '
+                   'background, compressed with `compression` (lzf by '
+                   'default, gzip, or null for none). The stem image reads '
+                   'the repacked copy once the `status` of its `repack` '
+                   'field is complete.',
                    paramType='body')
         .errorResponse('Failed to create stem image')
     )
@@ -172,9 +370,23 @@ class StemImage(Resource):
         file_id = body.get('fileId')
         file_path = body.get('filePath')
         public = body.get('public', False)
+        repack_compression = False
+        if body.get('repack', False):
+            repack_compression = body.get('compression', 'lzf')
 
         return self._clean(self._model.create(user, file_id, file_path,
-                                              public))
+                                              public, repack_compression))
+
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Extract the metadata of the stem image file again.')
+        .notes('Use this when the HDF5 file changed after the stem image '
+               'was created.')
+        .param('id', 'The id of the stem image.')
+        .errorResponse('StemImage not found.', 404)
+    )
+    def rescan(self, id):
+        return self._clean(self._model.rescan(id, self.getCurrentUser()))
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
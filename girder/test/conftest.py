@@ -0,0 +1,131 @@
+from concurrent.futures import Future
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from pytest_girder.assertions import assertStatusOk
+from pytest_girder.utils import getResponseBody
+
+# The scan is (Nx, Ny) = (4, 3) and the detector (Nx, Ny) = (8, 6)
+SCAN_SHAPE = (4, 3)
+FRAME_SHAPE = (8, 6)
+NUM_POSITIONS = SCAN_SHAPE[0] * SCAN_SHAPE[1]
+
+
+def make_events(num_frames, seed=0):
+    """Get sorted uint32 event frames, some of them empty"""
+    rng = np.random.default_rng(seed)
+    num_pixels = FRAME_SHAPE[0] * FRAME_SHAPE[1]
+    frames = []
+    for count in rng.integers(0, 10, num_frames):
+        events = rng.choice(num_pixels, count, replace=False)
+        frames.append(np.sort(events).astype(np.uint32))
+    return frames
+
+
+def write_electron_file(path, scan_positions, seed=0):
+    """Write an electron counted dataset, frame i being at scan position
+    `scan_positions[i]`"""
+    frames = make_events(len(scan_positions), seed)
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('electron_events')
+        dataset = group.create_dataset('frames', (len(frames),),
+                                       dtype=h5py.vlen_dtype(np.uint32))
+        for i, events in enumerate(frames):
+            dataset[i] = events
+        dataset.attrs['Nx'] = FRAME_SHAPE[0]
+        dataset.attrs['Ny'] = FRAME_SHAPE[1]
+
+        positions = group.create_dataset(
+            'scan_positions', data=np.asarray(scan_positions, dtype=np.uint32))
+        positions.attrs['Nx'] = SCAN_SHAPE[0]
+        positions.attrs['Ny'] = SCAN_SHAPE[1]
+
+    return str(path)
+
+
+class ManualExecutor(object):
+    """Runs the submitted jobs when the test asks for it"""
+
+    def __init__(self):
+        self.jobs = []
+        self.completed = []
+
+    def submit(self, function, *args):
+        future = Future()
+        self.jobs.append((future, function, args))
+        return future
+
+    def run(self):
+        for future, function, args in self.jobs:
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+        self.completed += self.jobs
+        self.jobs = []
+
+
+@pytest.fixture
+def electron_file(tmp_path):
+    """One frame per scan position"""
+    return write_electron_file(tmp_path / 'electron.h5',
+                               np.arange(NUM_POSITIONS))
+
+
+@pytest.fixture
+def multi_frame_electron_file(tmp_path):
+    """Several frames for some scan positions, none for position 3"""
+    positions = [0, 0, 1, 2, 2, 2, 4, 5, 6, 7, 8, 9, 10, 11, 11]
+    return write_electron_file(tmp_path / 'multi.h5', positions, seed=1)
+
+
+@pytest.fixture
+def raw_file(tmp_path):
+    """Dense frames of (Ny, Nx) of the detector, and two stem images"""
+    rng = np.random.default_rng(2)
+    path = tmp_path / 'raw.h5'
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('frames', data=rng.integers(
+            0, 1024, (NUM_POSITIONS, FRAME_SHAPE[1], FRAME_SHAPE[0]),
+            dtype=np.uint16))
+        f.create_dataset('scan_positions',
+                         data=np.arange(NUM_POSITIONS, dtype=np.uint32))
+        images = f.create_group('stem').create_dataset(
+            'images', data=rng.random((2, SCAN_SHAPE[1], SCAN_SHAPE[0])))
+        images.attrs['names'] = np.array(['bright', 'dark'],
+                                         dtype=h5py.string_dtype())
+
+    return str(path)
+
+
+@pytest.fixture
+def stem_image(server, admin, fsAssetstore):
+    """Create a stem image of a file path"""
+    def create(path, **body):
+        body['filePath'] = path
+        resp = server.request('/stem_images', method='POST', user=admin,
+                              body=json.dumps(body), type='application/json')
+        assertStatusOk(resp)
+        return resp.json
+
+    return create
+
+
+@pytest.fixture
+def fetch(server, admin):
+    """GET a binary endpoint, its body is set as the `data` of the
+    response"""
+    def get(path, status=200, headers=None, **params):
+        params = {k: json.dumps(v) if isinstance(v, (list, dict)) else v
+                  for k, v in params.items() if v is not None}
+        resp = server.request(path, user=admin, params=params, isJson=False,
+                              additionalHeaders=headers)
+        resp.data = getResponseBody(resp, text=False)
+        assert resp.output_status.startswith(str(status).encode()), (
+            resp.output_status, resp.data)
+        return resp
+
+    return get
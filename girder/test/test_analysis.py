@@ -0,0 +1,92 @@
+import h5py
+import numpy as np
+import pytest
+
+from conftest import FRAME_SHAPE, NUM_POSITIONS
+from stemserver_plugin import analysis
+
+
+def test_annular_mask_includes_the_radii():
+    # The detector is (Nx, Ny), the mask is (Ny, Nx)
+    mask = analysis.annular_mask((11, 9), center_x=4, inner_radius=2,
+                                 outer_radius=3)
+    assert mask.shape == (9, 11)
+    for y in range(9):
+        for x in range(11):
+            distance2 = (x - 4) ** 2 + (y - 4) ** 2
+            assert mask[y, x] == (4 <= distance2 <= 9)
+
+
+@pytest.mark.parametrize('center', [(-1, -1), (3, 7)])
+def test_annular_mask_matches_worker(center):
+    numpy_engine = pytest.importorskip('stemworker.numpy_engine')
+
+    nx, ny = 24, 17
+    for inner_radius, outer_radius in [(0, 5), (3, 8), (5, 5)]:
+        mask = analysis.annular_mask((nx, ny), center[0], center[1],
+                                     inner_radius, outer_radius)
+        expected = numpy_engine.annular_mask((ny, nx), inner_radius,
+                                             outer_radius, *center)
+        assert np.array_equal(mask, expected)
+
+
+class _Dataset(object):
+    """A dense dataset recording the rows of its reads"""
+
+    def __init__(self, data):
+        self.data = data
+        self.dtype = data.dtype
+        self.shape = data.shape
+        self.reads = []
+
+    def __getitem__(self, rows):
+        self.reads.append(rows)
+        return self.data[rows]
+
+
+@pytest.mark.parametrize('reduction', ['sum', 'mean', 'max'])
+def test_reduce_dense_frames_in_bounded_blocks(monkeypatch, reduction):
+    frames = np.random.default_rng(0).integers(
+        0, 1000, (300, 16, 32), dtype=np.uint16)
+    dataset = _Dataset(frames)
+    rows = np.array([0, 1, 2, 5] + list(range(10, 290)))
+
+    max_bytes = 40 * frames[0].nbytes
+    monkeypatch.setattr(analysis, 'BLOCK_BYTES', max_bytes)
+    result = analysis.reduce_frames(dataset, rows, reduction, (32, 16),
+                                    sparse=False)
+
+    assert max(r.stop - r.start for r in dataset.reads) == 40
+    selected = frames[rows].astype(np.float64)
+    expected = {'sum': selected.sum(axis=0), 'mean': selected.mean(axis=0),
+                'max': selected.max(axis=0)}[reduction]
+    assert np.allclose(result, expected)
+
+
+@pytest.mark.plugin('stem')
+def test_virtual_detector(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    data = fetch('/stem_images/%s/analysis/virtual_detector' % id,
+                 centerX=3, centerY=2, innerRadius=1, outerRadius=3).data
+
+    mask = analysis.annular_mask(FRAME_SHAPE, 3, 2, 1, 3).ravel()
+    with h5py.File(electron_file, 'r') as f:
+        frames = f['/electron_events/frames'][()]
+    expected = [mask[events].sum() for events in frames]
+    assert np.array_equal(np.frombuffer(data, dtype=np.float64),
+                          np.asarray(expected, dtype=np.float64))
+    assert len(expected) == NUM_POSITIONS
+
+
+@pytest.mark.plugin('stem')
+def test_images_named_like_analysis_routes(fetch, stem_image, raw_file):
+    with h5py.File(raw_file, 'a') as f:
+        f['/stem/images'].attrs['names'] = np.array(
+            ['virtual_detector', 'analysis'], dtype=h5py.string_dtype())
+        images = f['/stem/images'][()]
+
+    id = stem_image(raw_file)['_id']
+    for index, name in enumerate(['virtual_detector', 'analysis']):
+        data = fetch('/stem_images/%s/%s' % (id, name)).data
+        assert np.array_equal(np.frombuffer(data, dtype=images.dtype),
+                              images[index].ravel())
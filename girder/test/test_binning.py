@@ -0,0 +1,83 @@
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+from conftest import FRAME_SHAPE, NUM_POSITIONS
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def _bin_events(events, roi, bin):
+    x, y, width, height = roi
+    width -= width % bin
+    height -= height % bin
+    ex, ey = events % FRAME_SHAPE[0], events // FRAME_SHAPE[0]
+    keep = (ex >= x) & (ex < x + width) & (ey >= y) & (ey < y + height)
+    return (((ey[keep] - y) // bin) * (width // bin) +
+            (ex[keep] - x) // bin)
+
+
+def _unpack_all(data):
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+    return [frame for chunk in unpacker for frame in chunk]
+
+
+def test_electron_frame(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    with h5py.File(electron_file, 'r') as f:
+        events = f['/electron_events/frames'][4]
+
+    roi = [1, 2, 5, 3]
+    data = fetch('/stem_images/%s/frames/4' % id, bin=2, roi=roi).data
+    # The event dtype is kept
+    assert np.array_equal(np.frombuffer(data, dtype=np.uint32),
+                          _bin_events(events, roi, 2))
+
+
+@pytest.mark.parametrize('type', ['electron', 'raw'])
+def test_all_frames(fetch, stem_image, electron_file, raw_file, type):
+    path = electron_file if type == 'electron' else raw_file
+    id = stem_image(path)['_id']
+    with h5py.File(path, 'r') as f:
+        frames = f['/electron_events/frames' if type == 'electron'
+                   else '/frames'][()]
+
+    roi = [2, 1, 6, 4]
+    data = fetch('/stem_images/%s/frames' % id, type=type, bin=3,
+                 roi=roi).data
+    result = _unpack_all(data)
+    assert len(result) == NUM_POSITIONS
+
+    for frame, expected in zip(result, frames):
+        if type == 'electron':
+            expected = _bin_events(expected, roi, 3)
+        else:
+            expected = expected[1:4, 2:8].astype(np.uint32).reshape(
+                (1, 3, 2, 3)).sum(axis=(1, 3))
+        assert np.array_equal(np.array(frame), expected)
+
+
+def test_reduce(fetch, stem_image, raw_file):
+    id = stem_image(raw_file)['_id']
+    with h5py.File(raw_file, 'r') as f:
+        frames = f['/frames'][[1, 2]].astype(np.float64)
+
+    data = fetch('/stem_images/%s/frames/reduce' % id, type='raw',
+                 positions=[1, 2], bin=2, roi=[0, 2, 8, 4]).data
+    expected = frames.sum(axis=0)[2:6, :].reshape((2, 2, 4, 2)).sum(
+        axis=(1, 3))
+    assert np.array_equal(np.frombuffer(data, dtype=np.float64),
+                          expected.ravel())
+
+
+def test_roi_errors(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    path = '/stem_images/%s/frames/0' % id
+
+    fetch(path, status=400, roi=[0, 0, FRAME_SHAPE[0] + 1, 1])
+    fetch(path, status=400, roi=[-1, 0, 2, 2])
+    fetch(path, status=400, roi=[0, 0, 2])
+    fetch(path, status=400, bin=-1)
+    fetch(path, status=400, bin=3, roi=[0, 0, 2, 4])
@@ -0,0 +1,173 @@
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from pytest_girder.assertions import assertStatus, assertStatusOk
+
+from conftest import FRAME_SHAPE, SCAN_SHAPE, ManualExecutor
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+@pytest.fixture
+def manual_executor(monkeypatch):
+    from stemserver_plugin import derived
+
+    executor = ManualExecutor()
+    monkeypatch.setattr(derived, 'get_executor', lambda: executor)
+    return executor
+
+
+def _wait_for_status(server, admin, id, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        resp = server.request('/stem_images/%s/derived/status' % id,
+                              user=admin)
+        assertStatusOk(resp)
+        if resp.json['status'] != 'running' or time.time() > deadline:
+            return resp.json
+        time.sleep(0.1)
+
+
+def test_derived_products(server, admin, fetch, stem_image,
+                          multi_frame_electron_file):
+    id = stem_image(multi_frame_electron_file)['_id']
+
+    status = _wait_for_status(server, admin, id)
+    assert status['status'] == 'complete'
+    assert status['products'] == ['scan_counts', 'summed_diffraction',
+                                  'frame_counts']
+    assert 'path' not in status
+
+    with h5py.File(multi_frame_electron_file, 'r') as f:
+        frames = f['/electron_events/frames'][()]
+        positions = f['/electron_events/scan_positions'][()]
+    frame_counts = np.array([len(events) for events in frames])
+    num_pixels = FRAME_SHAPE[0] * FRAME_SHAPE[1]
+    expected = {
+        'frame_counts': frame_counts,
+        'summed_diffraction': np.bincount(np.concatenate(frames),
+                                          minlength=num_pixels),
+        'scan_counts': np.bincount(positions, weights=frame_counts,
+                                   minlength=SCAN_SHAPE[0] * SCAN_SHAPE[1])
+    }
+    for name, values in expected.items():
+        resp = fetch('/stem_images/%s/derived/products/%s' % (id, name))
+        assert np.array_equal(np.frombuffer(resp.data, dtype=np.float64),
+                              values)
+
+    fetch('/stem_images/%s/derived/products/unknown' % id, status=400)
+
+
+def test_derived_products_not_available(server, admin, fetch, stem_image,
+                                        electron_file, manual_executor):
+    id = stem_image(electron_file)['_id']
+
+    resp = server.request('/stem_images/%s/derived/status' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json['status'] == 'running'
+    fetch('/stem_images/%s/derived/products/frame_counts' % id, status=404)
+
+    manual_executor.run()
+    resp = server.request('/stem_images/%s/derived/status' % id, user=admin)
+    assert resp.json['status'] == 'complete'
+    fetch('/stem_images/%s/derived/products/frame_counts' % id)
+
+
+def test_status_update_keeps_the_file_open(server, admin, fetch, stem_image,
+                                           electron_file, manual_executor):
+    from stemserver_plugin.models.stemimage import h5_file_pool
+
+    doc = stem_image(electron_file)
+    fetch('/stem_images/%s/frames/0' % doc['_id'])
+    entry = h5_file_pool._entries[str(doc['fileId'])]
+
+    manual_executor.run()
+
+    assert h5_file_pool._entries.get(str(doc['fileId'])) is entry
+    assert entry['file'].id.valid
+
+
+def test_delete_while_running(server, admin, stem_image, electron_file,
+                              manual_executor):
+    id = stem_image(electron_file)['_id']
+    output_path = manual_executor.jobs[0][2][1]
+
+    resp = server.request('/stem_images/%s' % id, method='DELETE',
+                          user=admin)
+    assertStatusOk(resp)
+
+    manual_executor.run()
+    assert not os.path.exists(output_path)
+
+
+def test_delete_removes_the_products(server, admin, stem_image,
+                                     electron_file, manual_executor):
+    id = stem_image(electron_file)['_id']
+    manual_executor.run()
+
+    resp = server.request('/stem_images/%s/derived/status' % id, user=admin)
+    assert resp.json['status'] == 'complete'
+    output_path = manual_executor.completed[0][2][1]
+    assert os.path.exists(output_path)
+
+    resp = server.request('/stem_images/%s' % id, method='DELETE',
+                          user=admin)
+    assertStatusOk(resp)
+    assert not os.path.exists(output_path)
+
+    resp = server.request('/stem_images/%s/derived/status' % id, user=admin)
+    assertStatus(resp, 404)
+
+
+def test_image_named_derived(fetch, stem_image, raw_file, manual_executor):
+    with h5py.File(raw_file, 'a') as f:
+        f['/stem/images'].attrs['names'] = np.array(
+            ['derived', 'status'], dtype=h5py.string_dtype())
+        images = f['/stem/images'][()]
+
+    id = stem_image(raw_file)['_id']
+    data = fetch('/stem_images/%s/derived' % id).data
+    assert np.array_equal(np.frombuffer(data, dtype=images.dtype),
+                          images[0].ravel())
+    resp = fetch('/stem_images/%s/derived/shape' % id)
+    assert json.loads(resp.data) == list(images.shape[1:])
+
+
+def test_unknown_detector_dimensions(server, admin, stem_image, electron_file,
+                                     manual_executor):
+    with h5py.File(electron_file, 'a') as f:
+        del f['/electron_events/frames'].attrs['Nx']
+
+    id = stem_image(electron_file)['_id']
+    assert manual_executor.jobs == []
+
+    resp = server.request('/stem_images/%s/derived/status' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json['status'] == 'unavailable'
+    assert 'detector dimensions' in resp.json['error']
+
+
+def test_blocks_bounded_by_bytes(monkeypatch, tmp_path, raw_file):
+    from stemserver_plugin import analysis, derived
+
+    metadata = {'types': {'raw': {'scanShape': None}}}
+    expected_path = derived.compute_derived_products(
+        raw_file, str(tmp_path / 'expected.h5'), metadata)
+
+    # Blocks of two uint16 frames
+    monkeypatch.setattr(analysis, 'BLOCK_BYTES',
+                        2 * FRAME_SHAPE[0] * FRAME_SHAPE[1] * 2)
+    with h5py.File(raw_file, 'r') as f:
+        assert analysis.block_rows(f['/frames']) == 2
+    output_path = derived.compute_derived_products(
+        raw_file, str(tmp_path / 'blocks.h5'), metadata)
+
+    with h5py.File(expected_path, 'r') as expected, \
+            h5py.File(output_path, 'r') as output:
+        for name in derived.PRODUCTS:
+            assert np.array_equal(output[name][()], expected[name][()])
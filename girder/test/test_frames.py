@@ -0,0 +1,90 @@
+import json
+
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+from pytest_girder.utils import getResponseBody
+
+from conftest import NUM_POSITIONS
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def _post_frames(server, admin, id, body, status=200, **params):
+    resp = server.request('/stem_images/%s/frames' % id, method='POST',
+                          user=admin, params=params, body=json.dumps(body),
+                          type='application/json', isJson=False)
+    data = getResponseBody(resp, text=False)
+    assert resp.output_status.startswith(str(status).encode()), data
+    return data
+
+
+def _read_frames(data):
+    """Decode the chunks of the bulk frames endpoint into a dict of the
+    frame of each position"""
+    frames = {}
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+    for message in unpacker:
+        if 'frames' in message:
+            frames.update(zip(message['positions'],
+                              [np.array(f) for f in message['frames']]))
+            continue
+
+        positions = np.frombuffer(message['positions'], dtype='<u4')
+        values = np.frombuffer(message['data'], dtype=message['dtype'])
+        if 'offsets' in message:
+            offsets = np.frombuffer(message['offsets'], dtype='<u4')
+            chunk = [values[offsets[i]:offsets[i + 1]]
+                     for i in range(len(positions))]
+        else:
+            chunk = values.reshape(message['shape'])
+        frames.update(zip(positions.tolist(), chunk))
+
+    return frames
+
+
+@pytest.mark.parametrize('format', ['msgpack', 'msgpack-typed'])
+@pytest.mark.parametrize('type', ['electron', 'raw'])
+def test_bulk_frames(server, admin, stem_image, electron_file, raw_file,
+                     type, format):
+    path = electron_file if type == 'electron' else raw_file
+    id = stem_image(path)['_id']
+    with h5py.File(path, 'r') as f:
+        expected = f['/electron_events/frames' if type == 'electron'
+                     else '/frames'][()]
+
+    body = {'positions': [7, 2, 7], 'ranges': [[0, 2], [9, 11]]}
+    frames = _read_frames(_post_frames(server, admin, id, body, type=type,
+                                       format=format))
+
+    assert sorted(frames) == [0, 1, 2, 7, 9, 10]
+    for position, frame in frames.items():
+        assert np.array_equal(frame, expected[position])
+
+
+def test_ranges_are_clipped(server, admin, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+
+    body = {'ranges': [[-5, 2], [NUM_POSITIONS - 1, 2 ** 62], [8, 3]]}
+    frames = _read_frames(_post_frames(server, admin, id, body))
+    assert sorted(frames) == [0, 1, NUM_POSITIONS - 1]
+
+    body = {'ranges': [[2 ** 40, 2 ** 41]]}
+    assert _read_frames(_post_frames(server, admin, id, body)) == {}
+
+
+def test_bulk_frames_errors(server, admin, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+
+    for body in [{'positions': [NUM_POSITIONS]}, {'positions': [-1]},
+                 {'ranges': [[0, 1, 2]]}, {'ranges': [0]},
+                 {'ranges': [['a', 2]]}, {'ranges': 3}, {'positions': 3},
+                 {'positions': [[0, 1]]}, {'positions': ['a']},
+                 [0, 1], 3, 'positions', None]:
+        _post_frames(server, admin, id, body, status=400)
+
+    _post_frames(server, admin, id, {'positions': [0]}, status=400,
+                 format='bytes')
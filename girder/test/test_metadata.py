@@ -0,0 +1,118 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from pytest_girder.assertions import assertStatus, assertStatusOk
+
+from conftest import FRAME_SHAPE, NUM_POSITIONS, SCAN_SHAPE
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def test_metadata_is_stored(stem_image, raw_file):
+    doc = stem_image(raw_file)
+
+    metadata = doc['metadata']
+    assert metadata['types'] == {
+        'raw': {
+            'frames': NUM_POSITIONS,
+            'frameShape': [FRAME_SHAPE[1], FRAME_SHAPE[0]],
+            'scanShape': None
+        }
+    }
+    assert metadata['images'] == {
+        'names': ['bright', 'dark'],
+        'count': 2,
+        'shape': [SCAN_SHAPE[1], SCAN_SHAPE[0]]
+    }
+
+
+def test_electron_metadata(stem_image, multi_frame_electron_file):
+    doc = stem_image(multi_frame_electron_file)
+
+    info = doc['metadata']['types']['electron']
+    assert info['frames'] == 15
+    assert info['frameShape'] == list(FRAME_SHAPE)
+    assert info['scanShape'] == list(SCAN_SHAPE)
+    assert info['scanIndex'] == {'positions': NUM_POSITIONS,
+                                 'identity': False, 'maxFrames': 3,
+                                 'empty': 1}
+    assert doc['metadata']['images'] is None
+
+
+def test_endpoints_use_metadata(server, admin, stem_image, raw_file):
+    id = stem_image(raw_file)['_id']
+
+    resp = server.request('/stem_images/%s/names' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json == ['bright', 'dark']
+
+    resp = server.request('/stem_images/%s/dark/shape' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json == [SCAN_SHAPE[1], SCAN_SHAPE[0]]
+
+    resp = server.request('/stem_images/%s/frames/types' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json == ['raw']
+
+    resp = server.request('/stem_images/%s/frames/shape' % id, user=admin,
+                          params={'type': 'raw'})
+    assertStatusOk(resp)
+    assert resp.json == [FRAME_SHAPE[1], FRAME_SHAPE[0]]
+
+    resp = server.request('/stem_images/%s/frames/shape' % id, user=admin)
+    assertStatus(resp, 404)
+
+
+def test_find_fields_and_pagination(server, admin, stem_image, raw_file,
+                                    electron_file):
+    ids = [stem_image(path)['_id'] for path in [raw_file, electron_file,
+                                                raw_file]]
+
+    resp = server.request('/stem_images', user=admin,
+                          params={'fields': 'fileId,metadata.images'})
+    assertStatusOk(resp)
+    assert [doc['_id'] for doc in resp.json] == ids
+    for doc in resp.json:
+        assert set(doc) == {'_id', 'fileId', 'metadata'}
+        assert set(doc['metadata']) == {'images'}
+
+    resp = server.request('/stem_images', user=admin,
+                          params={'limit': 1, 'offset': 1})
+    assertStatusOk(resp)
+    assert [doc['_id'] for doc in resp.json] == ids[1:2]
+    assert 'access' not in resp.json[0]
+
+    resp = server.request('/stem_images', user=admin,
+                          params={'sort': '_id', 'sortdir': -1})
+    assertStatusOk(resp)
+    assert [doc['_id'] for doc in resp.json] == ids[::-1]
+
+
+def test_rescan(server, admin, stem_image, raw_file):
+    id = stem_image(raw_file)['_id']
+
+    # Replace the file, the server keeps the previous one open
+    with h5py.File(raw_file + '.new', 'w') as f:
+        f.create_dataset('/stem/images', data=np.zeros((3, 5, 7)))
+    os.replace(raw_file + '.new', raw_file)
+
+    resp = server.request('/stem_images/%s/rescan' % id, method='PUT',
+                          user=admin)
+    assertStatusOk(resp)
+    assert resp.json['metadata']['images'] == {'names': [], 'count': 3,
+                                               'shape': [5, 7]}
+
+    resp = server.request('/stem_images/%s/0/shape' % id, user=admin)
+    assertStatusOk(resp)
+    assert resp.json == [5, 7]
+
+
+def test_rescan_requires_write_access(server, user, stem_image, raw_file):
+    id = stem_image(raw_file, public=True)['_id']
+
+    resp = server.request('/stem_images/%s/rescan' % id, method='PUT',
+                          user=user)
+    assertStatus(resp, 403)
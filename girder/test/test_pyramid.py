@@ -0,0 +1,87 @@
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+from pytest_girder.assertions import assertStatus, assertStatusOk
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    path = str(tmp_path / 'images.h5')
+    rng = np.random.default_rng(3)
+    with h5py.File(path, 'w') as f:
+        images = f.create_dataset('/stem/images', data=rng.random((2, 5, 7)))
+        images.attrs['names'] = np.array(['bright', 'dark'],
+                                         dtype=h5py.string_dtype())
+
+    return path
+
+
+def _read_image(resp):
+    message = msgpack.unpackb(resp.data, raw=False)
+    return np.frombuffer(message['data'], dtype=message['dtype']).reshape(
+        message['shape'])
+
+
+def _downsample(image):
+    padded = np.pad(image, ((0, image.shape[0] % 2),
+                            (0, image.shape[1] % 2)), mode='edge')
+    return padded.reshape((padded.shape[0] // 2, 2,
+                           padded.shape[1] // 2, 2)).mean(axis=(1, 3))
+
+
+def test_levels(server, admin, fetch, stem_image, image_file):
+    id = stem_image(image_file)['_id']
+    with h5py.File(image_file, 'r') as f:
+        expected = f['/stem/images'][1]
+
+    # 5x7, 3x4, 2x2 and 1x1
+    for level in range(4):
+        resp = server.request('/stem_images/%s/dark/shape' % id, user=admin,
+                              params={'level': level})
+        assertStatusOk(resp)
+        assert resp.json == list(expected.shape)
+
+        resp = fetch('/stem_images/%s/dark' % id, level=level,
+                     format='msgpack-typed')
+        assert np.allclose(_read_image(resp), expected)
+        expected = _downsample(expected)
+
+    resp = server.request('/stem_images/%s/dark/shape' % id, user=admin,
+                          params={'level': 4})
+    assertStatus(resp, 400)
+
+
+def test_max_size(server, admin, fetch, stem_image, image_file):
+    id = stem_image(image_file)['_id']
+
+    for max_size, shape in [(100, [5, 7]), (7, [5, 7]), (6, [3, 4]),
+                            (2, [2, 2]), (0, [1, 1])]:
+        resp = server.request('/stem_images/%s/0/shape' % id, user=admin,
+                              params={'maxSize': max_size})
+        assertStatusOk(resp)
+        assert resp.json == shape
+
+        resp = fetch('/stem_images/%s/0' % id, maxSize=max_size)
+        assert len(resp.data) == shape[0] * shape[1] * 8
+
+
+def test_tiles(fetch, stem_image, image_file):
+    id = stem_image(image_file)['_id']
+    with h5py.File(image_file, 'r') as f:
+        image = f['/stem/images'][0]
+
+    resp = fetch('/stem_images/%s/bright' % id, x=2, y=1, width=4, height=3,
+                 format='msgpack-typed')
+    assert np.array_equal(_read_image(resp), image[1:4, 2:6])
+
+    # In the coordinates of the level
+    resp = fetch('/stem_images/%s/bright' % id, level=1, x=1, y=1,
+                 format='msgpack-typed')
+    assert np.allclose(_read_image(resp), _downsample(image)[1:, 1:])
+
+    fetch('/stem_images/%s/bright' % id, status=400, x=5, width=3)
+    fetch('/stem_images/%s/bright' % id, status=400, level=1, y=3)
@@ -0,0 +1,104 @@
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+from conftest import FRAME_SHAPE
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def _dense_frames(path, type):
+    """Read the frames of a file as dense float64 frames, and the frame
+    rows of each scan position"""
+    with h5py.File(path, 'r') as f:
+        if type == 'raw':
+            frames = f['/frames'][()].astype(np.float64)
+            positions = np.arange(len(frames))
+        else:
+            num_pixels = FRAME_SHAPE[0] * FRAME_SHAPE[1]
+            frames = np.array([
+                np.bincount(events, minlength=num_pixels).reshape(
+                    (FRAME_SHAPE[1], FRAME_SHAPE[0]))
+                for events in f['/electron_events/frames']], dtype=np.float64)
+            positions = f['/electron_events/scan_positions'][()]
+
+    return frames, positions
+
+
+def _reduce(frames, scan_positions, positions, reduction):
+    selected = frames[np.isin(scan_positions, positions)]
+    return {
+        'sum': selected.sum(axis=0),
+        'mean': selected.mean(axis=0),
+        'max': selected.max(axis=0)
+    }[reduction]
+
+
+@pytest.mark.parametrize('reduction', ['sum', 'mean', 'max'])
+@pytest.mark.parametrize('type', ['electron', 'raw'])
+def test_reduce_positions(fetch, stem_image, multi_frame_electron_file,
+                          raw_file, type, reduction):
+    path = multi_frame_electron_file if type == 'electron' else raw_file
+    id = stem_image(path)['_id']
+    frames, scan_positions = _dense_frames(path, type)
+
+    # Position 3 has no electron frames, 0 and 2 have several
+    positions = [5, 0, 3, 2, 5]
+    resp = fetch('/stem_images/%s/frames/reduce' % id, type=type,
+                 reduction=reduction, positions=positions)
+    result = np.frombuffer(resp.data, dtype=np.float64)
+
+    expected = _reduce(frames, scan_positions, positions, reduction)
+    assert np.allclose(result.reshape(expected.shape), expected)
+
+
+def test_reduce_over_frames(fetch, stem_image, multi_frame_electron_file):
+    id = stem_image(multi_frame_electron_file)['_id']
+    frames, _ = _dense_frames(multi_frame_electron_file, 'electron')
+
+    # Position 2 has the frames 3, 4 and 5, position 3 has none: the mean
+    # is over the three frames
+    resp = fetch('/stem_images/%s/frames/reduce' % id, reduction='mean',
+                 positions=[2, 3])
+    result = np.frombuffer(resp.data, dtype=np.float64)
+    expected = (frames[3] + frames[4] + frames[5]) / 3
+    assert np.allclose(result.reshape(expected.shape), expected)
+
+    resp = fetch('/stem_images/%s/frames/reduce' % id, reduction='max',
+                 positions=[2, 3])
+    result = np.frombuffer(resp.data, dtype=np.float64)
+    expected = np.maximum.reduce([frames[3], frames[4], frames[5]])
+    assert np.array_equal(result.reshape(expected.shape), expected)
+
+
+def test_reduce_rectangle(fetch, stem_image, multi_frame_electron_file,
+                          raw_file):
+    id = stem_image(multi_frame_electron_file)['_id']
+    frames, scan_positions = _dense_frames(multi_frame_electron_file,
+                                           'electron')
+
+    # Clipped to the scan
+    resp = fetch('/stem_images/%s/frames/reduce' % id, x=2, y=0, width=5,
+                 height=1, format='msgpack-typed')
+    message = msgpack.unpackb(resp.data, raw=False)
+    result = np.frombuffer(message['data'], dtype=message['dtype'])
+
+    expected = _reduce(frames, scan_positions, [2, 3], 'sum')
+    assert message['shape'] == list(expected.shape)
+    assert np.array_equal(result.reshape(expected.shape), expected)
+
+    # Raw datasets don't have the scan dimensions
+    raw_id = stem_image(raw_file)['_id']
+    fetch('/stem_images/%s/frames/reduce' % raw_id, status=404, type='raw',
+          x=0, y=0, width=1, height=1)
+
+
+def test_reduce_errors(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    path = '/stem_images/%s/frames/reduce' % id
+
+    fetch(path, status=400)
+    fetch(path, status=400, positions=[0, 12])
+    fetch(path, status=400, positions=[-1])
+    fetch(path, status=400, positions=[0], reduction='median')
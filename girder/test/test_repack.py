@@ -0,0 +1,162 @@
+import json
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from pytest_girder.assertions import assertStatus, assertStatusOk
+
+from conftest import ManualExecutor
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+@pytest.fixture
+def repack_executor(monkeypatch):
+    from stemserver_plugin import repack
+
+    executor = ManualExecutor()
+    monkeypatch.setattr(repack, 'get_executor', lambda: executor)
+    return executor
+
+
+def _create(server, admin, body):
+    return server.request('/stem_images', method='POST', user=admin,
+                          body=json.dumps(body), type='application/json')
+
+
+def _get(server, admin, id, path=''):
+    resp = server.request('/stem_images/%s%s' % (id, path), user=admin)
+    assertStatusOk(resp)
+    return resp.json
+
+
+@pytest.mark.parametrize('compression', ['lzf', 'gzip', None])
+def test_repack(server, admin, fsAssetstore, fetch, raw_file,
+                repack_executor, compression):
+    resp = _create(server, admin, {'filePath': raw_file, 'repack': True,
+                                   'compression': compression})
+    assertStatusOk(resp)
+    doc = resp.json
+    id = doc['_id']
+
+    # The copy is kept in the assetstore, and made in the background
+    assert doc['repack']['status'] == 'running'
+    output_path = doc['repack']['path']
+    assert os.path.dirname(output_path) == os.path.join(
+        fsAssetstore['root'], 'stem_repacked')
+    assert _get(server, admin, id, '/path')['path'] == raw_file
+    before = fetch('/stem_images/%s/frames/3' % id, type='raw').data
+
+    repack_executor.run()
+
+    report = _get(server, admin, id)['repack']
+    assert report['status'] == 'complete'
+    assert report['compression'] == compression
+    assert report['source'] == raw_file
+    assert report['path'] == output_path
+    assert set(report['datasets']) == {'/frames', '/scan_positions'}
+
+    with h5py.File(raw_file, 'r') as original, \
+            h5py.File(output_path, 'r') as repacked:
+        frames = repacked['/frames']
+        assert list(frames.chunks) == report['datasets']['/frames']['chunks']
+        assert frames.compression == compression
+        assert np.array_equal(frames[()], original['/frames'][()])
+        assert np.array_equal(repacked['/stem/images'][()],
+                              original['/stem/images'][()])
+        assert (list(repacked['/stem/images'].attrs['names']) ==
+                list(original['/stem/images'].attrs['names']))
+
+    # The stem image reads the repacked copy
+    assert _get(server, admin, id, '/path')['path'] == output_path
+    assert fetch('/stem_images/%s/frames/3' % id, type='raw').data == before
+
+    resp = server.request('/stem_images/%s' % id, method='DELETE',
+                          user=admin)
+    assertStatusOk(resp)
+    assert not os.path.exists(output_path)
+    assert os.path.exists(raw_file)
+
+
+def test_repack_directory(monkeypatch, tmp_path, server, admin, fsAssetstore,
+                          raw_file, repack_executor):
+    from stemserver_plugin.models import stemimage
+
+    directory = str(tmp_path / 'repacked')
+    monkeypatch.setattr(stemimage, 'repack_directory', directory)
+
+    resp = _create(server, admin, {'filePath': raw_file, 'repack': True})
+    assertStatusOk(resp)
+    assert os.path.dirname(resp.json['repack']['path']) == directory
+    repack_executor.run()
+    assert (_get(server, admin, resp.json['_id'], '/path')['path'] ==
+            resp.json['repack']['path'])
+
+
+def test_repack_errors(server, admin, user, fsAssetstore, tmp_path, raw_file,
+                       repack_executor):
+    resp = _create(server, admin, {'filePath': raw_file, 'repack': True,
+                                   'compression': 'zstd'})
+    assertStatus(resp, 400)
+
+    not_hdf5 = str(tmp_path / 'not_hdf5.h5')
+    with open(not_hdf5, 'w') as f:
+        f.write('not hdf5')
+    resp = _create(server, admin, {'filePath': not_hdf5, 'repack': True})
+    assertStatus(resp, 400)
+
+    resp = _create(server, user, {'filePath': raw_file, 'repack': True})
+    assertStatus(resp, 403)
+    assert repack_executor.jobs == []
+
+
+def test_failed_repack(monkeypatch, server, admin, fsAssetstore, fetch,
+                       raw_file, repack_executor):
+    from stemserver_plugin import repack
+
+    resp = _create(server, admin, {'filePath': raw_file, 'repack': True})
+    assertStatusOk(resp)
+    id = resp.json['_id']
+    output_path = resp.json['repack']['path']
+
+    monkeypatch.setattr(repack, 'dataset_checksum', lambda dataset: '')
+    repack_executor.run()
+
+    status = _get(server, admin, id)['repack']
+    assert status['status'] == 'error'
+    assert 'Checksum mismatch' in status['error']
+    assert 'path' not in status
+    assert not os.path.exists(output_path)
+    # The stem image still reads the original
+    assert _get(server, admin, id, '/path')['path'] == raw_file
+    fetch('/stem_images/%s/frames/3' % id, type='raw')
+
+
+def test_delete_while_repacking(server, admin, fsAssetstore, raw_file,
+                                repack_executor):
+    resp = _create(server, admin, {'filePath': raw_file, 'repack': True})
+    assertStatusOk(resp)
+    output_path = resp.json['repack']['path']
+
+    resp = server.request('/stem_images/%s' % resp.json['_id'],
+                          method='DELETE', user=admin)
+    assertStatusOk(resp)
+
+    repack_executor.run()
+    assert not os.path.exists(output_path)
+    assert os.path.exists(raw_file)
+
+
+def test_failed_repack_leaves_no_file(monkeypatch, tmp_path, raw_file):
+    from stemserver_plugin import repack
+
+    monkeypatch.setattr(repack, 'dataset_checksum', lambda dataset: '')
+    output_path = str(tmp_path / 'repacked.h5')
+    with pytest.raises(Exception, match='Checksum mismatch'):
+        repack.repack(raw_file, output_path)
+
+    assert not os.path.exists(output_path)
+    assert not os.path.exists(output_path + '.tmp')
+
@@ -0,0 +1,90 @@
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+from conftest import FRAME_SHAPE, NUM_POSITIONS
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def _frames_by_position(path):
+    with h5py.File(path, 'r') as f:
+        frames = f['/electron_events/frames'][()]
+        positions = f['/electron_events/scan_positions'][()]
+
+    return {p: np.concatenate([frames[i] for i in np.flatnonzero(
+        positions == p)] or [np.empty(0, dtype=np.uint32)])
+        for p in range(NUM_POSITIONS)}
+
+
+def test_scan_index(fetch, stem_image, electron_file,
+                    multi_frame_electron_file):
+    id = stem_image(electron_file)['_id']
+    message = msgpack.unpackb(
+        fetch('/stem_images/%s/scanPositions/index' % id).data, raw=False)
+    assert message == {'positions': NUM_POSITIONS, 'frames': NUM_POSITIONS,
+                       'identity': True}
+
+    id = stem_image(multi_frame_electron_file)['_id']
+    message = msgpack.unpackb(
+        fetch('/stem_images/%s/scanPositions/index' % id).data, raw=False)
+    assert message['identity'] is False
+    assert message['positions'] == NUM_POSITIONS
+    assert message['frames'] == 15
+
+    offsets = np.frombuffer(message['offsets'], dtype=message['dtype'])
+    rows = np.frombuffer(message['rows'], dtype=message['dtype'])
+    with h5py.File(multi_frame_electron_file, 'r') as f:
+        positions = f['/electron_events/scan_positions'][()]
+    for p in range(NUM_POSITIONS):
+        assert np.array_equal(rows[offsets[p]:offsets[p + 1]],
+                              np.flatnonzero(positions == p))
+
+
+@pytest.mark.parametrize('format', ['bytes', 'msgpack', 'msgpack-typed'])
+def test_frame_of_position(fetch, stem_image, multi_frame_electron_file,
+                           format):
+    id = stem_image(multi_frame_electron_file)['_id']
+    expected = _frames_by_position(multi_frame_electron_file)
+
+    # Position 0 has two frames, 2 has three and 3 has none
+    for position in [0, 2, 3, 4]:
+        data = fetch('/stem_images/%s/frames/%d' % (id, position),
+                     format=format).data
+        if format == 'bytes':
+            frame = np.frombuffer(data, dtype=np.uint32)
+        elif format == 'msgpack':
+            frame = np.array(msgpack.unpackb(data), dtype=np.uint32)
+        else:
+            message = msgpack.unpackb(data, raw=False)
+            assert message['shape'] == [1]
+            frame = np.frombuffer(message['data'], dtype=message['dtype'])
+        assert np.array_equal(frame, expected[position])
+
+
+@pytest.mark.parametrize('format', ['bytes', 'msgpack', 'msgpack-typed'])
+def test_raw_frame_bin_roi(fetch, stem_image, raw_file, format):
+    id = stem_image(raw_file)['_id']
+    with h5py.File(raw_file, 'r') as f:
+        frame = f['/frames'][5].astype(np.uint32)
+
+    # [x, y, width, height], trimmed to a multiple of bin
+    data = fetch('/stem_images/%s/frames/5' % id, type='raw', format=format,
+                 bin=2, roi=[1, 1, 7, 5]).data
+    expected = frame[1:5, 1:7].reshape((2, 2, 3, 2)).sum(axis=(1, 3))
+
+    if format == 'bytes':
+        result = np.frombuffer(data, dtype=np.uint32).reshape(expected.shape)
+    elif format == 'msgpack':
+        result = np.array(msgpack.unpackb(data))
+    else:
+        message = msgpack.unpackb(data, raw=False)
+        result = np.frombuffer(message['data'], dtype=message['dtype'])
+        result = result.reshape(message['shape'])
+    assert np.array_equal(result, expected)
+
+    data = fetch('/stem_images/%s/frames/5' % id, type='raw',
+                 roi=[2, 0, 3, FRAME_SHAPE[1]]).data
+    assert np.array_equal(np.frombuffer(data, dtype=np.uint16),
+                          frame[:, 2:5].ravel())
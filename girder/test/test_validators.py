@@ -0,0 +1,94 @@
+import os
+import time
+
+import pytest
+
+pytestmark = pytest.mark.plugin('stem')
+
+
+def test_etag(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    path = '/stem_images/%s/frames/3' % id
+
+    resp = fetch(path)
+    etag = resp.headers['ETag']
+    assert resp.headers['Cache-Control'] == 'private, max-age=60'
+    assert 'Pragma' not in resp.headers
+    assert len(resp.data) > 0
+
+    resp = fetch(path, status=304, headers=[('If-None-Match', etag)])
+    assert resp.data == b''
+    resp = fetch(path, status=304,
+                 headers=[('If-None-Match', '"other", W/' + etag)])
+    fetch(path, headers=[('If-None-Match', '"other"')])
+
+    # The tag depends on the parameters
+    resp = fetch(path, format='msgpack')
+    assert resp.headers['ETag'] != etag
+    assert fetch('/stem_images/%s/frames/4' % id).headers['ETag'] != etag
+
+
+def test_last_modified(fetch, stem_image, electron_file):
+    id = stem_image(electron_file, public=True)['_id']
+    path = '/stem_images/%s/scanPositions' % id
+
+    resp = fetch(path)
+    last_modified = resp.headers['Last-Modified']
+    assert resp.headers['Cache-Control'] == 'public, max-age=60'
+
+    fetch(path, status=304, headers=[('If-Modified-Since', last_modified)])
+    fetch(path, headers=[('If-Modified-Since',
+                          'Thu, 01 Jan 1970 00:00:00 GMT')])
+    fetch(path, headers=[('If-Modified-Since', 'not a date')])
+
+
+def test_last_modified_is_utc(monkeypatch, fetch, stem_image, electron_file):
+    id = stem_image(electron_file, public=True)['_id']
+    path = '/stem_images/%s/scanPositions' % id
+    last_modified = fetch(path).headers['Last-Modified']
+
+    # A date without a zone is in UTC, whatever the zone of the server
+    monkeypatch.setenv('TZ', 'Asia/Tokyo')
+    time.tzset()
+    try:
+        since = last_modified.replace('GMT', '-0000')
+        fetch(path, status=304, headers=[('If-Modified-Since', since)])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_file_change(fetch, stem_image, electron_file):
+    id = stem_image(electron_file)['_id']
+    path = '/stem_images/%s/scanPositions' % id
+
+    etag = fetch(path).headers['ETag']
+    stat = os.stat(electron_file)
+    os.utime(electron_file, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 10 ** 9))
+
+    resp = fetch(path, headers=[('If-None-Match', etag)])
+    assert resp.headers['ETag'] != etag
+    assert len(resp.data) > 0
+
+
+def test_response_cache(monkeypatch, tmp_path, fetch, stem_image,
+                        electron_file):
+    from stemserver_plugin.cache import DiskCache
+    from stemserver_plugin.models import stemimage
+
+    cache = DiskCache(str(tmp_path / 'responses'), max_size=1024 ** 2)
+    monkeypatch.setattr(stemimage, 'response_cache', cache)
+
+    id = stem_image(electron_file)['_id']
+    path = '/stem_images/%s/frames' % id
+
+    data = fetch(path).data
+    assert len(os.listdir(str(tmp_path / 'responses'))) > 0
+
+    # Served from the cache, without reading the file
+    def fail(*args, **kwargs):
+        raise AssertionError('The file was read')
+
+    monkeypatch.setattr(stemimage.StemImage, '_open_h5py_file', fail)
+    assert fetch(path).data == data
@@ -0,0 +1,480 @@
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+import click
+import msgpack
+import numpy as np
+import psutil
+import socketio
+
+#
+# Load generator for the Flask relay. It starts a stub Girder API and a
+# local relay (unless --flask-url is given), then connects a simulated fleet:
+#
+# workers ( --num-workers )
+#  |
+#  +--- ranks ( --num-ranks socket.io clients per worker, answering
+#               create/execute and streaming stem.bright/stem.dark )
+#
+# clients ( --num-clients socket.io clients acting as browsers, each creating
+#           a pipeline and issuing --num-executions executions )
+#
+# Every message carries the time it was sent, so that the latency of each hop
+# through the relay can be measured.
+#
+
+LOGIN = 'loadtest'
+USER_ID = '000000000000000000000001'
+FLASK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flask')
+
+PIPELINE_INFO = {
+    'name': 'annular',
+    'displayName': 'Annular Mask',
+    'description': 'Simulated annular mask',
+    'parameters': {},
+    'input': 'frame',
+    'output': 'image',
+    'aggregation': 'sum'
+}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.counts = {}
+        self.bytes = {}
+
+    def record(self, hop, sent_at, size=0):
+        self.latencies.setdefault(hop, []).append(time.time() - sent_at)
+        self.counts[hop] = self.counts.get(hop, 0) + 1
+        self.bytes[hop] = self.bytes.get(hop, 0) + size
+
+    def summary(self, elapsed):
+        hops = {}
+        for hop, values in self.latencies.items():
+            values = np.array(values) * 1000.0
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            hops[hop] = {
+                'count': self.counts[hop],
+                'perSecond': self.counts[hop] / elapsed,
+                'megabytesPerSecond': self.bytes[hop] / elapsed / 1e6,
+                'p50': p50,
+                'p90': p90,
+                'p99': p99,
+                'max': values.max()
+            }
+        return hops
+
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.25):
+        self.process = psutil.Process(pid) if pid is not None else None
+        self.interval = interval
+        self.samples = []
+
+    async def run(self):
+        if self.process is None:
+            return
+        while True:
+            self.samples.append(self.process.memory_info().rss)
+            await asyncio.sleep(self.interval)
+
+    def summary(self):
+        if not self.samples:
+            return None
+        return {
+            'startMB': self.samples[0] / 1e6,
+            'peakMB': max(self.samples) / 1e6,
+            'endMB': self.samples[-1] / 1e6
+        }
+
+
+async def start_girder_stub(port):
+    async def user_me(request):
+        return web.json_response({'_id': USER_ID, 'login': LOGIN})
+
+    async def api_key_token(request):
+        return web.json_response({
+            'authToken': {'token': request.query.get('key', LOGIN)}
+        })
+
+    async def stem_image_path(request):
+        return web.json_response({
+            'path': '/data/%s.h5' % request.match_info['id']
+        })
+
+    app = web.Application()
+    app.router.add_get('/api/v1/user/me', user_me)
+    app.router.add_post('/api/v1/api_key/token', api_key_token)
+    app.router.add_get('/api/v1/stem_images/{id}/path', stem_image_path)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+
+    return runner
+
+
+def start_relay(port, girder_port):
+    config = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+    config.write("GIRDER_API_URL = 'http://127.0.0.1:%d/api/v1'\n" % girder_port)
+    config.write("SECRET_KEY = '%s'\n" % uuid.uuid4().hex)
+    config.close()
+
+    env = dict(os.environ, STEMSERVER_CONFIG=config.name)
+    code = ('import server; '
+            'server.socketio.run(server.app, host="127.0.0.1", port=%d)' % port)
+
+    return subprocess.Popen([sys.executable, '-c', code], cwd=FLASK_DIR,
+                            env=env)
+
+
+async def wait_for_relay(url, relay, timeout=30):
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.time() < deadline:
+            if relay.poll() is not None:
+                raise Exception('Relay exited with code %s' % relay.returncode)
+            try:
+                async with session.post('%s/login' % url, json={}) as resp:
+                    await resp.read()
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2)
+
+    raise Exception('Relay did not start within %s seconds' % timeout)
+
+
+async def authenticate(url, girder_api_key):
+    params = {
+        'girderApiKey': girder_api_key
+    }
+    async with aiohttp.ClientSession(raise_for_status=True) as session:
+        async with session.post('%s/login' % url, json=params) as resp:
+            await resp.read()
+
+    return resp.cookies['session'].output(header='')
+
+
+async def fetch_relay_metrics(url, cookie):
+    headers = {
+        'Cookie': cookie
+    }
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async with session.get('%s/metrics' % url) as resp:
+            if resp.status != 200:
+                return None
+            return await resp.json()
+
+
+async def worker_rank(url, cookie, worker_id, rank, num_ranks, payload,
+                      completions, stats, stream_rate, stream_pixels,
+                      stop_streams):
+    client = socketio.AsyncClient()
+
+    @client.on('connect', namespace='/stem')
+    async def on_connect():
+        data = {
+            'id': worker_id,
+            'rank': rank
+        }
+        if rank == 0:
+            data['pipelines'] = {'annular': PIPELINE_INFO}
+        await client.emit('stem.worker_connected', namespace='/stem', data=data)
+
+    @client.on('stem.pipeline.create', namespace='/stem')
+    async def on_create(params):
+        stats.record('create:client->worker', params['sentAt'])
+        if rank == 0:
+            await client.emit('stem.pipeline.created', namespace='/stem', data={
+                'id': params['id'],
+                'name': params['name'],
+                'workerId': worker_id,
+                'pipelineId': uuid.uuid5(uuid.NAMESPACE_OID, params['id']).hex,
+                'info': PIPELINE_INFO,
+                'sentAt': time.time()
+            })
+
+    @client.on('stem.pipeline.execute', namespace='/stem')
+    async def on_execute(params):
+        load = params['params']['loadtest']
+        stats.record('execute:client->worker', load['sentAt'])
+
+        data = {
+            'correlationId': params.get('correlationId'),
+            'workerId': worker_id,
+            'rank': rank,
+            'pipelineId': params['pipelineId'],
+            'result': payload,
+            'info': PIPELINE_INFO,
+            'loadtest': dict(load, workerSentAt=time.time())
+        }
+        await client.emit('stem.pipeline.executed', namespace='/stem',
+                          data=msgpack.packb(data, use_bin_type=True))
+
+        # Emulate the MPI barrier, rank 0 reports completion once every rank
+        # of the worker has produced its result.
+        key = (params['pipelineId'], load['seq'])
+        done = completions.setdefault(key, [0, asyncio.Event()])
+        done[0] += 1
+        if done[0] == num_ranks:
+            done[1].set()
+
+        if rank == 0:
+            await done[1].wait()
+            del completions[key]
+            await client.emit('stem.pipeline.completed', namespace='/stem', data={
+                'correlationId': params.get('correlationId'),
+                'workerId': worker_id,
+                'rank': rank,
+                'pipelineId': params['pipelineId'],
+                'info': PIPELINE_INFO,
+                'loadtest': dict(load, workerSentAt=time.time())
+            })
+
+    headers = {
+        'Cookie': cookie
+    }
+    await client.connect(url, namespaces=['/stem'], transports=['websocket'],
+                         headers=headers)
+
+    if stream_rate > 0:
+        asyncio.ensure_future(stream(client, rank, num_ranks, stream_rate,
+                                     stream_pixels, stop_streams))
+
+    return client
+
+
+async def stream(client, rank, num_ranks, rate, num_pixels, stop):
+    # Each rank streams its slice of the detector, as mock_detector does.
+    pixel_indices = np.arange(rank, num_pixels * num_ranks, num_ranks,
+                              dtype=np.uint32)
+    while not stop.is_set():
+        values = np.random.rand(num_pixels)
+        for event in ['stem.dark', 'stem.bright']:
+            message = {
+                'data': {
+                    'values': values.tobytes(),
+                    'indexes': pixel_indices.tobytes()
+                },
+                'sentAt': time.time()
+            }
+            await client.emit(event, message, namespace='/stem')
+        await asyncio.sleep(1.0 / rate)
+
+
+async def browser_client(url, cookie, worker_id, num_executions, stats,
+                         subscribers):
+    client = socketio.AsyncClient()
+    created = asyncio.Future()
+    pending = {}
+
+    @client.on('stem.pipeline.created', namespace='/stem')
+    async def on_created(params):
+        stats.record('created:worker->client', params['sentAt'])
+        if not created.done():
+            created.set_result(params['pipelineId'])
+
+    @client.on('stem.pipeline.executed', namespace='/stem')
+    async def on_executed(data):
+        size = len(data)
+        data = msgpack.unpackb(data, raw=False)
+        load = data['loadtest']
+        if load['client'] != client_id:
+            return
+        stats.record('executed:worker->client', load['workerSentAt'], size)
+
+    @client.on('stem.pipeline.completed', namespace='/stem')
+    async def on_completed(data):
+        load = data['loadtest']
+        if load['client'] != client_id:
+            return
+        stats.record('completed:worker->client', load['workerSentAt'])
+        stats.record('execute:end-to-end', load['sentAt'])
+        future = pending.pop(load['seq'], None)
+        if future is not None:
+            future.set_result(None)
+
+    for event in ['stem.bright', 'stem.dark']:
+        def on_stream(message, event=event):
+            stats.record('%s:worker->client' % event, message['sentAt'],
+                         len(message['data']['values']))
+        client.on(event, on_stream, namespace='/stem')
+
+    headers = {
+        'Cookie': cookie
+    }
+    await client.connect(url, namespaces=['/stem'], transports=['websocket'],
+                         headers=headers)
+    client_id = client.get_sid(namespace='/stem')
+
+    await client.emit('stem.pipeline.create', namespace='/stem', data={
+        'id': client_id,
+        'name': 'annular',
+        'workerId': worker_id,
+        'sentAt': time.time()
+    })
+    pipeline_id = await created
+
+    for seq in range(num_executions):
+        future = asyncio.get_running_loop().create_future()
+        pending[seq] = future
+        await client.emit('stem.pipeline.execute', namespace='/stem', data={
+            'workerId': worker_id,
+            'pipelineId': pipeline_id,
+            'params': {
+                'loadtest': {
+                    'client': client_id,
+                    'seq': seq,
+                    'sentAt': time.time()
+                }
+            }
+        })
+        await future
+
+    subscribers.append(client)
+
+
+async def main(url, num_workers, num_ranks, num_clients, num_executions,
+               payload_size, stream_rate, stream_pixels, port, girder_port,
+               relay_pid, output):
+    relay = None
+    girder = None
+    if url is None:
+        girder = await start_girder_stub(girder_port)
+        relay = start_relay(port, girder_port)
+        relay_pid = relay.pid
+        url = 'http://127.0.0.1:%d' % port
+        await wait_for_relay(url, relay)
+
+    stats = Stats()
+    memory = MemorySampler(relay_pid)
+    memory_task = asyncio.ensure_future(memory.run())
+
+    # The result payload is random so that it is not compressible
+    payload = np.random.bytes(payload_size)
+    stop_streams = asyncio.Event()
+    completions = {}
+    cookie = await authenticate(url, LOGIN)
+
+    workers = []
+    ranks = []
+    for _ in range(num_workers):
+        worker_id = uuid.uuid4().hex
+        workers.append(worker_id)
+        for rank in range(num_ranks):
+            ranks.append(await worker_rank(url, cookie, worker_id, rank,
+                                           num_ranks, payload, completions,
+                                           stats, stream_rate, stream_pixels,
+                                           stop_streams))
+
+    # Give the relay a moment to register all the ranks
+    await asyncio.sleep(0.5)
+
+    start = time.time()
+    subscribers = []
+    await asyncio.gather(*[
+        browser_client(url, cookie, workers[i % num_workers], num_executions,
+                       stats, subscribers)
+        for i in range(num_clients)
+    ])
+    elapsed = time.time() - start
+
+    stop_streams.set()
+    memory_task.cancel()
+    relay_metrics = await fetch_relay_metrics(url, cookie)
+
+    for client in ranks + subscribers:
+        await client.disconnect()
+
+    report = {
+        'config': {
+            'workers': num_workers,
+            'ranks': num_ranks,
+            'clients': num_clients,
+            'executions': num_executions,
+            'payloadSize': payload_size,
+            'streamRate': stream_rate,
+            'streamPixels': stream_pixels
+        },
+        'elapsed': elapsed,
+        'executionsPerSecond': num_clients * num_executions / elapsed,
+        'hops': stats.summary(elapsed),
+        'relayMemory': memory.summary(),
+        'relayMetrics': relay_metrics
+    }
+
+    print_report(report)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if relay is not None:
+        relay.terminate()
+        relay.wait()
+    if girder is not None:
+        await girder.cleanup()
+
+
+def print_report(report):
+    print('Elapsed: %.2f s, %.1f executions/s' % (report['elapsed'],
+                                                 report['executionsPerSecond']))
+    row = '%-32s %8s %10s %9s %9s %9s %9s %9s'
+    print(row % ('hop', 'count', 'msg/s', 'MB/s', 'p50 ms', 'p90 ms',
+                 'p99 ms', 'max ms'))
+    for hop, s in sorted(report['hops'].items()):
+        print('%-32s %8d %10.1f %9.2f %9.2f %9.2f %9.2f %9.2f' % (
+            hop, s['count'], s['perSecond'], s['megabytesPerSecond'], s['p50'],
+            s['p90'], s['p99'], s['max']))
+
+    memory = report['relayMemory']
+    if memory is not None:
+        print('Relay RSS: start %.1f MB, peak %.1f MB, end %.1f MB' % (
+            memory['startMB'], memory['peakMB'], memory['endMB']))
+
+
+@click.command()
+@click.option('-u', '--flask-url', default=None,
+              help='URL of a running relay (default: start one locally)')
+@click.option('-w', '--num-workers', type=int, default=1, help='number of workers')
+@click.option('-r', '--num-ranks', type=int, default=4, help='number of ranks per worker')
+@click.option('-c', '--num-clients', type=int, default=4, help='number of browser clients')
+@click.option('-e', '--num-executions', type=int, default=20,
+              help='number of executions per client')
+@click.option('-s', '--payload-size', type=int, default=256 * 256 * 8,
+              help='size in bytes of each rank result')
+@click.option('--stream-rate', type=float, default=10.0,
+              help='bright/dark messages per second per rank (0 to disable)')
+@click.option('--stream-pixels', type=int, default=4096,
+              help='number of pixels in each bright/dark message')
+@click.option('--port', type=int, default=5055, help='port for the local relay')
+@click.option('--girder-port', type=int, default=5056,
+              help='port for the stub Girder API')
+@click.option('--relay-pid', type=int, default=None,
+              help='pid of the relay to sample memory from when using --flask-url')
+@click.option('--seed', type=int, default=0, help='random seed')
+@click.option('-o', '--output', default=None, help='write the report as JSON')
+def cli(flask_url, num_workers, num_ranks, num_clients, num_executions,
+        payload_size, stream_rate, stream_pixels, port, girder_port,
+        relay_pid, seed, output):
+    random.seed(seed)
+    np.random.seed(seed)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(flask_url, num_workers, num_ranks,
+                                 num_clients, num_executions, payload_size,
+                                 stream_rate, stream_pixels, port, girder_port,
+                                 relay_pid, output))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+
+def make_sparse_frames(n_frames, frame_shape=(576, 576),
+                       events_per_frame=200, seed=0):
+    """Generate an object array of sorted uint32 pixel indices per frame"""
+    rng = np.random.default_rng(seed)
+    n_pixels = frame_shape[0] * frame_shape[1]
+    frames = np.empty(n_frames, dtype=object)
+    for i, count in enumerate(rng.poisson(events_per_frame, n_frames)):
+        frames[i] = np.sort(rng.integers(0, n_pixels, count)).astype(
+            np.uint32)
+    return frames
+
+
+def make_raw_blocks(scan_shape=(16, 16), frame_shape=(128, 128),
+                    block_size=32, seed=0):
+    """Generate blocks shaped like the ones of a stempy reader"""
+    rng = np.random.default_rng(seed)
+    n_frames = scan_shape[0] * scan_shape[1]
+    # The scan positions are not in order across blocks
+    image_numbers = rng.permutation(n_frames)
+    blocks = []
+    for start in range(0, n_frames, block_size):
+        numbers = image_numbers[start:start + block_size]
+        header = SimpleNamespace(image_numbers=numbers,
+                                 scan_dimensions=scan_shape[::-1],
+                                 frame_dimensions=frame_shape[::-1])
+        data = rng.integers(0, 1024, (len(numbers),) + frame_shape,
+                            dtype=np.uint16)
+        blocks.append(SimpleNamespace(header=header, data=data))
+    return blocks
+
+
+def make_counting_blocks(scan_shape=(8, 8), frame_shape=(128, 128),
+                         block_size=16, electrons_per_frame=20, seed=0):
+    """Generate raw blocks of isolated electrons over a noisy dark.
+
+    Returns: (blocks, dark, electrons), `electrons[position]` being the
+    sorted flat pixel indices of the electrons of each scan position
+    """
+    rng = np.random.default_rng(seed)
+    n_frames = scan_shape[0] * scan_shape[1]
+    rows, cols = frame_shape
+    dark = rng.normal(100, 5, frame_shape)
+
+    # Electrons on a grid 4 pixels apart, so that they are isolated
+    grid = (np.arange(2, rows - 2, 4)[:, None] * cols +
+            np.arange(2, cols - 2, 4)).ravel()
+
+    electrons = []
+    frames = np.empty((n_frames,) + tuple(frame_shape), dtype=np.uint16)
+    for i in range(n_frames):
+        frame = dark + rng.normal(0, 2, frame_shape)
+        events = np.sort(rng.choice(grid, electrons_per_frame,
+                                    replace=False))
+        frame.ravel()[events] += 24
+        frames[i] = np.clip(np.rint(frame), 0, None)
+        electrons.append(events)
+
+    blocks = []
+    for start in range(0, n_frames, block_size):
+        numbers = np.arange(start, min(start + block_size, n_frames))
+        header = SimpleNamespace(image_numbers=numbers,
+                                 scan_dimensions=scan_shape[::-1],
+                                 frame_dimensions=frame_shape[::-1])
+        blocks.append(SimpleNamespace(header=header, data=frames[numbers]))
+
+    return blocks, dark, electrons
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from stemworker import counting, sparse
+
+from datasets import make_counting_blocks
+
+SCAN_SHAPE = (8, 8)
+FRAME_SHAPE = (128, 128)
+# The electrons are 12 sigma above the noise
+BACKGROUND_N_SIGMA = 6
+XRAY_N_SIGMA = 20
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return make_counting_blocks(SCAN_SHAPE, FRAME_SHAPE)
+
+
+def test_calibration(dataset):
+    blocks, dark, _ = dataset
+    calculated = counting.calculate_dark(blocks, 1000)
+    # The electrons are a small fraction of the signal
+    assert np.abs(calculated - dark).mean() < 5
+
+    background, xray = counting.calculate_thresholds(blocks, dark)
+    assert 4 < background < xray < 30
+
+
+def test_count(dataset):
+    blocks, dark, electrons = dataset
+    background, xray = counting.calculate_thresholds(
+        blocks, dark, background_n_sigma=BACKGROUND_N_SIGMA,
+        xray_n_sigma=XRAY_N_SIGMA)
+    positions, frames, scan_shape = counting.count(blocks, dark, background,
+                                                   xray)
+
+    assert scan_shape == SCAN_SHAPE
+    assert np.array_equal(positions, np.arange(len(electrons)))
+    for i, expected in enumerate(electrons):
+        counted = frames.events[frames.offsets[i]:frames.offsets[i + 1]]
+        assert np.array_equal(counted, expected)
+
+
+def test_count_ties():
+    # Two equal neighbouring maxima are one electron
+    data = np.zeros((1, 5, 5), dtype=np.uint16)
+    data[0, 2, 1:3] = 50
+    frames = counting.count_block(data, np.zeros((5, 5)), 10, 100)
+    assert np.array_equal(frames.events, [11])
+
+
+def test_calibration_cached(dataset, tmp_path):
+    blocks, _, _ = dataset
+    path = tmp_path / 'stem0.0.bin'
+    path.write_bytes(b'')
+    opened = []
+
+    def open_reader(pattern):
+        opened.append(pattern)
+        return blocks
+
+    first = counting.calibrate(open_reader, str(path), str(path))
+    second = counting.calibrate(open_reader, str(path), str(path))
+
+    assert first is second
+    assert len(opened) == 2
+
+
+def test_write_frames(dataset, tmp_path):
+    blocks, dark, electrons = dataset
+    background, xray = counting.calculate_thresholds(
+        blocks, dark, background_n_sigma=BACKGROUND_N_SIGMA,
+        xray_n_sigma=XRAY_N_SIGMA)
+    positions, frames, scan_shape = counting.count(blocks[::-1], dark,
+                                                   background, xray)
+
+    path = str(tmp_path / 'counted.h5')
+    counting.write_frames(path, positions, frames, scan_shape, FRAME_SHAPE)
+
+    import h5py
+    with h5py.File(path, 'r') as f:
+        written = sparse.load_frames(f, 0, len(electrons))
+        assert f[sparse.FRAMES_PATH].attrs['Nx'] == FRAME_SHAPE[1]
+    for i, expected in enumerate(electrons):
+        events = written.events[written.offsets[i]:written.offsets[i + 1]]
+        assert np.array_equal(events, expected)
+
+
+def test_parts(dataset, tmp_path):
+    blocks, dark, electrons = dataset
+    background, xray = counting.calculate_thresholds(
+        blocks, dark, background_n_sigma=BACKGROUND_N_SIGMA,
+        xray_n_sigma=XRAY_N_SIGMA)
+    # The ranks write their parts, merged in the output
+    parts = []
+    for rank, rank_blocks in enumerate([blocks[::2], blocks[1::2], []]):
+        path = str(tmp_path / ('counted.h5.part%d' % rank))
+        positions, frames, _ = counting.count(rank_blocks, dark, background,
+                                              xray)
+        counting.write_part(path, positions, frames)
+        parts.append(counting.read_part(path))
+        assert np.array_equal(parts[-1][0], positions)
+        assert np.array_equal(parts[-1][1].events, frames.events)
+        assert np.array_equal(parts[-1][1].offsets, frames.offsets)
+
+    path = str(tmp_path / 'counted.h5')
+    counting.write_frames(path, np.concatenate([p for p, _ in parts]),
+                          counting.concatenate([f for _, f in parts]),
+                          SCAN_SHAPE, FRAME_SHAPE)
+
+    import h5py
+    with h5py.File(path, 'r') as f:
+        written = sparse.load_frames(f, 0, len(electrons))
+    for i, expected in enumerate(electrons):
+        events = written.events[written.offsets[i]:written.offsets[i + 1]]
+        assert np.array_equal(events, expected)
+
+
+def test_output_path(tmp_path):
+    directory = tmp_path / 'output'
+    directory.mkdir()
+    (directory / 'counted.h5').write_bytes(b'')
+    (tmp_path / 'outside').mkdir()
+    (directory / 'link').symlink_to(tmp_path / 'outside')
+
+    assert (counting.output_path(str(directory), 'new.h5') ==
+            str(directory / 'new.h5'))
+    assert (counting.output_path(str(directory), str(directory / 'new.h5')) ==
+            str(directory / 'new.h5'))
+    assert (counting.output_path(str(directory), 'counted.h5',
+                                 overwrite=True) ==
+            str(directory / 'counted.h5'))
+
+    with pytest.raises(Exception, match='already exists'):
+        counting.output_path(str(directory), 'counted.h5')
+    for path in ['../new.h5', str(tmp_path / 'new.h5'), 'link/new.h5', '',
+                 '.']:
+        with pytest.raises(Exception, match='is not in'):
+            counting.output_path(str(directory), path)
+
+
+def test_benchmark_count(benchmark, dataset):
+    blocks, dark, _ = dataset
+    background, xray = counting.calculate_thresholds(blocks, dark)
+    benchmark(counting.count, blocks, dark, background, xray)
+
+    n_frames = sum(len(b.data) for b in blocks)
+    if benchmark.stats is not None:
+        benchmark.extra_info['frames_per_second'] = (
+            n_frames / benchmark.stats.stats.mean)
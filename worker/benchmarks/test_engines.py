@@ -0,0 +1,321 @@
+import numpy as np
+import pytest
+
+from stemworker import numpy_engine, sparse
+
+from datasets import make_raw_blocks, make_sparse_frames
+
+try:
+    from stempy import image as stempy_image
+except ImportError:
+    stempy_image = None
+
+requires_stempy = pytest.mark.skipif(stempy_image is None,
+                                     reason='stempy is not installed')
+
+SCAN_SHAPE = (64, 64)
+FRAME_SHAPE = (576, 576)
+RAW_SCAN_SHAPE = (16, 16)
+RAW_FRAME_SHAPE = (128, 128)
+RADII = (40, 200)
+
+
+@pytest.fixture(scope='module')
+def sparse_frames():
+    return make_sparse_frames(SCAN_SHAPE[0] * SCAN_SHAPE[1])
+
+
+@pytest.fixture(scope='module')
+def raw_blocks():
+    return make_raw_blocks(RAW_SCAN_SHAPE, RAW_FRAME_SHAPE)
+
+
+def _sparse_kwargs(frame_offset=0):
+    return {
+        'frame_width': FRAME_SHAPE[1],
+        'frame_height': FRAME_SHAPE[0],
+        'width': SCAN_SHAPE[1],
+        'height': SCAN_SHAPE[0],
+        'frame_offset': frame_offset
+    }
+
+
+def test_annular_mask():
+    mask = numpy_engine.annular_mask((9, 11), 2, 3, center_x=4)
+    for y in range(9):
+        for x in range(11):
+            distance = (x - 4) ** 2 + (y - 4) ** 2
+            assert mask[y, x] == (4 <= distance <= 9)
+
+
+def test_stem_image_sparse(sparse_frames):
+    offset = 100
+    frames = sparse_frames[:1000]
+    stem = numpy_engine.create_stem_image_sparse(
+        frames, *RADII, **_sparse_kwargs(offset))
+
+    mask = numpy_engine.annular_mask(FRAME_SHAPE, *RADII).ravel()
+    expected = np.zeros(SCAN_SHAPE[0] * SCAN_SHAPE[1], dtype=np.uint64)
+    for i, frame in enumerate(frames):
+        expected[offset + i] = sum(mask[e] for e in frame)
+
+    assert stem.shape == SCAN_SHAPE
+    assert np.array_equal(stem.ravel(), expected)
+
+
+def test_stem_image_raw(raw_blocks):
+    stem = numpy_engine.create_stem_image(raw_blocks, 10, 40)
+
+    mask = numpy_engine.annular_mask(RAW_FRAME_SHAPE, 10, 40)
+    expected = np.zeros(RAW_SCAN_SHAPE[0] * RAW_SCAN_SHAPE[1])
+    for block in raw_blocks:
+        for number, frame in zip(block.header.image_numbers, block.data):
+            expected[number] += frame[mask].sum()
+
+    assert stem.shape == RAW_SCAN_SHAPE
+    assert np.array_equal(stem.ravel(), expected)
+
+
+def test_maximum_diffraction_raw(raw_blocks):
+    maximum = numpy_engine.maximum_diffraction_pattern(raw_blocks)
+    expected = np.max([b.data.max(axis=0) for b in raw_blocks], axis=0)
+
+    assert np.array_equal(maximum, expected)
+
+
+def test_maximum_diffraction_sparse():
+    frames = make_sparse_frames(256, frame_shape=(32, 32),
+                                events_per_frame=400)
+    maximum = numpy_engine.maximum_diffraction_pattern_sparse(frames, 32, 32)
+
+    expected = np.max([np.bincount(f, minlength=32 * 32) for f in frames],
+                      axis=0)
+
+    assert np.array_equal(maximum.ravel(), expected)
+
+
+@requires_stempy
+@pytest.mark.parametrize('offset', [0, 1000])
+def test_stem_image_sparse_stempy(sparse_frames, offset):
+    frames = sparse_frames[:2000]
+    kwargs = _sparse_kwargs(offset)
+    expected = stempy_image.create_stem_image_sparse(frames, *RADII,
+                                                     **kwargs)
+    stem = numpy_engine.create_stem_image_sparse(frames, *RADII, **kwargs)
+
+    assert np.array_equal(stem, np.asarray(expected).reshape(stem.shape))
+
+
+def test_stem_image_sparse_csr(sparse_frames):
+    csr = sparse.from_frames(sparse_frames)
+    assert np.array_equal(
+        numpy_engine.create_stem_image_sparse(csr, *RADII,
+                                              **_sparse_kwargs()),
+        numpy_engine.create_stem_image_sparse(sparse_frames, *RADII,
+                                              **_sparse_kwargs()))
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'numpy-csr', 'stempy'])
+def test_benchmark_stem_image_sparse(benchmark, sparse_frames, engine):
+    module = numpy_engine
+    if engine == 'stempy':
+        if stempy_image is None:
+            pytest.skip('stempy is not installed')
+        module = stempy_image
+    elif engine == 'numpy-csr':
+        # The frames as loaded by the worker for the numpy engine
+        sparse_frames = sparse.from_frames(sparse_frames)
+
+    benchmark(module.create_stem_image_sparse, sparse_frames, *RADII,
+              **_sparse_kwargs())
+
+
+def test_benchmark_stem_image_raw(benchmark, raw_blocks):
+    benchmark(numpy_engine.create_stem_image, raw_blocks, 10, 40)
+
+
+def test_benchmark_maximum_diffraction_raw(benchmark, raw_blocks):
+    benchmark(numpy_engine.maximum_diffraction_pattern, raw_blocks)
+
+
+def test_benchmark_maximum_diffraction_sparse(benchmark, sparse_frames):
+    benchmark(numpy_engine.maximum_diffraction_pattern_sparse,
+              sparse_frames, FRAME_SHAPE[1], FRAME_SHAPE[0])
+
+
+def _reference_radial_profiles(frames_by_position, frame_shape, scan_shape,
+                               center, regions):
+    """Radial profiles from the dense frames, one pixel at a time"""
+    rows, cols = frame_shape
+    n_regions = regions[0] * regions[1]
+    sums = np.zeros((n_regions + 1, int(np.hypot(rows, cols)) + 1))
+    pixels = np.zeros(sums.shape[1])
+    positions = np.zeros(n_regions + 1)
+    for y in range(rows):
+        for x in range(cols):
+            pixels[int(np.hypot(x - center[0], y - center[1]))] += 1
+
+    for position, frame in frames_by_position.items():
+        sy, sx = divmod(position, scan_shape[1])
+        region = 1 + ((sy * regions[1] // scan_shape[0]) * regions[0] +
+                      sx * regions[0] // scan_shape[1])
+        for y in range(rows):
+            for x in range(cols):
+                r = int(np.hypot(x - center[0], y - center[1]))
+                sums[0, r] += frame[y, x]
+                sums[region, r] += frame[y, x]
+
+    for position in range(scan_shape[0] * scan_shape[1]):
+        sy, sx = divmod(position, scan_shape[1])
+        positions[1 + (sy * regions[1] // scan_shape[0]) * regions[0] +
+                  sx * regions[0] // scan_shape[1]] += 1
+    positions[0] = scan_shape[0] * scan_shape[1]
+
+    n_bins = int(np.flatnonzero(pixels)[-1]) + 1
+    return sums[:, :n_bins] / pixels[:n_bins] / positions[:, None]
+
+
+def test_radial_profile_sparse():
+    frame_shape = (12, 16)
+    scan_shape = (4, 6)
+    frames = make_sparse_frames(20, frame_shape, events_per_frame=30)
+    offset = 3
+
+    profiles = numpy_engine.radial_profile_sparse(
+        frames, frame_shape[1], frame_shape[0], scan_shape[1], scan_shape[0],
+        center_x=5, center_y=7, regions_x=3, regions_y=2, frame_offset=offset)
+
+    dense = {offset + i: np.bincount(f, minlength=frame_shape[0] *
+                                     frame_shape[1]).reshape(frame_shape)
+             for i, f in enumerate(frames)}
+    expected = _reference_radial_profiles(dense, frame_shape, scan_shape,
+                                          (5, 7), (3, 2))
+
+    assert profiles.shape == expected.shape
+    assert np.allclose(profiles, expected)
+
+
+def test_radial_profile_raw():
+    scan_shape = (4, 4)
+    frame_shape = (10, 10)
+    blocks = make_raw_blocks(scan_shape, frame_shape, block_size=5)
+    profiles = numpy_engine.radial_profile(blocks, regions_x=2, regions_y=2)
+
+    dense = {n: frame for b in blocks
+             for n, frame in zip(b.header.image_numbers, b.data)}
+    expected = _reference_radial_profiles(dense, frame_shape, scan_shape,
+                                          (5, 5), (2, 2))
+
+    assert np.allclose(profiles, expected)
+
+
+def test_radial_profile_ranks(sparse_frames):
+    """The profiles of the frames of each rank add up"""
+    kwargs = {
+        'frame_width': FRAME_SHAPE[1],
+        'frame_height': FRAME_SHAPE[0],
+        'width': SCAN_SHAPE[1],
+        'height': SCAN_SHAPE[0],
+        'regions_x': 2,
+        'regions_y': 2
+    }
+    profiles = numpy_engine.radial_profile_sparse(sparse_frames, **kwargs)
+    split = 1500
+    ranks = (numpy_engine.radial_profile_sparse(sparse_frames[:split],
+                                                **kwargs) +
+             numpy_engine.radial_profile_sparse(sparse_frames[split:],
+                                                frame_offset=split, **kwargs))
+
+    assert np.allclose(profiles, ranks)
+
+
+def test_benchmark_radial_profile_sparse(benchmark, sparse_frames):
+    frames = sparse.from_frames(sparse_frames)
+    benchmark(numpy_engine.radial_profile_sparse, frames, FRAME_SHAPE[1],
+              FRAME_SHAPE[0], SCAN_SHAPE[1], SCAN_SHAPE[0], regions_x=4,
+              regions_y=4)
+
+
+def test_benchmark_radial_profile_raw(benchmark, raw_blocks):
+    benchmark(numpy_engine.radial_profile, raw_blocks, regions_x=4,
+              regions_y=4)
+
+
+def _reference_center_of_mass(frame, center):
+    total = frame.sum()
+    if total == 0:
+        return 0, 0
+    y, x = np.indices(frame.shape)
+    return ((x * frame).sum() / total - center[0],
+            (y * frame).sum() / total - center[1])
+
+
+def test_center_of_mass_sparse():
+    frame_shape = (12, 16)
+    scan_shape = (4, 6)
+    frames = make_sparse_frames(20, frame_shape, events_per_frame=5)
+    frames[4] = np.zeros(0, dtype=np.uint32)
+    offset = 2
+
+    com = numpy_engine.center_of_mass_sparse(
+        frames, frame_shape[1], frame_shape[0], scan_shape[1], scan_shape[0],
+        center_x=5, frame_offset=offset)
+
+    expected = np.zeros((2, scan_shape[0] * scan_shape[1]))
+    for i, f in enumerate(frames):
+        dense = np.bincount(f, minlength=frame_shape[0] * frame_shape[1])
+        expected[:, offset + i] = _reference_center_of_mass(
+            dense.reshape(frame_shape), (5, frame_shape[0] // 2))
+
+    assert np.allclose(com.reshape((2, -1)), expected)
+
+
+def test_center_of_mass_sparse_blocks(sparse_frames):
+    kwargs = _sparse_kwargs()
+    del kwargs['frame_offset']
+    com = numpy_engine.center_of_mass_sparse(sparse_frames, **kwargs)
+
+    out = np.zeros_like(com)
+    for start in range(0, len(sparse_frames), 1000):
+        block = sparse.from_frames(sparse_frames[start:start + 1000], start)
+        numpy_engine.center_of_mass_sparse(
+            block, frame_offset=block.frame_offset, out=out, **kwargs)
+
+    assert np.array_equal(com, out)
+
+
+def test_center_of_mass_raw():
+    scan_shape = (4, 4)
+    frame_shape = (10, 12)
+    blocks = make_raw_blocks(scan_shape, frame_shape, block_size=5)
+    com = numpy_engine.center_of_mass(blocks, center_y=3)
+
+    expected = np.zeros((2, scan_shape[0] * scan_shape[1]))
+    for b in blocks:
+        for n, frame in zip(b.header.image_numbers, b.data):
+            expected[:, n] = _reference_center_of_mass(frame, (6, 3))
+
+    assert np.allclose(com.reshape((2, -1)), expected)
+
+
+def test_integrate_phase():
+    y, x = np.mgrid[:32, :48]
+    kx, ky = 2 * np.pi / 48, 2 * np.pi * 2 / 32
+    phase = np.sin(kx * x) * np.cos(ky * y)
+    com_x = kx * np.cos(kx * x) * np.cos(ky * y)
+    com_y = -ky * np.sin(kx * x) * np.sin(ky * y)
+
+    integrated = numpy_engine.integrate_phase(com_x, com_y)
+
+    assert np.allclose(integrated, phase - phase.mean(), atol=1e-2)
+
+
+def test_benchmark_center_of_mass_sparse(benchmark, sparse_frames):
+    frames = sparse.from_frames(sparse_frames)
+    kwargs = _sparse_kwargs()
+    del kwargs['frame_offset']
+    benchmark(numpy_engine.center_of_mass_sparse, frames, **kwargs)
+
+
+def test_benchmark_center_of_mass_raw(benchmark, raw_blocks):
+    benchmark(numpy_engine.center_of_mass, raw_blocks)
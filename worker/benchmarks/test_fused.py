@@ -0,0 +1,106 @@
+import h5py
+import numpy as np
+import pytest
+
+from stemworker import numpy_engine, sparse
+from stemworker.pipelines import Consumer, execute_fused
+
+from datasets import make_raw_blocks, make_sparse_frames
+
+SCAN_SHAPE = (32, 32)
+FRAME_SHAPE = (128, 128)
+
+
+@pytest.fixture(scope='module')
+def electron_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'electron.h5')
+    frames = make_sparse_frames(SCAN_SHAPE[0] * SCAN_SHAPE[1], FRAME_SHAPE)
+    with h5py.File(path, 'w') as f:
+        dataset = f.create_dataset(sparse.FRAMES_PATH, (len(frames),),
+                                   dtype=h5py.vlen_dtype(np.uint32))
+        dataset[...] = frames
+        dataset.attrs['Nx'] = FRAME_SHAPE[1]
+        dataset.attrs['Ny'] = FRAME_SHAPE[0]
+    return path, frames
+
+
+def _sparse_consumers():
+    kwargs = {
+        'frame_width': FRAME_SHAPE[1],
+        'frame_height': FRAME_SHAPE[0],
+        'width': SCAN_SHAPE[1],
+        'height': SCAN_SHAPE[0]
+    }
+    return [
+        Consumer(lambda f: numpy_engine.create_stem_image_sparse(
+            f, 10, 40, frame_offset=f.frame_offset, **kwargs)),
+        Consumer(lambda f: numpy_engine.maximum_diffraction_pattern_sparse(
+            f, FRAME_SHAPE[1], FRAME_SHAPE[0]), combine=np.maximum),
+        Consumer(lambda f: numpy_engine.radial_profile_sparse(
+            f, regions_x=2, regions_y=2, frame_offset=f.frame_offset,
+            **kwargs)),
+        Consumer(lambda f: numpy_engine.center_of_mass_sparse(
+            f, frame_offset=f.frame_offset, **kwargs))
+    ]
+
+
+def _separate_sparse(frames):
+    kwargs = {
+        'frame_width': FRAME_SHAPE[1],
+        'frame_height': FRAME_SHAPE[0],
+        'width': SCAN_SHAPE[1],
+        'height': SCAN_SHAPE[0]
+    }
+    return [
+        numpy_engine.create_stem_image_sparse(frames, 10, 40, **kwargs),
+        numpy_engine.maximum_diffraction_pattern_sparse(
+            frames, FRAME_SHAPE[1], FRAME_SHAPE[0]),
+        numpy_engine.radial_profile_sparse(frames, regions_x=2, regions_y=2,
+                                           **kwargs),
+        numpy_engine.center_of_mass_sparse(frames, **kwargs)
+    ]
+
+
+def test_fused_sparse(electron_file):
+    path, frames = electron_file
+    with h5py.File(path, 'r') as f:
+        # In several blocks
+        results = execute_fused(f, _sparse_consumers(), block_size=300)
+
+    for result, expected in zip(results, _separate_sparse(frames)):
+        assert np.allclose(result, expected)
+
+
+def test_fused_raw():
+    blocks = make_raw_blocks((8, 8), (32, 32), block_size=10)
+    consumers = [
+        Consumer(lambda b: numpy_engine.create_stem_image([b], 4, 12)),
+        Consumer(lambda b: numpy_engine.maximum_diffraction_pattern([b]),
+                 combine=np.maximum),
+        Consumer(lambda b: numpy_engine.radial_profile([b], regions_x=2)),
+        Consumer(lambda b: numpy_engine.center_of_mass([b]))
+    ]
+    results = execute_fused(iter(blocks), consumers)
+
+    expected = [
+        numpy_engine.create_stem_image(blocks, 4, 12),
+        numpy_engine.maximum_diffraction_pattern(blocks),
+        numpy_engine.radial_profile(blocks, regions_x=2),
+        numpy_engine.center_of_mass(blocks)
+    ]
+    for result, e in zip(results, expected):
+        assert np.allclose(result, e)
+
+
+def test_benchmark_fused(benchmark, electron_file):
+    path, _ = electron_file
+    with h5py.File(path, 'r') as f:
+        benchmark(lambda: execute_fused(f, _sparse_consumers()))
+
+
+def test_benchmark_separate(benchmark, electron_file):
+    """Each pipeline reading the data, for comparison with the fused pass"""
+    path, _ = electron_file
+    with h5py.File(path, 'r') as f:
+        benchmark(lambda: [execute_fused(f, [c])
+                           for c in _sparse_consumers()])
@@ -0,0 +1,45 @@
+import importlib
+
+import pytest
+
+from stemworker import get_pipeline_info
+from stemworker.pipelines import pipeline, parameter, PipelineAggregation
+
+PIPELINES = {
+    'annular': 'annular_mask',
+    'maximum_diffraction': 'maximum_diffraction',
+    'electron_count': 'electron_count',
+    'radial_profile': 'radial_profile',
+    'center_of_mass': 'center_of_mass'
+}
+
+
+def _load(module):
+    return importlib.import_module('stemworker.pipelines.' + module).execute
+
+
+@pytest.mark.parametrize('name', sorted(PIPELINES))
+def test_pipeline_info(name):
+    # The pipelines are described also without the stempy build
+    info = get_pipeline_info(name, {name: _load(PIPELINES[name])})
+
+    assert info['name'] == name
+    assert info['displayName']
+    assert info['input'] in ('frame', 'image')
+    assert info['output'] in ('frame', 'image')
+    assert 'version' in info['parameters']
+    for parameter in info['parameters'].values():
+        assert set(parameter) == {'type', 'label', 'description', 'default'}
+
+
+def test_parameter_defaults():
+    @pipeline('Test', 'Returns its parameters')
+    @parameter('size', type='integer', default=1)
+    def execute(reader, **params):
+        return params
+
+    assert execute.NAME == 'Test'
+    assert execute.AGGREGATION == PipelineAggregation.SUM
+    assert execute.PARAMETERS['size']['default'] == 1
+    assert execute(None) == {'size': 1}
+    assert execute(None, size=2) == {'size': 2}
@@ -0,0 +1,91 @@
+import h5py
+import numpy as np
+import pytest
+
+from stemworker import sparse
+
+from datasets import make_sparse_frames
+
+N_FRAMES = 4096
+
+
+@pytest.fixture(scope='module')
+def electron_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'electron.h5')
+    frames = make_sparse_frames(N_FRAMES)
+    # Some frames have no events
+    frames[::7] = [np.zeros(0, dtype=np.uint32)] * len(frames[::7])
+    with h5py.File(path, 'w') as f:
+        dataset = f.create_dataset(sparse.FRAMES_PATH, (N_FRAMES,),
+                                   dtype=h5py.vlen_dtype(np.uint32))
+        dataset[...] = frames
+    return path, frames
+
+
+@pytest.mark.parametrize('start,stop,block_size', [
+    (0, N_FRAMES, sparse.BLOCK_SIZE),
+    (100, 3000, 512),
+    (7, 8, 512),
+    (10, 10, 512)
+])
+def test_read_frames(electron_file, start, stop, block_size):
+    path, expected = electron_file
+    with h5py.File(path, 'r') as f:
+        frames = sparse.read_frames(f[sparse.FRAMES_PATH], start, stop,
+                                    block_size)
+
+    assert len(frames) == stop - start
+    assert frames.frame_offset == start
+    assert frames.offsets.dtype == np.int64
+    for i, events in enumerate(expected[start:stop]):
+        actual = frames.events[frames.offsets[i]:frames.offsets[i + 1]]
+        assert np.array_equal(actual, events)
+
+
+def test_load_frames_cached(electron_file):
+    path, _ = electron_file
+    with h5py.File(path, 'r') as f:
+        frames = sparse.load_frames(f, 0, 1024)
+        assert sparse.load_frames(f, 0, 1024) is frames
+        assert sparse.load_frames(f, 0, 2048) is not frames
+
+
+def test_iter_frames(electron_file):
+    path, expected = electron_file
+    with h5py.File(path, 'r') as f:
+        blocks = list(sparse.iter_frames(f, 100, 3000, block_size=1000))
+        assert [len(b) for b in blocks] == [1000, 1000, 900]
+        for block in blocks:
+            for i, events in enumerate(
+                    expected[block.frame_offset:
+                             block.frame_offset + len(block)]):
+                actual = block.events[block.offsets[i]:block.offsets[i + 1]]
+                assert np.array_equal(actual, events)
+
+        # The frames loaded already are used as they are
+        frames = sparse.load_frames(f, 100, 3000)
+        assert list(sparse.iter_frames(f, 100, 3000)) == [frames]
+
+
+def test_cache_bounded():
+    frames = sparse.from_frames(make_sparse_frames(16))
+    cache = sparse.SparseFramesCache(frames.nbytes * 2)
+    for key in range(3):
+        cache.set(key, frames)
+
+    assert cache.get(0) is None
+    assert cache.get(1) is frames and cache.get(2) is frames
+
+
+def test_benchmark_read_frames(benchmark, electron_file):
+    path, _ = electron_file
+    with h5py.File(path, 'r') as f:
+        benchmark(sparse.read_frames, f[sparse.FRAMES_PATH], 0, N_FRAMES)
+
+
+def test_benchmark_read_per_frame(benchmark, electron_file):
+    """Reading frame by frame, for comparison with the bulk reads"""
+    path, _ = electron_file
+    with h5py.File(path, 'r') as f:
+        dataset = f[sparse.FRAMES_PATH]
+        benchmark(lambda: [dataset[i] for i in range(N_FRAMES)])
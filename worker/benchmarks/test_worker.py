@@ -0,0 +1,171 @@
+import asyncio
+
+import h5py
+import msgpack
+import numpy as np
+import pytest
+
+import stemworker
+from stemworker import numpy_engine, sparse
+from stemworker import socketio as worker_socketio
+from stemworker.pipelines import PipelineAggregation, center_of_mass
+from stemworker.socketio.constants import FileFormat
+
+from datasets import make_sparse_frames
+
+SCAN_SHAPE = (8, 8)
+FRAME_SHAPE = (32, 32)
+
+
+@pytest.fixture(scope='module')
+def electron_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'electron.h5')
+    frames = make_sparse_frames(SCAN_SHAPE[0] * SCAN_SHAPE[1], FRAME_SHAPE,
+                                events_per_frame=20)
+    with h5py.File(path, 'w') as f:
+        dataset = f.create_dataset(sparse.FRAMES_PATH, (len(frames),),
+                                   dtype=h5py.vlen_dtype(np.uint32))
+        dataset[...] = frames
+        dataset.attrs['Nx'] = FRAME_SHAPE[1]
+        dataset.attrs['Ny'] = FRAME_SHAPE[0]
+        scans = f.create_dataset('/electron_events/scan_positions',
+                                 data=np.arange(len(frames)))
+        scans.attrs['Nx'] = SCAN_SHAPE[1]
+        scans.attrs['Ny'] = SCAN_SHAPE[0]
+    return path, frames
+
+
+class FakeClient(object):
+    """Stands for the socket.io connection of the worker to the server"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.emitted = []
+
+    def on(self, event, namespace=None):
+        def decorator(handler):
+            self.handlers[event] = handler
+            return handler
+        return decorator
+
+    async def emit(self, event, namespace=None, data=None):
+        if event == 'stem.pipeline.executed':
+            data = msgpack.unpackb(data, raw=False)
+        self.emitted.append((event, data))
+
+    async def connect(self, url, **kwargs):
+        pass
+
+    def messages(self, event):
+        return [data for name, data in self.emitted if name == event]
+
+    async def wait_for(self, event, count):
+        for _ in range(1000):
+            if len(self.messages(event)) >= count:
+                return self.messages(event)
+            await asyncio.sleep(0.01)
+        raise Exception('Timed out waiting for %s' % event)
+
+
+def run_worker(monkeypatch, pipelines, interact):
+    """Run the worker with a fake connection, until `interact(client)` is
+    done"""
+    client = FakeClient()
+    monkeypatch.setattr(worker_socketio.socketio, 'AsyncClient',
+                        lambda: client)
+    for name, execute in pipelines.items():
+        monkeypatch.setitem(stemworker._pipelines, name, execute)
+
+    async def run():
+        worker = asyncio.ensure_future(worker_socketio.connect(
+            pipelines, 'worker', 'http://localhost', ''))
+        # Let the worker connect
+        await asyncio.sleep(0)
+        try:
+            await interact(client)
+        finally:
+            worker.cancel()
+
+    asyncio.run(run())
+    return client
+
+
+def _execute_com(client, pipeline_id, path, correlation_id=None, **params):
+    params.update({'format': FileFormat.H5, 'path': path})
+    message = {
+        'workerId': 'worker',
+        'pipelineId': pipeline_id,
+        'params': params
+    }
+    if correlation_id is not None:
+        message['correlationId'] = correlation_id
+    return client.handlers['stem.pipeline.execute'](message)
+
+
+async def _create_com(client):
+    await client.handlers['stem.pipeline.create'](
+        {'id': 'client', 'workerId': 'worker', 'name': 'center_of_mass'})
+    created, = await client.wait_for('stem.pipeline.created', 1)
+    return created['pipelineId']
+
+
+def test_aggregated_results(monkeypatch, electron_file):
+    path, frames = electron_file
+    n_executions = 3
+
+    async def interact(client):
+        pipeline_id = await _create_com(client)
+        for i in range(n_executions):
+            await _execute_com(client, pipeline_id, path,
+                               correlation_id=str(i), phase=1)
+        await client.wait_for('stem.pipeline.completed', n_executions)
+
+    client = run_worker(monkeypatch, {'center_of_mass': center_of_mass.execute},
+                        interact)
+
+    # A single, finished result per execution
+    executed = client.messages('stem.pipeline.executed')
+    assert sorted(r['correlationId'] for r in executed) == ['0', '1', '2']
+    com = numpy_engine.center_of_mass_sparse(
+        frames, FRAME_SHAPE[1], FRAME_SHAPE[0], SCAN_SHAPE[1], SCAN_SHAPE[0])
+    for r in executed:
+        assert r['info']['aggregation'] == PipelineAggregation.NONE
+        result = np.array(r['result'])
+        assert result.shape == (3,) + SCAN_SHAPE
+        assert np.allclose(result[:2], com)
+        assert np.allclose(result[2], numpy_engine.integrate_phase(*com))
+    for r in client.messages('stem.pipeline.completed'):
+        assert 'error' not in r
+
+
+def test_executions_without_correlation_id(monkeypatch, electron_file):
+    path, _ = electron_file
+
+    async def interact(client):
+        pipeline_id = await _create_com(client)
+        # Sent together, with nothing to tell them apart
+        await _execute_com(client, pipeline_id, path)
+        await _execute_com(client, pipeline_id, path)
+        await client.wait_for('stem.pipeline.completed', 2)
+
+    client = run_worker(monkeypatch, {'center_of_mass': center_of_mass.execute},
+                        interact)
+
+    assert len(client.messages('stem.pipeline.executed')) == 2
+    assert len(client.messages('stem.pipeline.completed')) == 2
+
+
+def test_lone_execution_does_not_wait(monkeypatch, electron_file):
+    path, _ = electron_file
+    # Longer than the test waits for the result
+    monkeypatch.setattr(worker_socketio, 'FUSE_WINDOW', 60)
+
+    async def interact(client):
+        pipeline_id = await _create_com(client)
+        await _execute_com(client, pipeline_id, path, correlation_id='0')
+        await client.wait_for('stem.pipeline.completed', 1)
+
+    client = run_worker(monkeypatch, {'center_of_mass': center_of_mass.execute},
+                        interact)
+
+    assert len(client.messages('stem.pipeline.executed')) == 1
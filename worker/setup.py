@@ -13,7 +13,9 @@ setup(
         'mpi4py',
         'stevedore',
         'coloredlogs',
-        'msgpack'
+        'msgpack',
+        'numpy',
+        'h5py'
     ],
     entry_points= {
         'console_scripts': [
@@ -21,7 +23,10 @@ setup(
         ],
         'stempy.pipeline': [
             'annular = stemworker.pipelines.annular_mask:execute',
-            'maximum_diffraction = stemworker.pipelines.maximum_diffraction:execute'
+            'maximum_diffraction = stemworker.pipelines.maximum_diffraction:execute',
+            'electron_count = stemworker.pipelines.electron_count:execute',
+            'radial_profile = stemworker.pipelines.radial_profile:execute',
+            'center_of_mass = stemworker.pipelines.center_of_mass:execute'
         ]
     }
 )
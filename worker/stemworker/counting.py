@@ -0,0 +1,294 @@
+"""Electron counting of raw frames.
+
+The frames are dark subtracted, and the pixels above the background
+threshold and below the X-ray threshold that are a local maximum of their
+3x3 neighbourhood are counted as electron events. The dark reference and
+the thresholds are calibrated once per dataset from a sample of frames
+(see `calibrate`).
+"""
+from collections import OrderedDict
+import glob
+import os
+import threading
+
+import h5py
+import numpy as np
+
+from stemworker import sparse
+
+# The number of histogram bins used to estimate the background
+HISTOGRAM_BINS = 1024
+
+# The neighbours of a pixel, as (row, column) shifts. The neighbours
+# before the pixel in raster order have to be strictly lower, so that
+# only one of two equal neighbouring maxima is counted.
+_NEIGHBOURS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+               if (dy, dx) != (0, 0)]
+
+
+def _frames(blocks, max_frames):
+    """Yield the data of `blocks` up to `max_frames` frames"""
+    remaining = max_frames
+    for block in blocks:
+        if remaining <= 0:
+            break
+        data = block.data[:remaining]
+        remaining -= len(data)
+        yield data
+
+
+def calculate_dark(blocks, max_frames=1000):
+    """Get the mean frame of up to `max_frames` frames"""
+    total = None
+    n_frames = 0
+    for data in _frames(blocks, max_frames):
+        block_total = data.sum(axis=0, dtype=np.float64)
+        total = block_total if total is None else total + block_total
+        n_frames += len(data)
+
+    if total is None:
+        raise Exception('No frames to calculate the dark reference from.')
+
+    return total / n_frames
+
+
+def _clipped_gaussian(centers, weights, n_sigma=3, iterations=5):
+    """Estimate the mean and standard deviation of the main peak of a
+    histogram, iteratively ignoring the bins beyond `n_sigma`"""
+    keep = weights > 0
+    for _ in range(iterations):
+        w = weights * keep
+        mean = np.average(centers, weights=w)
+        std = np.sqrt(np.average((centers - mean) ** 2, weights=w))
+        keep = np.abs(centers - mean) <= n_sigma * max(std, 1e-12)
+        if not (keep & (weights > 0)).any():
+            break
+
+    return mean, std
+
+
+def calculate_thresholds(blocks, dark, max_frames=20,
+                         background_n_sigma=4, xray_n_sigma=10):
+    """Calibrate the background and X-ray thresholds.
+
+    A gaussian is fitted to the histogram of the dark subtracted values of
+    up to `max_frames` frames, the thresholds are `n_sigma` standard
+    deviations above its mean.
+
+    Returns: (background_threshold, xray_threshold)
+    """
+    dark = np.asarray(dark, dtype=np.float32)
+    samples = [(data.astype(np.float32) - dark).ravel()
+               for data in _frames(blocks, max_frames)]
+    if not samples:
+        raise Exception('No frames to calculate the thresholds from.')
+    samples = np.concatenate(samples)
+
+    weights, edges = np.histogram(samples, bins=HISTOGRAM_BINS)
+    centers = (edges[:-1] + edges[1:]) / 2
+    mean, std = _clipped_gaussian(centers, weights.astype(np.float64))
+
+    return (mean + background_n_sigma * std, mean + xray_n_sigma * std)
+
+
+def count_block(data, dark, background_threshold, xray_threshold):
+    """Count the electrons of a block of frames, of shape (n, rows, cols).
+
+    Returns: `sparse.SparseFrames` of the flat pixel indices of the events
+    """
+    frames = data.astype(np.float32) - np.asarray(dark, dtype=np.float32)
+    candidates = (frames > background_threshold) & (frames < xray_threshold)
+
+    padded = np.pad(frames, ((0, 0), (1, 1), (1, 1)),
+                    constant_values=-np.inf)
+    rows, cols = frames.shape[1:]
+    for dy, dx in _NEIGHBOURS:
+        neighbour = padded[:, 1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+        if (dy, dx) < (0, 0):
+            candidates &= frames > neighbour
+        else:
+            candidates &= frames >= neighbour
+
+    ids, pixels = np.nonzero(candidates.reshape((len(frames), -1)))
+    offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=len(frames)), out=offsets[1:])
+
+    return sparse.SparseFrames(pixels.astype(np.uint32), offsets)
+
+
+def count(blocks, dark, background_threshold, xray_threshold):
+    """Count the electrons of the frames of `blocks`.
+
+    Returns: (scan positions, `sparse.SparseFrames`, scan shape) of the
+    counted frames, the scan shape being (rows, columns)
+    """
+    dark = np.asarray(dark, dtype=np.float32)
+    positions = []
+    counted = []
+    scan_shape = None
+    for block in blocks:
+        width, height = block.header.scan_dimensions
+        scan_shape = (height, width)
+        positions.append(np.asarray(block.header.image_numbers,
+                                    dtype=np.int64))
+        counted.append(count_block(block.data, dark, background_threshold,
+                                   xray_threshold))
+
+    positions = (np.concatenate(positions) if positions
+                 else np.zeros(0, dtype=np.int64))
+
+    return positions, concatenate(counted), scan_shape
+
+
+def concatenate(frames):
+    """Concatenate a list of `sparse.SparseFrames`"""
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    for f in frames:
+        offsets.append(f.offsets[1:] + total)
+        total += f.offsets[-1]
+
+    events = [f.events for f in frames]
+    events = (np.concatenate(events) if events
+              else np.zeros(0, dtype=np.uint32))
+
+    return sparse.SparseFrames(events, np.concatenate(offsets))
+
+
+def file_identity(pattern):
+    """Identify the files matching `pattern` by path, size and mtime"""
+    identity = []
+    for path in sorted(glob.glob(pattern)):
+        stat = os.stat(path)
+        identity.append((os.path.realpath(path), stat.st_size,
+                         stat.st_mtime_ns))
+
+    return tuple(identity)
+
+
+class CalibrationCache(object):
+    """A small LRU cache of the calibration of datasets"""
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            calibration = self._entries.get(key)
+            if calibration is not None:
+                self._entries.move_to_end(key)
+                return calibration
+
+        calibration = compute()
+
+        with self._lock:
+            self._entries[key] = calibration
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return calibration
+
+
+calibration_cache = CalibrationCache()
+
+
+def calibrate(open_reader, dark_pattern, data_pattern, dark_frames=1000,
+              threshold_frames=20, background_n_sigma=4, xray_n_sigma=10):
+    """Get the (dark, background_threshold, xray_threshold) of a dataset.
+
+    `open_reader(pattern)` opens a stempy reader on the files matching a
+    glob pattern. The dark reference is the mean of the first `dark_frames`
+    frames of the files matching `dark_pattern`, the thresholds are
+    calibrated on the first `threshold_frames` frames of the files matching
+    `data_pattern`. The result is cached by the identity of the
+    files and the parameters, so it is computed once per dataset.
+    """
+    key = (file_identity(dark_pattern), file_identity(data_pattern),
+           dark_frames, threshold_frames, background_n_sigma, xray_n_sigma)
+
+    def compute():
+        dark = calculate_dark(open_reader(dark_pattern), dark_frames)
+        thresholds = calculate_thresholds(
+            open_reader(data_pattern), dark, threshold_frames,
+            background_n_sigma, xray_n_sigma)
+        return (dark,) + thresholds
+
+    return calibration_cache.get_or_compute(key, compute)
+
+
+def output_path(directory, path, overwrite=False):
+    """Resolve the path of an output file, which must be in `directory`.
+
+    `path` is relative to `directory`, or absolute. Raises if it is outside
+    of `directory` (e.g. through '..' or a symbolic link), or if the file
+    exists and `overwrite` is false.
+    """
+    directory = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if (resolved == directory or
+            os.path.commonpath([directory, resolved]) != directory):
+        raise Exception('The output path %s is not in %s' % (path, directory))
+    if os.path.exists(resolved) and not overwrite:
+        raise Exception('%s already exists' % resolved)
+
+    return resolved
+
+
+def write_part(path, positions, frames):
+    """Write the counted frames of a rank, see `read_part`"""
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('positions', data=positions)
+        f.create_dataset('events', data=frames.events)
+        f.create_dataset('offsets', data=frames.offsets)
+
+
+def read_part(path):
+    """Read the (scan positions, `sparse.SparseFrames`) written by
+    `write_part`"""
+    with h5py.File(path, 'r') as f:
+        return f['positions'][()], sparse.SparseFrames(f['events'][()],
+                                                       f['offsets'][()])
+
+
+def write_frames(path, positions, frames, scan_shape, frame_shape, attrs=None):
+    """Write counted frames in the electron_events layout.
+
+    The frames are written in scan order, one per scan position, as the
+    sparse pipelines and the stemserver plugin expect. `scan_shape` and
+    `frame_shape` are (rows, columns).
+    """
+    n_positions = scan_shape[0] * scan_shape[1]
+    per_position = np.empty(n_positions, dtype=object)
+    for i, position in enumerate(positions):
+        events = frames.events[frames.offsets[i]:frames.offsets[i + 1]]
+        if per_position[position] is not None:
+            # A position with more than one frame, keep all of its events
+            events = np.concatenate([per_position[position], events])
+        per_position[position] = events
+
+    empty = np.zeros(0, dtype=np.uint32)
+    for position, events in enumerate(per_position):
+        if events is None:
+            per_position[position] = empty
+
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as f:
+        group = f.create_group('electron_events')
+        dataset = group.create_dataset('frames', (n_positions,),
+                                       dtype=h5py.vlen_dtype(np.uint32))
+        # Not dataset[...], which broadcasts frames of equal length as a
+        # 2D array
+        dataset.write_direct(per_position)
+        dataset.attrs['Nx'] = frame_shape[1]
+        dataset.attrs['Ny'] = frame_shape[0]
+
+        scan_positions = group.create_dataset(
+            'scan_positions', data=np.arange(n_positions, dtype=np.uint32))
+        scan_positions.attrs['Nx'] = scan_shape[1]
+        scan_positions.attrs['Ny'] = scan_shape[0]
+
+        for name, value in (attrs or {}).items():
+            group.attrs[name] = value
+    os.replace(tmp_path, path)
@@ -0,0 +1,334 @@
+"""Vectorized NumPy implementations of the pipeline computations.
+
+These mirror the compiled `stempy.image` functions used by the pipelines,
+so they can run on nodes without the stempy build and serve as an
+independent implementation to cross-check results against. Raw data is
+still read through the stempy reader blocks (`block.header.image_numbers`,
+`block.header.scan_dimensions` and `block.data`).
+"""
+import functools
+
+import numpy as np
+
+from stemworker import sparse
+
+
+@functools.lru_cache(maxsize=16)
+def annular_mask(frame_shape, inner_radius, outer_radius, center_x=-1,
+                 center_y=-1):
+    """Get the boolean annular mask of a frame of shape (rows, columns).
+
+    As in stempy, a negative center defaults to the middle of the frame
+    and the pixels at a distance between the radii (inclusive) are set.
+    The masks are cached, so they are read-only.
+    """
+    rows, columns = frame_shape
+    if center_x < 0:
+        center_x = columns // 2
+    if center_y < 0:
+        center_y = rows // 2
+
+    y, x = np.ogrid[:rows, :columns]
+    distance = (x - center_x) ** 2 + (y - center_y) ** 2
+
+    mask = ((distance >= inner_radius ** 2) &
+            (distance <= outer_radius ** 2))
+    mask.setflags(write=False)
+
+    return mask
+
+
+def create_stem_image_sparse(frames, inner_radius, outer_radius, frame_width,
+                             frame_height, width, height, center_x=-1,
+                             center_y=-1, frame_offset=0):
+    """Count the events of each sparse frame inside the annular mask.
+
+    `frames` holds the pixel indices of the events of each frame, either
+    as a sequence of arrays or as `sparse.SparseFrames`, frame `i` being at
+    scan position `frame_offset + i`.
+
+    Returns: the stem image, of shape (height, width)
+    """
+    mask = annular_mask((frame_height, frame_width), inner_radius,
+                        outer_radius, center_x, center_y).ravel()
+
+    frames = sparse.from_frames(frames)
+    counts = frames.sum_per_frame(mask[frames.events])
+
+    stem = np.zeros(width * height, dtype=np.uint64)
+    stem[frame_offset:frame_offset + len(frames)] = counts
+
+    return stem.reshape((height, width))
+
+
+def create_stem_image(reader, inner_radius, outer_radius, center_x=-1,
+                      center_y=-1):
+    """Sum the intensity of each raw frame inside the annular mask.
+
+    Returns: the stem image, of shape (height, width) of the scan
+    """
+    stem = None
+    indices = None
+    for block in reader:
+        data = block.data
+        if stem is None:
+            width, height = block.header.scan_dimensions
+            stem = np.zeros(width * height, dtype=np.uint64)
+            mask = annular_mask(data.shape[1:], inner_radius, outer_radius,
+                                center_x, center_y)
+            indices = np.flatnonzero(mask)
+
+        values = data.reshape((len(data), -1))[:, indices].sum(
+            axis=1, dtype=np.uint64)
+        np.add.at(stem, np.asarray(block.header.image_numbers,
+                                   dtype=np.int64), values)
+
+    if stem is None:
+        return np.zeros((0, 0), dtype=np.uint64)
+
+    return stem.reshape((height, width))
+
+
+def maximum_diffraction_pattern(reader):
+    """Get the pixelwise maximum of the raw frames.
+
+    Returns: the pattern, of the shape of a frame
+    """
+    maximum = None
+    for block in reader:
+        block_maximum = block.data.max(axis=0)
+        if maximum is None:
+            maximum = block_maximum.astype(np.float64)
+        else:
+            np.maximum(maximum, block_maximum, out=maximum)
+
+    return maximum
+
+
+def maximum_diffraction_pattern_sparse(frames, frame_width, frame_height):
+    """Get the pixelwise maximum of the event counts of sparse frames.
+
+    `frames` is a sequence of arrays or `sparse.SparseFrames`.
+
+    Returns: the pattern, of shape (frame_height, frame_width)
+    """
+    n_pixels = frame_width * frame_height
+    maximum = np.zeros(n_pixels, dtype=np.float64)
+
+    frames = sparse.from_frames(frames)
+    if len(frames.events) == 0:
+        return maximum.reshape((frame_height, frame_width))
+
+    keys = frames.frame_ids() * n_pixels + frames.events
+    # The events are usually sorted within each frame already
+    if not (keys[1:] >= keys[:-1]).all():
+        keys.sort()
+
+    # The number of events of each frame on each pixel
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = np.diff(np.r_[starts, len(keys)])
+    pixels = keys[starts] % n_pixels
+
+    # There are only a few distinct counts, assigning them in increasing
+    # order leaves the maximum of each pixel
+    for count in np.unique(counts):
+        maximum[pixels[counts == count]] = count
+
+    return maximum.reshape((frame_height, frame_width))
+
+
+@functools.lru_cache(maxsize=16)
+def radial_bins(frame_shape, center_x=-1, center_y=-1, bin_width=1):
+    """Get the radial bin of each pixel of a frame of shape (rows, columns).
+
+    The bins are cached, so they are read-only.
+
+    Returns: (flat bin index of each pixel, number of pixels in each bin)
+    """
+    rows, columns = frame_shape
+    if center_x < 0:
+        center_x = columns // 2
+    if center_y < 0:
+        center_y = rows // 2
+
+    y, x = np.ogrid[:rows, :columns]
+    radius = np.sqrt((x - center_x) ** 2 + (y - center_y) ** 2)
+    bins = (radius // bin_width).astype(np.int64).ravel()
+    pixels = np.bincount(bins)
+    bins.setflags(write=False)
+    pixels.setflags(write=False)
+
+    return bins, pixels
+
+
+def scan_regions(width, height, regions_x=1, regions_y=1):
+    """Split a scan into a grid of `regions_x` by `regions_y` regions.
+
+    Returns: the region of each scan position
+    """
+    y, x = np.divmod(np.arange(width * height, dtype=np.int64), width)
+    return (y * regions_y // height) * regions_x + (x * regions_x // width)
+
+
+def _normalize_profiles(sums, pixels, regions, n_regions):
+    """Get the mean intensity per pixel and per frame of the global and of
+    the region radial sums"""
+    sums = sums.reshape((n_regions, -1))
+    positions = np.bincount(regions, minlength=n_regions)
+    profiles = np.concatenate([sums.sum(axis=0, keepdims=True), sums])
+    positions = np.concatenate([[len(regions)], positions])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profiles = profiles / pixels / positions[:, None]
+
+    return np.nan_to_num(profiles)
+
+
+def radial_profile_sparse(frames, frame_width, frame_height, width, height,
+                          center_x=-1, center_y=-1, bin_width=1, regions_x=1,
+                          regions_y=1, frame_offset=0):
+    """Get the radial profiles of sparse frames, frame `i` being at scan
+    position `frame_offset + i`.
+
+    Returns: the profiles of shape (1 + regions, bins), the first one is
+    over the whole scan and the others over each of the scan regions (see
+    `scan_regions`). They are the mean number of events per pixel and per
+    scan position, so the profiles of several ranks add up.
+    """
+    bins, pixels = radial_bins((frame_height, frame_width), center_x,
+                               center_y, bin_width)
+    n_bins = len(pixels)
+    regions = scan_regions(width, height, regions_x, regions_y)
+    n_regions = regions_x * regions_y
+
+    frames = sparse.from_frames(frames)
+    frame_regions = regions[frame_offset:frame_offset + len(frames)]
+    keys = np.repeat(frame_regions, frames.lengths) * n_bins
+    keys += bins[frames.events]
+    sums = np.bincount(keys, minlength=n_regions * n_bins)
+
+    return _normalize_profiles(sums, pixels, regions, n_regions)
+
+
+def radial_profile(reader, center_x=-1, center_y=-1, bin_width=1,
+                   regions_x=1, regions_y=1):
+    """Get the radial profiles of raw frames, see `radial_profile_sparse`"""
+    sums = None
+    for block in reader:
+        data = block.data
+        if sums is None:
+            width, height = block.header.scan_dimensions
+            bins, pixels = radial_bins(data.shape[1:], center_x, center_y,
+                                       bin_width)
+            n_bins = len(pixels)
+            regions = scan_regions(width, height, regions_x, regions_y)
+            n_regions = regions_x * regions_y
+            sums = np.zeros(n_regions * n_bins, dtype=np.float64)
+
+        data = data.reshape((len(data), -1))
+        block_regions = regions[np.asarray(block.header.image_numbers,
+                                           dtype=np.int64)]
+        # Sum the frames of each region before binning them
+        for region in np.unique(block_regions):
+            summed = data[block_regions == region].sum(axis=0,
+                                                       dtype=np.float64)
+            sums[region * n_bins:(region + 1) * n_bins] += np.bincount(
+                bins, weights=summed, minlength=n_bins)
+
+    if sums is None:
+        return np.zeros((0, 0))
+
+    return _normalize_profiles(sums, pixels, regions, n_regions)
+
+
+def _frame_center(frame_shape, center_x, center_y):
+    rows, columns = frame_shape
+    if center_x < 0:
+        center_x = columns // 2
+    if center_y < 0:
+        center_y = rows // 2
+
+    return center_x, center_y
+
+
+def center_of_mass_sparse(frames, frame_width, frame_height, width, height,
+                          center_x=-1, center_y=-1, frame_offset=0, out=None):
+    """Get the center of mass of the events of sparse frames, frame `i`
+    being at scan position `frame_offset + i`.
+
+    The centers are relative to (`center_x`, `center_y`), the middle of the
+    frame by default, and are 0 for frames without events. They are
+    written to `out` if given, so the frames can be processed in blocks.
+
+    Returns: the (CoMx, CoMy) images, of shape (2, height, width)
+    """
+    if out is None:
+        out = np.zeros((2, height, width), dtype=np.float64)
+    center_x, center_y = _frame_center((frame_height, frame_width), center_x,
+                                       center_y)
+
+    frames = sparse.from_frames(frames)
+    y, x = np.divmod(frames.events.astype(np.int64), frame_width)
+    counts = frames.lengths
+    has_events = counts > 0
+
+    com = out.reshape((2, -1))[:, frame_offset:frame_offset + len(frames)]
+    com[0, has_events] = (frames.sum_per_frame(x)[has_events] /
+                          counts[has_events] - center_x)
+    com[1, has_events] = (frames.sum_per_frame(y)[has_events] /
+                          counts[has_events] - center_y)
+
+    return out
+
+
+def center_of_mass(reader, center_x=-1, center_y=-1):
+    """Get the center of mass of the intensity of raw frames, see
+    `center_of_mass_sparse`"""
+    out = None
+    for block in reader:
+        data = block.data
+        if out is None:
+            width, height = block.header.scan_dimensions
+            out = np.zeros((2, height * width), dtype=np.float64)
+            rows, columns = data.shape[1:]
+            frame_center_x, frame_center_y = _frame_center(
+                (rows, columns), center_x, center_y)
+            xs = np.arange(columns, dtype=np.float64) - frame_center_x
+            ys = np.arange(rows, dtype=np.float64) - frame_center_y
+
+        # The projections of the frames on each axis
+        column_sums = data.sum(axis=1, dtype=np.float64)
+        row_sums = data.sum(axis=2, dtype=np.float64)
+        totals = row_sums.sum(axis=1)
+        has_intensity = totals > 0
+
+        positions = np.asarray(block.header.image_numbers,
+                               dtype=np.int64)[has_intensity]
+        totals = totals[has_intensity]
+        out[0, positions] = column_sums[has_intensity] @ xs / totals
+        out[1, positions] = row_sums[has_intensity] @ ys / totals
+
+    if out is None:
+        return np.zeros((2, 0, 0))
+
+    return out.reshape((2, height, width))
+
+
+def integrate_phase(com_x, com_y):
+    """Integrate a center of mass field into a phase image.
+
+    The field is taken as the gradient of the phase, which is integrated
+    in Fourier space, keeping only the curl-free part of the field. The
+    phase is in units of pixels of the frames times pixels of the scan and
+    has a zero mean.
+    """
+    height, width = com_x.shape
+    kx = 2 * np.pi * np.fft.fftfreq(width)[None, :]
+    ky = 2 * np.pi * np.fft.fftfreq(height)[:, None]
+    k2 = kx ** 2 + ky ** 2
+    k2[0, 0] = 1
+
+    phase = (-1j * (kx * np.fft.fft2(com_x) + ky * np.fft.fft2(com_y)) / k2)
+    phase[0, 0] = 0
+
+    return np.fft.ifft2(phase).real
@@ -0,0 +1,233 @@
+from collections import OrderedDict
+import functools
+
+try:
+    from stempy import image
+except ImportError:
+    # Without the stempy build only the numpy engine is available
+    image = None
+
+try:
+    from stempy.pipeline import (pipeline, parameter, PipelineIO,
+                                 PipelineAggregation as _PipelineAggregation)
+except ImportError:
+    # Without the stempy build the pipelines are described by these
+    # equivalents of the stempy.pipeline decorators
+
+    class PipelineIO(object):
+        IMAGE = 'image'
+        FRAME = 'frame'
+
+    class _PipelineAggregation(object):
+        SUM = 'sum'
+        MAX = 'max'
+        MIN = 'min'
+        MEAN = 'mean'
+        MEDIAN = 'median'
+
+    def pipeline(name=None, description=None, input=PipelineIO.FRAME,
+                 output=PipelineIO.IMAGE,
+                 aggregation=_PipelineAggregation.SUM):
+        def decorator(execute):
+            execute.NAME = name
+            execute.DESCRIPTION = description
+            execute.INPUT = input
+            execute.OUTPUT = output
+            execute.AGGREGATION = aggregation
+            if not hasattr(execute, 'PARAMETERS'):
+                execute.PARAMETERS = OrderedDict()
+            return execute
+
+        return decorator
+
+    def parameter(name, type='string', label=None, description=None,
+                  default=None):
+        def decorator(execute):
+            if not hasattr(execute, 'PARAMETERS'):
+                execute.PARAMETERS = OrderedDict()
+            execute.PARAMETERS[name] = {
+                'type': type,
+                'label': label,
+                'description': description,
+                'default': default
+            }
+
+            @functools.wraps(execute)
+            def wrapper(*args, **kwargs):
+                kwargs.setdefault(name, default)
+                return execute(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+import h5py
+from mpi4py import MPI
+import numpy as np
+
+from stemworker import numpy_engine, sparse
+
+ENGINES = ['stempy', 'numpy']
+
+
+class PipelineAggregation(_PipelineAggregation):
+    # The result of an execution is sent once, complete (e.g. summed over
+    # the ranks by the worker, see `aggregated`), there is nothing for the
+    # client to aggregate
+    NONE = 'none'
+
+
+def get_engine(name=None):
+    """Get the module implementing the pipeline computations.
+
+    `name` is one of `ENGINES`, the compiled stempy functions are used by
+    default when they are available.
+    """
+    if name is None or name == '':
+        name = 'stempy' if image is not None else 'numpy'
+
+    if name == 'numpy':
+        return numpy_engine
+    elif name == 'stempy':
+        if image is None:
+            raise Exception('The stempy engine is not available.')
+        return image
+
+    raise Exception('Unknown engine: %s' % name)
+
+
+def get_rank_range(n_frames):
+    """Get the (offset, size) of the frames processed by this rank"""
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    world_size = comm.Get_size()
+    frames_per_rank = n_frames // world_size
+    offset = rank * frames_per_rank
+    if (rank == world_size - 1):
+        size = n_frames - offset
+    else:
+        size = frames_per_rank
+
+    return offset, size
+
+
+def read_sparse_frames(reader, engine, offset, size):
+    """Read the sparse frames [offset, offset + size) for `engine`.
+
+    The numpy engine gets the cached `sparse.SparseFrames`, stempy gets
+    the array of per frame events.
+    """
+    if engine is numpy_engine:
+        return sparse.load_frames(reader, offset, offset + size)
+
+    return reader[sparse.FRAMES_PATH][offset:offset+size]
+
+
+class Consumer(object):
+    """Accumulates the result of a pipeline over the blocks of a dataset.
+
+    `compute(block)` gets the result of a block, the results of the
+    blocks are merged with `combine` and `finish` is applied to the merged
+    result. The blocks are `sparse.SparseFrames` for H5 files and stempy
+    reader blocks for raw data, see `iter_blocks`.
+    """
+
+    def __init__(self, compute, combine=np.add, finish=None):
+        self.compute = compute
+        self.combine = combine
+        self._finish = finish
+        self.result = None
+
+    def consume(self, block):
+        result = self.compute(block)
+        if self.result is None:
+            self.result = result
+        else:
+            self.result = self.combine(self.result, result)
+
+    def finish(self):
+        result = self.result
+        if result is None:
+            result = np.zeros((0, 0))
+        if self._finish is not None:
+            result = self._finish(result)
+        return result
+
+
+def consumer(create_consumer):
+    """Make a pipeline fusable with the other pipelines reading the same
+    dataset.
+
+    `create_consumer(reader, **params)` gets the `Consumer` of an
+    execution, or None when the execution can't be fused (e.g. the
+    stempy engine is asked for). The consumers use the numpy engine, so an
+    execution reading the data on its own, with no other to share the
+    pass with, is run by the default engine instead.
+    """
+    def decorator(execute):
+        execute.create_consumer = create_consumer
+        return execute
+
+    return decorator
+
+
+def collective(execute):
+    """Make a pipeline run on every rank, including the ranks without any
+    data to read (their `reader` is None).
+
+    This is needed by the pipelines communicating between the ranks (e.g.
+    gathering their results), which would otherwise wait forever for the
+    ranks without data.
+    """
+    execute.collective = True
+    return execute
+
+
+def aggregated(finish):
+    """Make the results of a pipeline be summed over the ranks by the
+    worker, `finish(result, **params)` being applied to the sum.
+
+    This is for the pipelines needing the whole result, e.g. to integrate
+    it. Only rank 0 sends the finished result, once per execution, so the
+    aggregation of the pipeline is `PipelineAggregation.NONE`.
+    """
+    def decorator(execute):
+        execute.finish_aggregated = finish
+        execute.AGGREGATION = PipelineAggregation.NONE
+        return execute
+
+    return decorator
+
+
+def iter_blocks(reader, block_size=sparse.BLOCK_SIZE):
+    """Iterate over the blocks of the frames of this rank, H5 files are
+    read `block_size` frames at a time"""
+    if isinstance(reader, h5py.File):
+        n_frames = len(reader[sparse.FRAMES_PATH])
+        offset, size = get_rank_range(n_frames)
+        empty = True
+        for frames in sparse.iter_frames(reader, offset, offset + size,
+                                         block_size):
+            empty = False
+            yield frames
+        if empty:
+            # So the consumers still produce a (zero) result
+            yield sparse.SparseFrames(np.zeros(0, dtype=np.uint32),
+                                      np.zeros(1, dtype=np.int64), offset)
+    else:
+        for block in reader:
+            yield block
+
+
+def execute_fused(reader, consumers, block_size=sparse.BLOCK_SIZE):
+    """Execute several pipelines in a single pass over the data of `reader`,
+    feeding each block to all the `consumers`.
+
+    Returns: the result of each consumer
+    """
+    for block in iter_blocks(reader, block_size):
+        for c in consumers:
+            c.consume(block)
+
+    return [c.finish() for c in consumers]
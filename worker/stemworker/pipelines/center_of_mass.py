@@ -0,0 +1,74 @@
+import h5py
+import numpy as np
+
+from stemworker import numpy_engine, sparse
+from stemworker.pipelines import pipeline, parameter, PipelineIO, PipelineAggregation
+from stemworker.pipelines import Consumer, aggregated, consumer, get_rank_range
+
+def _with_phase(com, **params):
+    """Add the integrated phase to the CoM images summed over the ranks"""
+    if not bool(int(params.get('phase', 0))):
+        return com
+
+    return np.concatenate([com, numpy_engine.integrate_phase(*com)[None]])
+
+def create_consumer(reader, **params):
+    center_x = int(params.get('centerX', -1))
+    center_y = int(params.get('centerY', -1))
+
+    if (isinstance(reader, h5py.File)):
+        frames = reader['/electron_events/frames']
+        scans = reader['/electron_events/scan_positions']
+        kwargs = {
+            'frame_width': frames.attrs['Nx'],
+            'frame_height': frames.attrs['Ny'],
+            'width': scans.attrs['Nx'],
+            'height': scans.attrs['Ny'],
+            'center_x': center_x,
+            'center_y': center_y
+        }
+
+        def compute(frames):
+            return numpy_engine.center_of_mass_sparse(frames, frame_offset=frames.frame_offset, **kwargs)
+    else:
+        def compute(block):
+            return numpy_engine.center_of_mass([block], center_x=center_x, center_y=center_y)
+
+    # Each rank fills its own scan positions, they add up
+    return Consumer(compute)
+
+# The phase needs the whole field, so it is integrated once the CoM of the
+# ranks are summed. Rank 0 sends the finished result alone, there is
+# nothing left for the client to aggregate.
+@aggregated(_with_phase)
+@consumer(create_consumer)
+@pipeline('Center of Mass', 'Creates center of mass (CoMx, CoMy) and optionally integrated phase (DPC) images', PipelineIO.FRAME, PipelineIO.IMAGE, PipelineAggregation.NONE)
+@parameter('centerX', type='integer', label='Center X', default=-1)
+@parameter('centerY', type='integer', label='Center Y', default=-1)
+@parameter('phase', type='integer', label='Integrate the phase (0 or 1)', default=0)
+@parameter('version', type='integer', label='File version', default=3)
+def execute(reader, **params):
+    center_x = int(params.get('centerX', -1))
+    center_y = int(params.get('centerY', -1))
+
+    if (isinstance(reader, h5py.File)):
+        frames_path = '/electron_events/frames'
+        scans_path = '/electron_events/scan_positions'
+        n_frames = len(reader[frames_path])
+        offset, size = get_rank_range(n_frames)
+
+        frame_width = reader[frames_path].attrs['Nx']
+        frame_height = reader[frames_path].attrs['Ny']
+        width = reader[scans_path].attrs['Nx']
+        height = reader[scans_path].attrs['Ny']
+        local_com = np.zeros((2, height, width), dtype=np.float64)
+        # Stream the frames in blocks, so the memory used is bounded
+        for frames in sparse.iter_frames(reader, offset, offset + size):
+            numpy_engine.center_of_mass_sparse(frames, frame_width, frame_height, width, height,
+                                               center_x=center_x, center_y=center_y,
+                                               frame_offset=frames.frame_offset, out=local_com)
+    else:
+        local_com = numpy_engine.center_of_mass(reader, center_x=center_x, center_y=center_y)
+
+    # Each rank fills its own scan positions, they add up
+    return local_com
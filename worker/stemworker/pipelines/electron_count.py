@@ -0,0 +1,137 @@
+import glob
+import logging
+import os
+import time
+
+import h5py
+from mpi4py import MPI
+import numpy as np
+
+try:
+    from stempy import io
+except ImportError:
+    # Without the stempy build there is no raw data to count
+    io = None
+
+from stemworker import counting
+from stemworker.pipelines import pipeline, parameter, PipelineIO, PipelineAggregation
+from stemworker.pipelines import collective
+
+logger = logging.getLogger('stemworker')
+
+# The counted electrons are written in this directory, which has to be
+# shared by the ranks (they write their part of the events in it, see
+# `execute`). The outputPath of an execution is relative to it.
+OUTPUT_DIR = os.environ.get('STEMWORKER_OUTPUT_DIR')
+DEFAULT_OUTPUT = 'electron_counted.h5'
+
+# Every rank takes part in merging the events, the ranks without any file
+# to read (see `get_worker_reader`) contribute no frames.
+@collective
+@pipeline('Electron Counting', 'Counts the electrons of raw frames into sparse events', PipelineIO.FRAME, PipelineIO.IMAGE, PipelineAggregation.SUM)
+@parameter('darkPath', type='string', label='Dark reference files (defaults to the data)', default='')
+@parameter('outputPath', type='string', label='Output file (in the output directory)', default='')
+@parameter('overwrite', type='integer', label='Overwrite the output file (0 or 1)', default=0)
+@parameter('darkFrames', type='integer', label='Dark reference frames', default=1000)
+@parameter('thresholdFrames', type='integer', label='Threshold calibration frames', default=20)
+@parameter('backgroundSigma', type='integer', label='Background threshold (sigma)', default=4)
+@parameter('xraySigma', type='integer', label='X-ray threshold (sigma)', default=10)
+@parameter('version', type='integer', label='File version', default=3)
+def execute(reader, **params):
+    if (isinstance(reader, h5py.File)):
+        raise Exception("This pipeline is only implemented for raw datasets.")
+    if io is None:
+        raise Exception('Electron counting requires stempy.')
+
+    path = params.get('path')
+    version = int(params.get('version', 3))
+    dark_path = params.get('darkPath') or path
+    if OUTPUT_DIR is None:
+        raise Exception('STEMWORKER_OUTPUT_DIR must be set to count electrons.')
+    output_path = counting.output_path(
+        OUTPUT_DIR, params.get('outputPath') or DEFAULT_OUTPUT,
+        overwrite=bool(int(params.get('overwrite', 0))))
+
+    def open_reader(pattern):
+        return io.reader(sorted(glob.glob(pattern)), version=version)
+
+    # Every rank calibrates on the same frames, so they agree without
+    # communicating; this is only done once per dataset.
+    dark, background_threshold, xray_threshold = counting.calibrate(
+        open_reader, dark_path, path,
+        dark_frames=int(params.get('darkFrames', 1000)),
+        threshold_frames=int(params.get('thresholdFrames', 20)),
+        background_n_sigma=params.get('backgroundSigma', 4),
+        xray_n_sigma=params.get('xraySigma', 10))
+
+    start = time.perf_counter()
+    positions, frames, scan_shape = counting.count(
+        reader if reader is not None else [], dark, background_threshold,
+        xray_threshold)
+    elapsed = time.perf_counter() - start
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    logger.info('Rank %d counted %d frames (%d events) in %.2fs, %.1f frames/s',
+                rank, len(frames), len(frames.events), elapsed,
+                len(frames) / max(elapsed, 1e-9))
+
+    # The events are passed to rank 0 through files rather than MPI, each
+    # rank writing its part next to the output
+    def part_path(rank):
+        return '%s.part%d' % (output_path, rank)
+
+    error = None
+    try:
+        counting.write_part(part_path(rank), positions, frames)
+    except Exception as e:
+        logger.exception('Failed to write %s', part_path(rank))
+        error = '%s: %s' % (type(e).__name__, e)
+
+    gathered = comm.gather((error, len(frames), len(frames.events),
+                            scan_shape, elapsed), root=0)
+    if rank == 0:
+        scan_shape = next((s for _, _, _, s, _ in gathered if s is not None),
+                          None)
+        error = '; '.join('rank %d: %s' % (r, g[0])
+                          for r, g in enumerate(gathered)
+                          if g[0] is not None) or None
+    scan_shape, error = comm.bcast((scan_shape, error), root=0)
+
+    try:
+        if error is not None:
+            raise Exception('Failed to write the counted frames: %s' % error)
+        if scan_shape is None:
+            raise Exception('No frames to count in %s' % path)
+
+        if rank == 0:
+            n_frames = sum(g[1] for g in gathered)
+            elapsed = max(g[4] for g in gathered)
+            report = {
+                'frames': n_frames,
+                'events': sum(g[2] for g in gathered),
+                'countingSeconds': elapsed,
+                'framesPerSecond': n_frames / max(elapsed, 1e-9),
+                'backgroundThreshold': background_threshold,
+                'xrayThreshold': xray_threshold
+            }
+            logger.info('Counted %(frames)d frames (%(events)d events) in '
+                        '%(countingSeconds).2fs, %(framesPerSecond).1f frames/s',
+                        report)
+            parts = [counting.read_part(part_path(r))
+                     for r in range(comm.Get_size())]
+            counting.write_frames(
+                output_path, np.concatenate([p for p, _ in parts]),
+                counting.concatenate([f for _, f in parts]), scan_shape,
+                dark.shape, attrs=report)
+    finally:
+        if rank == 0:
+            for r in range(comm.Get_size()):
+                if os.path.exists(part_path(r)):
+                    os.remove(part_path(r))
+
+    # The number of events at each scan position
+    counts = np.zeros(scan_shape[0] * scan_shape[1], dtype=np.uint64)
+    np.add.at(counts, positions, frames.lengths.astype(np.uint64))
+
+    return counts.reshape(scan_shape)
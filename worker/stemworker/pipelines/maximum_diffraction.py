@@ -1,23 +1,56 @@
-from stempy import image
-from stempy.pipeline import pipeline, parameter, PipelineIO, PipelineAggregation
 import h5py
-from mpi4py import MPI
+import numpy as np
 
+from stemworker import numpy_engine
+from stemworker.pipelines import pipeline, parameter, PipelineIO, PipelineAggregation
+from stemworker.pipelines import Consumer, consumer, get_engine, get_rank_range, read_sparse_frames
+
+def create_consumer(reader, **params):
+    # The single pass is made by the numpy engine, unless stempy is asked for
+    if get_engine(params.get('engine') or 'numpy') is not numpy_engine:
+        return None
+
+    if (isinstance(reader, h5py.File)):
+        frames = reader['/electron_events/frames']
+        frame_width = frames.attrs['Nx']
+        frame_height = frames.attrs['Ny']
+
+        def compute(frames):
+            return numpy_engine.maximum_diffraction_pattern_sparse(frames, frame_width, frame_height)
+    else:
+        def compute(block):
+            return numpy_engine.maximum_diffraction_pattern([block])
+
+    return Consumer(compute, combine=np.maximum)
+
+@consumer(create_consumer)
 @pipeline('Maximum Diffraction', 'Get the maximum diffraction for a given group of frams', PipelineIO.FRAME, PipelineIO.FRAME, PipelineAggregation.MAX)
 @parameter('x', type='integer', label='Origin X', default=-1)
 @parameter('y', type='integer', label='Origin Y', default=-1)
 @parameter('width', type='integer', label='Width', default=0)
 @parameter('height', type='integer', label='Height', default=0)
 @parameter('version', type='integer', label='File version', default=3)
+@parameter('engine', type='string', label='Engine (stempy or numpy)', default='')
 def execute(reader, **params):
     origin_x = params.get('x')
     origin_y = params.get('y')
     selection_width = params.get('width')
     selection_height = params.get('height')
+    engine = get_engine(params.get('engine'))
 
     if (isinstance(reader, h5py.File)):
-        raise Exception("This pipeline is currently only implemented for raw datasets.")
+        if engine is not numpy_engine:
+            raise Exception("This pipeline is only implemented for sparse datasets by the numpy engine.")
+
+        frames_path = '/electron_events/frames'
+        n_frames = len(reader[frames_path])
+        offset, size = get_rank_range(n_frames)
+
+        data = read_sparse_frames(reader, engine, offset, size)
+        frame_width = reader[frames_path].attrs['Nx']
+        frame_height = reader[frames_path].attrs['Ny']
+        local_stem = engine.maximum_diffraction_pattern_sparse(data, frame_width, frame_height)
     else:
-        local_stem = image.maximum_diffraction_pattern(reader)
+        local_stem = engine.maximum_diffraction_pattern(reader)
 
     return local_stem
@@ -0,0 +1,64 @@
+import h5py
+
+from stemworker import numpy_engine
+from stemworker.pipelines import pipeline, parameter, PipelineIO, PipelineAggregation
+from stemworker.pipelines import Consumer, consumer, get_rank_range, read_sparse_frames
+
+def _profile_kwargs(params):
+    return {
+        'center_x': int(params.get('centerX', -1)),
+        'center_y': int(params.get('centerY', -1)),
+        'bin_width': int(params.get('binWidth', 1)),
+        'regions_x': int(params.get('regionsX', 1)),
+        'regions_y': int(params.get('regionsY', 1))
+    }
+
+def create_consumer(reader, **params):
+    kwargs = _profile_kwargs(params)
+
+    if (isinstance(reader, h5py.File)):
+        frames = reader['/electron_events/frames']
+        scans = reader['/electron_events/scan_positions']
+        kwargs.update({
+            'frame_width': frames.attrs['Nx'],
+            'frame_height': frames.attrs['Ny'],
+            'width': scans.attrs['Nx'],
+            'height': scans.attrs['Ny']
+        })
+
+        def compute(frames):
+            return numpy_engine.radial_profile_sparse(frames, frame_offset=frames.frame_offset, **kwargs)
+    else:
+        def compute(block):
+            return numpy_engine.radial_profile([block], **kwargs)
+
+    return Consumer(compute)
+
+@consumer(create_consumer)
+@pipeline('Radial Profile', 'Azimuthally integrated intensity profile, over the whole scan and per scan region', PipelineIO.FRAME, PipelineIO.IMAGE, PipelineAggregation.SUM)
+@parameter('centerX', type='integer', label='Center X', default=-1)
+@parameter('centerY', type='integer', label='Center Y', default=-1)
+@parameter('binWidth', type='integer', label='Bin width', default=1)
+@parameter('regionsX', type='integer', label='Scan regions along X', default=1)
+@parameter('regionsY', type='integer', label='Scan regions along Y', default=1)
+@parameter('version', type='integer', label='File version', default=3)
+def execute(reader, **params):
+    kwargs = _profile_kwargs(params)
+
+    if (isinstance(reader, h5py.File)):
+        frames_path = '/electron_events/frames'
+        scans_path = '/electron_events/scan_positions'
+        n_frames = len(reader[frames_path])
+        offset, size = get_rank_range(n_frames)
+
+        data = read_sparse_frames(reader, numpy_engine, offset, size)
+        frame_width = reader[frames_path].attrs['Nx']
+        frame_height = reader[frames_path].attrs['Ny']
+        width = reader[scans_path].attrs['Nx']
+        height = reader[scans_path].attrs['Ny']
+        local_profile = numpy_engine.radial_profile_sparse(data, frame_width, frame_height,
+                                                           width, height, frame_offset=offset, **kwargs)
+    else:
+        local_profile = numpy_engine.radial_profile(reader, **kwargs)
+
+    return local_profile
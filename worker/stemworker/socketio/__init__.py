@@ -2,12 +2,14 @@ import logging
 import asyncio
 import functools
 import glob
+import os
 from collections import OrderedDict
 
 from mpi4py import MPI
 import socketio
 import msgpack
 import h5py
+import numpy as np
 
 from stemworker import (
     create_pipeline_instance,
@@ -16,12 +18,23 @@ from stemworker import (
     get_pipeline_info
 )
 
+from stemworker.pipelines import execute_fused
 from .constants import FileFormat
 
-from stempy import io
+try:
+    from stempy import io
+except ImportError:
+    # Without the stempy build only H5 files can be read
+    io = None
 
 logger = logging.getLogger('stemworker')
 
+# The executions received by rank 0 within this many seconds of each other
+# are grouped, those reading the same data are run in a single pass. Rank 0
+# only waits when executions arrive together, a lone one is run right away;
+# 0 disables the wait.
+FUSE_WINDOW = float(os.environ.get('STEMWORKER_FUSE_WINDOW', 0.05))
+
 def get_worker_reader(path, version):
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
@@ -29,6 +42,8 @@ def get_worker_reader(path, version):
     files = glob.glob(path)[rank::world_size]
     if (len(files) == 0):
         return None
+    if io is None:
+        raise Exception('Reading raw data requires stempy.')
     return io.reader(files, version=int(version))
 
 def get_worker_h5_reader(path):
@@ -38,6 +53,22 @@ def get_worker_h5_reader(path):
     else:
         return h5py.File(path, 'r')
 
+def open_reader(params):
+    file_format = params.get('format')
+    path = params.get('path')
+    version = params.get('version', 3)
+    reader = None
+    if file_format == FileFormat.Dat:
+        reader = get_worker_reader(path, version)
+    elif file_format == FileFormat.H5:
+        reader = get_worker_h5_reader(path)
+
+    return reader
+
+def close_reader(reader):
+    if isinstance(reader, h5py.File):
+        reader.close()
+
 async def connect(pipelines,  worker_id, url, cookie):
     comm = MPI.COMM_WORLD
     rank = comm.Get_rank()
@@ -63,9 +94,19 @@ async def connect(pipelines,  worker_id, url, cookie):
         await client.emit('stem.worker_connected', namespace='/stem',
                           data=connect_data)
 
+    # The messages acting on the pipelines, in the order rank 0 received
+    # them. Rank 0 broadcasts them to the other ranks, so every rank runs
+    # the same collectives in the same order, whatever order the messages
+    # reach it in.
+    commands = asyncio.Queue()
+
     @client.on('stem.pipeline.create', namespace='/stem')
     async def on_create(params):
-        logger.info('stem.pipeline.create: %s' % params)
+        logger.info('stem.pipeline.create: %s', params)
+        if rank == 0:
+            commands.put_nowait(('create', params))
+
+    async def create(params):
         worker_id = params['workerId']
         name = params['name']
         pipeline_id = create_pipeline_instance(name)
@@ -84,59 +125,240 @@ async def connect(pipelines,  worker_id, url, cookie):
 
     @client.on('stem.pipeline.execute', namespace='/stem')
     async def on_execute(params):
-        logger.info('stem.pipeline.execute: %s' % params)
+        logger.info('stem.pipeline.execute: %s', params)
+        if rank == 0:
+            commands.put_nowait(('execute', params))
+
+    async def emit_executed(params, result):
+        pipeline_id = params['pipelineId']
+        name = get_pipeline_instance(pipeline_id)['name']
+        # The correlation id goes first so the relay can read it
+        # without unpacking the result.
+        data = {
+            'correlationId': params.get('correlationId'),
+            'workerId': worker_id,
+            'rank': rank,
+            'pipelineId': pipeline_id,
+            'result': result.tolist(),
+            'info': get_pipeline_info(name, pipelines)
+        }
+        data = msgpack.packb(data, use_bin_type=True)
+
+        await client.emit('stem.pipeline.executed', namespace='/stem', data=data)
+
+    async def emit_completed(params, error=None):
         pipeline_id = params['pipelineId']
-        pipeline = get_pipeline_instance(pipeline_id)
-        name = pipeline['name']
-        executor = pipeline['executor']
-        info = get_pipeline_info(name, pipelines)
-
-        file_format = params['params'].get('format')
-        path = params['params'].get('path')
-        version = params['params'].get('version', 3)
+        try:
+            name = get_pipeline_instance(pipeline_id)['name']
+            info = get_pipeline_info(name, pipelines)
+        except KeyError:
+            # The pipeline is unknown, which is the error
+            info = None
+        data = {
+            'correlationId': params.get('correlationId'),
+            'workerId': worker_id,
+            'rank': rank,
+            'pipelineId': pipeline_id,
+            'info': info
+        }
+        if error is not None:
+            data['error'] = error
+        await client.emit('stem.pipeline.completed', namespace='/stem', data=data)
+
+    async def execute(group):
+        """Execute a group of executions on the same data.
+
+        The executions of pipelines that have a consumer (see
+        `stemworker.pipelines.consumer`) share a single pass over the
+        data, the others are run one after the other. The ranks without
+        data only run the collective pipelines (see
+        `stemworker.pipelines.collective`).
+
+        The results of the aggregated pipelines (see
+        `stemworker.pipelines.aggregated`) are summed over the ranks once
+        the group is executed, every rank taking part in the same order.
+
+        An execution failing doesn't stop the others, its error is sent
+        with its completion, prefixed by the ranks it failed on.
+        """
+        loop = asyncio.get_running_loop()
+        first = group[0]['params']
+        # The executor, result to be summed over the ranks and error of each
+        # execution, by position in the group
+        executors = [None] * len(group)
+        partials = [None] * len(group)
+        errors = [None] * len(group)
+        # The executions whose result was computed
+        done = set()
+
+        def failed(i, e):
+            logger.exception('Execution failed')
+            errors[i] = '%s: %s' % (type(e).__name__, e)
+
+        async def emit_result(i, result):
+            done.add(i)
+            if getattr(executors[i], 'finish_aggregated', None) is not None:
+                partials[i] = result
+            else:
+                await emit_executed(group[i], result)
+
+        for i, params in enumerate(group):
+            try:
+                executors[i] = get_pipeline_instance(params['pipelineId'])['executor']
+            except Exception as e:
+                failed(i, e)
+
+        fused = []
+        single = []
         reader = None
-        if file_format == FileFormat.Dat:
-            reader = get_worker_reader(path, version)
-        elif file_format == FileFormat.H5:
-            reader = get_worker_h5_reader(path)
-
-        if reader is not None:
-            loop = asyncio.get_running_loop()
-            # Add the kwargs
-            executor = functools.partial(executor, reader, **params['params'])
-            # Execute in thread pool
-            result = await loop.run_in_executor(None, executor)
-
-            if isinstance(reader, h5py.File):
-                reader.close()
-
-            data = {
-                'workerId': worker_id,
-                'rank': rank,
-                'pipelineId': pipeline_id,
-                'result': result.tolist(),
-                'info': info
-            }
-            data = msgpack.packb(data, use_bin_type=True)
+        try:
+            reader = open_reader(first)
+            for i, params in enumerate(group):
+                executor = executors[i]
+                if executor is None:
+                    continue
+                create_consumer = getattr(executor, 'create_consumer', None)
+                consumer = None
+                try:
+                    if reader is not None and create_consumer is not None:
+                        consumer = create_consumer(reader, **params['params'])
+                except Exception as e:
+                    failed(i, e)
+                    continue
+                if consumer is not None:
+                    fused.append((i, consumer))
+                elif reader is not None or getattr(executor, 'collective', False):
+                    single.append(i)
+
+            # Alone, an execution is better run by the default engine
+            if len(fused) == 1:
+                single.insert(0, fused.pop()[0])
+
+            if fused:
+                logger.info('Executing %d pipelines in a single pass over %s',
+                            len(fused), first.get('path'))
+                # Execute in thread pool
+                results = await loop.run_in_executor(
+                    None, execute_fused, reader, [c for _, c in fused])
+                for (i, _), result in zip(fused, results):
+                    await emit_result(i, result)
+        except Exception as e:
+            # The data couldn't be opened or the single pass failed, the
+            # executions run on their own still are
+            for i in range(len(group)):
+                if i not in done and i not in single and errors[i] is None:
+                    failed(i, e)
+        finally:
+            close_reader(reader)
 
-            await client.emit('stem.pipeline.executed', namespace='/stem', data=data)
+        for i in single:
+            params = group[i]
+            reader = None
+            try:
+                reader = open_reader(params['params'])
+                # Add the kwargs
+                executor = functools.partial(executors[i], reader, **params['params'])
+                # Execute in thread pool
+                result = await loop.run_in_executor(None, executor)
+                close_reader(reader)
+                reader = None
+                await emit_result(i, result)
+            except Exception as e:
+                failed(i, e)
+            finally:
+                close_reader(reader)
 
-        comm.Barrier()
+        for i, params in enumerate(group):
+            finish = getattr(executors[i], 'finish_aggregated', None)
+            if finish is None:
+                continue
+            # The ranks without a result still take part
+            results = comm.gather(partials[i], root=0)
+            results = [r for r in results or [] if r is not None]
+            if rank == 0 and results:
+                try:
+                    result = finish(functools.reduce(np.add, results),
+                                    **params['params'])
+                    await emit_executed(params, result)
+                except Exception as e:
+                    failed(i, e)
+
+        # Gathering the errors also waits for every rank to be done
+        errors = comm.gather(errors, root=0)
         if rank == 0:
-            data = {
-                'workerId': worker_id,
-                'rank': rank,
-                'pipelineId': pipeline_id,
-                'info': info
-            }
-            await client.emit('stem.pipeline.completed', namespace='/stem', data=data)
+            for i, params in enumerate(group):
+                messages = ['rank %d: %s' % (r, e[i])
+                            for r, e in enumerate(errors) if e[i] is not None]
+                await emit_completed(params, '; '.join(messages) or None)
+
+    async def next_commands():
+        """Get the next commands to run, the same on every rank.
+
+        Rank 0 takes the next message and those received meanwhile. When
+        an execution is followed by other messages, it first waits
+        `FUSE_WINDOW` for the rest of the executions sent together. The
+        other ranks wait for rank 0 to broadcast them.
+        """
+        batch = None
+        if rank == 0:
+            batch = [await commands.get()]
+            if batch[0][0] == 'execute' and not commands.empty():
+                # Let the executions sent together arrive
+                await asyncio.sleep(FUSE_WINDOW)
+            while not commands.empty():
+                batch.append(commands.get_nowait())
+
+        # Wait in a thread, so the connection is still served meanwhile
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(comm.bcast, batch, root=0))
+
+    async def run_pending(pending):
+        """Run the pending executions, grouped by the data they read"""
+        groups = OrderedDict()
+        for params in pending.values():
+            data = params['params']
+            data_key = (data.get('format'), data.get('path'),
+                        data.get('version', 3))
+            groups.setdefault(data_key, []).append(params)
+
+        for group in groups.values():
+            await execute(group)
+
+    async def run_commands():
+        """Run the commands in order, the executions between two other
+        commands being run together."""
+        while True:
+            # The executions waiting to be run, by (pipeline id, correlation id)
+            pending = OrderedDict()
+            for name, params in await next_commands():
+                if name == 'execute':
+                    correlation_id = params.get('correlationId')
+                    if correlation_id is None:
+                        # Executions without a correlation id can't be told
+                        # apart, none of them is merged with another
+                        correlation_id = object()
+                    pending[(params['pipelineId'], correlation_id)] = params
+                    continue
+
+                await run_pending(pending)
+                pending = OrderedDict()
+                try:
+                    if name == 'create':
+                        await create(params)
+                    elif name == 'delete':
+                        logger.info('Deleting pipeline:: %s', params['pipelineId'])
+                        delete_pipeline_instance(params['pipelineId'])
+                except Exception:
+                    logger.exception('stem.pipeline.%s failed', name)
+
+            await run_pending(pending)
 
     @client.on('stem.pipeline.delete', namespace='/stem')
     async def on_delete(params):
-        logger.info('stem.pipeline.delete: %s' % params)
-        pipeline_id = params['pipelineId']
-        logger.info('Deleting pipeline:: %s' % pipeline_id)
-        delete_pipeline_instance(pipeline_id)
+        logger.info('stem.pipeline.delete: %s', params)
+        if rank == 0:
+            commands.put_nowait(('delete', params))
 
     @client.on('disconnect', namespace='/stem')
     async def on_disconnect():
@@ -147,3 +369,4 @@ async def connect(pipelines,  worker_id, url, cookie):
     }
 
     await client.connect(url, namespaces=['/stem'], transports=['websocket'], headers=headers)
+    await run_commands()
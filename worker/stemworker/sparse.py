@@ -0,0 +1,169 @@
+"""A flat (CSR) representation of sparse electron event frames.
+
+The events of all the frames are held in one flat buffer, with the
+events of frame `i` at `events[offsets[i]:offsets[i + 1]]`. This lets the
+pipelines compute over all the events at once (`bincount`,
+`maximum.at`, ...) rather than walking the frames one by one.
+"""
+from collections import OrderedDict
+import os
+import threading
+
+import numpy as np
+
+FRAMES_PATH = '/electron_events/frames'
+
+# The frames read from a vlen dataset at a time
+BLOCK_SIZE = 16384
+
+
+class SparseFrames(object):
+    """The events of a range of frames, starting at frame `frame_offset`"""
+
+    def __init__(self, events, offsets, frame_offset=0):
+        self.events = events
+        self.offsets = offsets
+        self.frame_offset = frame_offset
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.events.nbytes + self.offsets.nbytes
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def frame_ids(self):
+        """Get the index of the frame of each event"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.lengths)
+
+    def sum_per_frame(self, values):
+        """Sum `values`, one per event, over the events of each frame"""
+        sums = np.zeros(len(values) + 1, dtype=np.result_type(values,
+                                                              np.int64))
+        np.cumsum(values, out=sums[1:])
+        return sums[self.offsets[1:]] - sums[self.offsets[:-1]]
+
+
+def from_frames(frames, frame_offset=0):
+    """Get the `SparseFrames` of a sequence of per frame event arrays"""
+    if isinstance(frames, SparseFrames):
+        return frames
+
+    offsets = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(f) for f in frames), dtype=np.int64,
+                          count=len(frames)), out=offsets[1:])
+
+    events = [f for f in frames if len(f)]
+    if events:
+        events = np.concatenate(events)
+    else:
+        events = np.zeros(0, dtype=np.uint32)
+
+    return SparseFrames(events, offsets, frame_offset)
+
+
+def read_frames(dataset, start, stop, block_size=BLOCK_SIZE):
+    """Read the frames [start, stop) of a vlen dataset.
+
+    The frames are read in bulk, `block_size` frames per read, and the
+    events of each block are appended to the flat buffer.
+    """
+    offsets = np.zeros(stop - start + 1, dtype=np.int64)
+    blocks = []
+    for block_start in range(start, stop, block_size):
+        block = from_frames(dataset[block_start:min(block_start + block_size,
+                                                    stop)])
+        i = block_start - start
+        offsets[i + 1:i + len(block) + 1] = offsets[i] + block.offsets[1:]
+        blocks.append(block.events)
+
+    if blocks:
+        events = np.concatenate(blocks)
+    else:
+        events = np.zeros(0, dtype=np.uint32)
+
+    return SparseFrames(events, offsets, start)
+
+
+class SparseFramesCache(object):
+    """A process wide LRU cache of `SparseFrames`, bounded by their size.
+
+    Entries are keyed by the path, the modification time and the size of
+    the file, so a file changing on disk is read again.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            frames = self._entries.get(key)
+            if frames is not None:
+                self._entries.move_to_end(key)
+            return frames
+
+    def set(self, key, frames):
+        if frames.nbytes > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous.nbytes
+            self._entries[key] = frames
+            self._size += frames.nbytes
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+
+
+cache = SparseFramesCache(int(os.environ.get('STEMWORKER_SPARSE_CACHE_SIZE',
+                                             1024 ** 3)))
+
+
+def _cache_key(reader, frames_path, start, stop):
+    stat = os.stat(reader.filename)
+    return (os.path.realpath(reader.filename), stat.st_mtime_ns, stat.st_size,
+            frames_path, start, stop)
+
+
+def load_frames(reader, start, stop, frames_path=FRAMES_PATH):
+    """Get the `SparseFrames` [start, stop) of an open h5py file.
+
+    The frames are cached, so executions on the same file reuse them.
+    """
+    key = _cache_key(reader, frames_path, start, stop)
+
+    frames = cache.get(key)
+    if frames is None:
+        frames = read_frames(reader[frames_path], start, stop)
+        cache.set(key, frames)
+
+    return frames
+
+
+def iter_frames(reader, start, stop, block_size=BLOCK_SIZE,
+                frames_path=FRAMES_PATH):
+    """Iterate over the frames [start, stop) of an open h5py file in
+    `SparseFrames` blocks of at most `block_size` frames.
+
+    The frames are taken from the cache when `load_frames` loaded them
+    already, otherwise they are read a block at a time and not cached, so
+    the memory used is bounded by the size of a block.
+    """
+    frames = cache.get(_cache_key(reader, frames_path, start, stop))
+    if frames is not None:
+        yield frames
+        return
+
+    dataset = reader[frames_path]
+    for block_start in range(start, stop, block_size):
+        yield read_frames(dataset, block_start,
+                          min(block_start + block_size, stop))